@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- python -*-
+#
+# Compares applying a dataset's AVUs one imeta process per AVU
+# (as irods_setavus used to) with the bulk writer in ids.namespace,
+# counting the processes each spawns against a local stand-in
+# catalog.
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import optparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from standin import catalog
+from ids.utils import shell_command
+from ids.namespace import irods_bulk_setavus
+
+
+def populate(zone, collections, objects):
+    """
+    Creates 'collections' collections of 'objects' data objects
+    each, and returns the paths as a {path: object type} dict.
+    """
+    db = catalog.create_zone(zone)
+    paths = {}
+    for c in range(collections):
+        coll = '/%s/home/dataset/coll%d' % (zone, c)
+        coll_id = catalog.add_collection(db, coll)
+        paths[coll] = '-C'
+        for n in range(objects):
+            catalog.add_data_object(db, coll_id, 'file%d.nii' % (n,))
+            paths['%s/file%d.nii' % (coll, n)] = '-d'
+    db.commit()
+    db.close()
+    return paths
+
+
+def dataset_avus(paths, avus, tag):
+    avu_dict = {}
+    for path in paths:
+        avu_dict[path] = [[paths[path], 'attr%d' % (n,), '%s-%d' % (tag, n), 'units' if n % 2 else '']
+                          for n in range(avus)]
+    return avu_dict
+
+
+def processes():
+    log = os.environ['IDS_STANDIN_CALL_LOG']
+    if not os.path.exists(log):
+        return 0
+    count = len(open(log).readlines())
+    os.remove(log)
+    return count
+
+
+def per_avu(avu_dict):
+    failures = 0
+    for path in avu_dict:
+        for avu in avu_dict[path]:
+            imeta_cmd = ['imeta', 'add', avu[0], path, avu[1], avu[2]]
+            if avu[3]:
+                imeta_cmd.append(avu[3])
+            if shell_command(imeta_cmd)[0]:
+                failures += 1
+    return failures
+
+
+def bulk(avu_dict):
+    return len(irods_bulk_setavus(avu_dict))
+
+
+if __name__ == '__main__':
+
+    parser = optparse.OptionParser()
+    parser.add_option('--collections', type='int', default=10,
+                      help='number of collections in the dataset')
+    parser.add_option('--objects', type='int', default=20,
+                      help='number of data objects per collection')
+    parser.add_option('--avus', type='int', default=5,
+                      help='number of AVUs per collection or data object')
+    parser.add_option('--connect-latency', type='float', default=0.02,
+                      help='simulated seconds to connect and authenticate')
+    parser.add_option('--query-latency', type='float', default=0.0,
+                      help='simulated seconds per catalog operation')
+    options, args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='ids-bench-')
+    try:
+        zone = 'benchZone'
+        catalog.activate(directory, zone)
+        os.environ['IDS_STANDIN_CONNECT_LATENCY'] = str(options.connect_latency)
+        os.environ['IDS_STANDIN_QUERY_LATENCY'] = str(options.query_latency)
+        os.environ['IDS_STANDIN_CALL_LOG'] = os.path.join(directory, 'calls.log')
+        paths = populate(zone, options.collections, options.objects)
+
+        results = []
+        for name, writer in (('per-AVU', per_avu), ('bulk', bulk)):
+            avu_dict = dataset_avus(paths, options.avus, name)
+            start = time.time()
+            failures = writer(avu_dict)
+            results.append((name, time.time() - start, processes(), failures))
+
+        print('%d AVUs on %d paths' % (len(paths) * options.avus, len(paths)))
+        for name, elapsed, count, failures in results:
+            print('%-8s %8.2f s %8d processes %6d failures'
+                  % (name, elapsed, count, failures))
+        print('process reduction: %.0fx' % (float(results[0][2]) / max(results[1][2], 1),))
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- python -*-
+#
+# Compares harvesting the IDS groups from LDAP one search per group
+# (as get_ldap_group_membership used to) with the single paged
+# search in ids.users, against a stand-in directory (see
+# standin/directory.py), counting the round trips each takes and
+# checking they find the same groups and members.
+#
+# Needs python-ldap, for its controls and DN parsing.
+
+import os
+import sys
+import time
+import optparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from standin.directory import StandinDirectory, synthetic_directory
+
+
+def per_group(directory, search_base):
+    """ the harvest as get_ldap_group_membership used to do it """
+    import ldap
+
+    group_list = {}
+    for dn, entry in directory.search_s(search_base, ldap.SCOPE_SUBTREE,
+                                        '(cn=ids-*)', ['cn']):
+        group_list[entry['cn'][0]] = []
+    for group in group_list:
+        for dn, entry in directory.search_s(search_base, ldap.SCOPE_SUBTREE,
+                                            '(cn=%s)' % (group,), ['member']):
+            for member in entry.get('member', []):
+                group_list[group].append(ldap.dn.str2dn(member)[0][0][1])
+    return group_list
+
+
+if __name__ == '__main__':
+
+    parser = optparse.OptionParser()
+    parser.add_option('--groups', type='int', default=500,
+                      help='number of ids-* groups')
+    parser.add_option('--users', type='int', default=50000,
+                      help='number of users')
+    parser.add_option('--memberships', type='int', default=3,
+                      help='groups per user, besides ids-user')
+    parser.add_option('--page-size', type='int', default=500,
+                      help='entries per page of the paged search')
+    parser.add_option('--latency', type='float', default=0.005,
+                      help='simulated seconds per LDAP round trip')
+    options, args = parser.parse_args()
+
+    try:
+        import ldap
+    except ImportError:
+        print('python-ldap is needed to run this benchmark')
+        sys.exit(1)
+    import ids.users
+
+    entries = synthetic_directory(options.groups, options.users, options.memberships)
+    os.environ['IDS_LDAP_PAGE_SIZE'] = str(options.page_size)
+
+    # point ids.users at the stand-in directory
+    directories = []
+    def connect(*args):
+        directories.append(StandinDirectory(entries, options.latency))
+        return directories[-1]
+    ids.users.connect_to_directory = connect
+
+    results = []
+    for name, harvest in (('per-group', lambda: per_group(connect(), ids.users.ldap_settings['base'])),
+                          ('paged', ids.users.get_ldap_group_membership)):
+        start = time.time()
+        groups = harvest()
+        results.append((name, time.time() - start, directories[-1].round_trips, groups))
+
+    print('%d groups, %d users' % (options.groups + 1, options.users))
+    for name, elapsed, round_trips, groups in results:
+        print('%-10s %8.2f s %8d round trips %8d memberships'
+              % (name, elapsed, round_trips, sum(len(users) for users in groups.values())))
+    same = (dict((g, sorted(u)) for g, u in results[0][3].items())
+            == dict((g, sorted(u)) for g, u in results[1][3].items()))
+    print('same groups and members: %s' % ('yes' if same else 'NO',))
+    if not same:
+        sys.exit(1)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- python -*-
+#
+# Compares the queries/sec of the run_iquest backends (one iquest
+# process per query vs. one open session per zone) against a
+# local stand-in catalog.
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import optparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from standin import catalog
+from ids.utils import run_iquest, set_query_backend, IquestBackend, SessionBackend
+
+
+# the kinds of queries the ids modules run most
+queries = [
+    ("select ZONE_NAME where ZONE_TYPE = 'local'", '%s'),
+    ('select ZONE_NAME, ZONE_TYPE, ZONE_CONNECTION', '%s~_~%s~_~%s'),
+    ("select USER_NAME, USER_ZONE where USER_ID = '%(id)s'", '%s#%s'),
+    ("select count(COLL_NAME) where COLL_NAME = '/%(zone)s/home/user%(n)d'", '%s'),
+    ]
+
+
+def populate(zone, users):
+    db = catalog.create_zone(zone, ['zone%d' % (i,) for i in range(10)])
+    ids = []
+    for n in range(users):
+        user_id = catalog.add_user(db, 'user%d' % (n,), zone)
+        catalog.add_collection(db, '/%s/home/user%d' % (zone, n), user_id)
+        ids.append(user_id)
+    db.commit()
+    db.close()
+    return ids
+
+
+def run(backend, user_ids, count, zone):
+    set_query_backend(backend)
+    start = time.time()
+    for n in range(count):
+        query, format = queries[n % len(queries)]
+        index = n % len(user_ids)
+        output = run_iquest(query % {'id': user_ids[index], 'n': index, 'zone': zone},
+                            format)
+        if output is None:
+            print('query failed: %s' % (query,))
+            sys.exit(1)
+    return count / (time.time() - start)
+
+
+if __name__ == '__main__':
+
+    parser = optparse.OptionParser()
+    parser.add_option('--queries', '-n', type='int', default=200,
+                      help='number of queries to run per backend')
+    parser.add_option('--users', type='int', default=1000,
+                      help='number of users in the stand-in catalog')
+    parser.add_option('--connect-latency', type='float', default=0.02,
+                      help='simulated seconds to connect and authenticate')
+    parser.add_option('--query-latency', type='float', default=0.001,
+                      help='simulated seconds per catalog query')
+    options, args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='ids-bench-')
+    try:
+        zone = 'benchZone'
+        catalog.activate(directory, zone)
+        os.environ['IDS_STANDIN_CONNECT_LATENCY'] = str(options.connect_latency)
+        os.environ['IDS_STANDIN_QUERY_LATENCY'] = str(options.query_latency)
+        user_ids = populate(zone, options.users)
+
+        results = [
+            ('iquest', run(IquestBackend(), user_ids, options.queries, zone)),
+            ('session', run(SessionBackend(connect=catalog.StandinConnection),
+                            user_ids, options.queries, zone)),
+            ]
+
+        print('%-10s %12s' % ('backend', 'queries/sec'))
+        for name, rate in results:
+            print('%-10s %12.1f' % (name, rate))
+        print('speedup: %.1fx' % (results[1][1] / results[0][1],))
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- python -*-
+#
+# Load test of ids-zone-api: starts the API against a stand-in
+# federation (see standin/), once with the Flask development server
+# (--debug) and once in the production serving mode, and has
+# concurrent clients request the zone list and single zones, to
+# compare throughput and latency. The stand-in's simulated latency
+# makes each request's iinit and iquest take as long as they would
+# against a remote ICAT.
+#
+# Needs Flask and its extensions, as the zone API does.
+
+import os
+import sys
+import time
+import base64
+import shutil
+import signal
+import socket
+import urllib2
+import tempfile
+import optparse
+import threading
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from standin import catalog
+from standin.synthetic import load_federation
+
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_for(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return True
+        except socket.error:
+            time.sleep(0.1)
+    return False
+
+
+def load(port, clients, requests, zones):
+    """
+    Makes 'requests' requests from each of 'clients' threads.
+    Returns the elapsed time, the latencies of the requests that
+    succeeded, and the number that failed.
+    """
+    headers = {'Authorization': 'Basic ' + base64.b64encode('user000000:user000000')}
+    latencies = []
+    failures = []
+
+    def client(n):
+        for r in range(requests):
+            if r % 2:
+                url = '/api/v1.0/zone/zone%03d' % ((n + r) % zones,)
+            else:
+                url = '/api/v1.0/zones'
+            start = time.time()
+            try:
+                urllib2.urlopen(urllib2.Request('http://127.0.0.1:%d%s' % (port, url),
+                                                headers=headers), timeout=120).read()
+                latencies.append(time.time() - start)
+            except (urllib2.URLError, socket.error):
+                failures.append(url)
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(clients)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.time() - start, sorted(latencies), len(failures)
+
+
+def percentile(values, percent):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+
+if __name__ == '__main__':
+
+    parser = optparse.OptionParser()
+    parser.add_option('--clients', type='int', default=16,
+                      help='number of concurrent clients')
+    parser.add_option('--requests', type='int', default=10,
+                      help='requests per client')
+    parser.add_option('--zones', type='int', default=50,
+                      help='number of zones in the federation')
+    parser.add_option('--processes', type='int', default=2,
+                      help='worker processes of the production server')
+    parser.add_option('--threads', type='int', default=8,
+                      help='threads per worker process of the production server')
+    parser.add_option('--connect-latency', type='float', default=0.05,
+                      help='simulated seconds for an icommand to connect')
+    parser.add_option('--query-latency', type='float', default=0.02,
+                      help='simulated seconds per catalog query')
+    options, args = parser.parse_args()
+
+    try:
+        import flask
+    except ImportError:
+        print('Flask is needed to run the zone API')
+        sys.exit(1)
+
+    directory = tempfile.mkdtemp(prefix='ids-bench-')
+    try:
+        zone = 'benchZone'
+        load_federation(directory, zone, zones=options.zones, users=10, groups=2,
+                        collections=0, objects=0)
+        catalog.activate(directory, zone)
+        os.environ['IDS_STANDIN_CONNECT_LATENCY'] = str(options.connect_latency)
+        os.environ['IDS_STANDIN_QUERY_LATENCY'] = str(options.query_latency)
+
+        modes = [
+            ('development', ['--debug']),
+            ('production', ['--processes', str(options.processes),
+                            '--threads', str(options.threads)]),
+            ]
+        print('%d clients x %d requests' % (options.clients, options.requests))
+        print('%-12s %9s %10s %9s %9s %9s %8s'
+              % ('server', 'wall s', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'failed'))
+        for name, server_options in modes:
+            port = free_port()
+            server = subprocess.Popen([sys.executable, os.path.join(root, 'bin', 'ids-zone-api'),
+                                       '--host', '127.0.0.1', '--port', str(port)]
+                                      + server_options,
+                                      stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+            try:
+                if not wait_for(port):
+                    print('%-12s did not start' % (name,))
+                    continue
+                elapsed, latencies, failed = load(port, options.clients, options.requests,
+                                                  options.zones - 1)
+                print('%-12s %9.2f %10.1f %9.1f %9.1f %9.1f %8d'
+                      % (name, elapsed, len(latencies) / elapsed,
+                         percentile(latencies, 50) * 1000, percentile(latencies, 95) * 1000,
+                         percentile(latencies, 99) * 1000, failed))
+            finally:
+                server.send_signal(signal.SIGTERM)
+                server.wait()
+    finally:
+        shutil.rmtree(directory)
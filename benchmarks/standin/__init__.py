@@ -0,0 +1,4 @@
+"""
+A local stand-in for an iRODS federation, used to exercise and
+benchmark the ids package without a live ICAT. See catalog.py.
+"""
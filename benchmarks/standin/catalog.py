@@ -0,0 +1,463 @@
+"""
+A sqlite-backed stand-in for an iRODS catalog (ICAT). Each zone
+of the stand-in federation is a sqlite file named <zone>.db in
+the directory given by $IDS_STANDIN_DIR, and the local zone is
+named by $IDS_STANDIN_ZONE.
+
+The catalog answers the subset of GenQuery used by the ids
+package, both for the stub icommands in standin/bin and for
+StandinConnection, a connection object for ids.utils.SessionBackend.
+
+Latency of a real ICAT can be simulated with the environment
+variables $IDS_STANDIN_CONNECT_LATENCY (seconds per connection,
+paid by every icommand process) and $IDS_STANDIN_QUERY_LATENCY
+(seconds per query or catalog change). Either can be set for one
+stub with $IDS_STANDIN_<PROGRAM>_CONNECT_LATENCY (for example
+$IDS_STANDIN_IQUEST_CONNECT_LATENCY), and $IDS_STANDIN_ZONE_LATENCY
+('zone=seconds,...') adds to the cost of connecting to slow zones.
+Each query or change is also counted as a line in the file named by
+$IDS_STANDIN_ROUND_TRIP_LOG, if set.
+
+standin/synthetic.py loads a federation with synthetic users,
+collections, data objects, AVUs and ACLs at scale.
+"""
+
+import os
+import sys
+import time
+import sqlite3
+import threading
+
+from ids.utils import parse_genquery
+
+
+
+schema = """
+create table if not exists zones (
+    id integer primary key, name text unique, type text, connection text,
+    comment text, create_time text, modify_time text);
+create table if not exists users (
+    id integer primary key, name text, zone text, type text,
+    comment text, create_time text, modify_time text);
+create table if not exists user_groups (group_id integer, user_id integer);
+create table if not exists passwords (user_id integer primary key, password text);
+create table if not exists resources (
+    id integer primary key, name text unique, zone text, type text,
+    class text, loc text, vault_path text, status text, info text,
+    comment text, create_time text, modify_time text);
+create table if not exists colls (
+    id integer primary key, name text unique, parent_name text,
+    owner_name text, owner_zone text, create_time text, modify_time text);
+create table if not exists data (
+    id integer primary key, coll_id integer, name text, size integer,
+    resc_name text, owner_name text, owner_zone text,
+    create_time text, modify_time text);
+create table if not exists coll_meta (
+    coll_id integer, name text, value text, units text);
+create table if not exists data_meta (
+    data_id integer, name text, value text, units text);
+create table if not exists coll_access (
+    coll_id integer, user_id integer, access text);
+create table if not exists data_access (
+    data_id integer, user_id integer, access text);
+create index if not exists data_coll on data (coll_id);
+create index if not exists coll_meta_coll on coll_meta (coll_id);
+create index if not exists data_meta_data on data_meta (data_id);
+create index if not exists coll_access_coll on coll_access (coll_id);
+create index if not exists data_access_data on data_access (data_id);
+create index if not exists user_groups_user on user_groups (user_id);
+create index if not exists users_name on users (name, zone);
+"""
+
+
+# GenQuery column name -> (table alias, sql column)
+columns = {
+    'ZONE_ID': ('zones', 'id'),
+    'ZONE_NAME': ('zones', 'name'),
+    'ZONE_TYPE': ('zones', 'type'),
+    'ZONE_CONNECTION': ('zones', 'connection'),
+    'ZONE_COMMENT': ('zones', 'comment'),
+    'ZONE_CREATE_TIME': ('zones', 'create_time'),
+    'ZONE_MODIFY_TIME': ('zones', 'modify_time'),
+    'USER_ID': ('users', 'id'),
+    'USER_NAME': ('users', 'name'),
+    'USER_ZONE': ('users', 'zone'),
+    'USER_TYPE': ('users', 'type'),
+    'USER_COMMENT': ('users', 'comment'),
+    'USER_CREATE_TIME': ('users', 'create_time'),
+    'USER_MODIFY_TIME': ('users', 'modify_time'),
+    'USER_GROUP_ID': ('grp', 'id'),
+    'USER_GROUP_NAME': ('grp', 'name'),
+    'RESC_ID': ('resources', 'id'),
+    'RESC_NAME': ('resources', 'name'),
+    'RESC_ZONE_NAME': ('resources', 'zone'),
+    'RESC_TYPE_NAME': ('resources', 'type'),
+    'RESC_CLASS_NAME': ('resources', 'class'),
+    'RESC_LOC': ('resources', 'loc'),
+    'RESC_VAULT_PATH': ('resources', 'vault_path'),
+    'RESC_STATUS': ('resources', 'status'),
+    'RESC_INFO': ('resources', 'info'),
+    'RESC_COMMENT': ('resources', 'comment'),
+    'RESC_CREATE_TIME': ('resources', 'create_time'),
+    'RESC_MODIFY_TIME': ('resources', 'modify_time'),
+    'COLL_ID': ('colls', 'id'),
+    'COLL_NAME': ('colls', 'name'),
+    'COLL_PARENT_NAME': ('colls', 'parent_name'),
+    'COLL_OWNER_NAME': ('colls', 'owner_name'),
+    'COLL_OWNER_ZONE': ('colls', 'owner_zone'),
+    'COLL_CREATE_TIME': ('colls', 'create_time'),
+    'COLL_MODIFY_TIME': ('colls', 'modify_time'),
+    'DATA_ID': ('data', 'id'),
+    'DATA_COLL_ID': ('data', 'coll_id'),
+    'DATA_NAME': ('data', 'name'),
+    'DATA_SIZE': ('data', 'size'),
+    'DATA_RESC_NAME': ('data', 'resc_name'),
+    'DATA_OWNER_NAME': ('data', 'owner_name'),
+    'DATA_OWNER_ZONE': ('data', 'owner_zone'),
+    'DATA_CREATE_TIME': ('data', 'create_time'),
+    'DATA_MODIFY_TIME': ('data', 'modify_time'),
+    'META_COLL_ATTR_NAME': ('coll_meta', 'name'),
+    'META_COLL_ATTR_VALUE': ('coll_meta', 'value'),
+    'META_COLL_ATTR_UNITS': ('coll_meta', 'units'),
+    'META_DATA_ATTR_NAME': ('data_meta', 'name'),
+    'META_DATA_ATTR_VALUE': ('data_meta', 'value'),
+    'META_DATA_ATTR_UNITS': ('data_meta', 'units'),
+    'COLL_ACCESS_NAME': ('coll_access', 'access'),
+    'COLL_ACCESS_USER_ID': ('coll_access', 'user_id'),
+    'DATA_ACCESS_NAME': ('data_access', 'access'),
+    'DATA_ACCESS_USER_ID': ('data_access', 'user_id'),
+    }
+
+
+# table alias -> (sql table, alias this one joins to, join condition)
+tables = {
+    'zones': ('zones', None, None),
+    'users': ('users', None, None),
+    'user_groups': ('user_groups', 'users', 'user_groups.user_id = users.id'),
+    'grp': ('users', 'user_groups', 'grp.id = user_groups.group_id'),
+    'resources': ('resources', None, None),
+    'colls': ('colls', None, None),
+    'data': ('data', 'colls', 'data.coll_id = colls.id'),
+    'coll_meta': ('coll_meta', 'colls', 'coll_meta.coll_id = colls.id'),
+    'data_meta': ('data_meta', 'data', 'data_meta.data_id = data.id'),
+    'coll_access': ('coll_access', 'colls', 'coll_access.coll_id = colls.id'),
+    'data_access': ('data_access', 'data', 'data_access.data_id = data.id'),
+    }
+
+
+sql_ops = {
+    '=': '=', '<>': '<>', '<': '<', '>': '>', '<=': '<=', '>=': '>=',
+    'like': 'like', 'not like': 'not like',
+    }
+
+
+
+def genquery_to_sql(selects, conditions):
+    """
+    Translates a parsed GenQuery (see ids.utils.parse_genquery)
+    into a sql statement and its parameters. Tables are joined
+    automatically, the way the ICAT does.
+    """
+
+    needed = []
+    def need(alias):
+        while alias and alias not in needed:
+            needed.append(alias)
+            alias = tables[alias][1]
+
+    sel = []
+    group = []
+    order = []
+    aggregate = False
+    for func, column in selects:
+        if column not in columns:
+            raise ValueError('unsupported column %s' % (column,))
+        alias, col = columns[column]
+        need(alias)
+        expr = '%s.%s' % (alias, col)
+        if func in ('count', 'sum', 'min', 'max', 'avg'):
+            aggregate = True
+            sel.append('%s(%s)' % (func, expr))
+        else:
+            sel.append(expr)
+            group.append(expr)
+            if func == 'order':
+                order.append(expr)
+            elif func == 'order_desc':
+                order.append(expr + ' desc')
+
+    where = []
+    params = []
+    for column, ops in conditions:
+        if column not in columns:
+            raise ValueError('unsupported column %s' % (column,))
+        alias, col = columns[column]
+        need(alias)
+        alts = []
+        for op, value in ops:
+            alts.append('%s.%s %s ?' % (alias, col, sql_ops[op]))
+            params.append(value)
+        where.append('(%s)' % (' or '.join(alts),))
+
+    # join parents before children
+    def depth(alias):
+        parent = tables[alias][1]
+        return depth(parent) + 1 if parent else 0
+    needed.sort(key=depth)
+    joins = []
+    for alias in needed:
+        table, parent, on = tables[alias]
+        if not joins:
+            joins.append('%s as %s' % (table, alias))
+        elif parent in needed:
+            joins.append('join %s as %s on %s' % (table, alias, on))
+        else:
+            joins.append('cross join %s as %s' % (table, alias))
+
+    sql = 'select %s%s from %s' % ('' if aggregate else 'distinct ',
+                                   ', '.join(sel), ' '.join(joins))
+    if where:
+        sql += ' where ' + ' and '.join(where)
+    if aggregate and group:
+        sql += ' group by ' + ', '.join(group)
+    if order:
+        sql += ' order by ' + ', '.join(order)
+
+    return sql, params
+
+
+
+def catalog_dir():
+    return os.environ.get('IDS_STANDIN_DIR', '/tmp/ids-standin')
+
+
+def local_zone():
+    return os.environ.get('IDS_STANDIN_ZONE', 'tempZone')
+
+
+def latency(name, program=None, zone=None):
+    """
+    Returns the simulated latency 'name' ('CONNECT' or 'QUERY'),
+    in seconds, for the stub 'program' talking to 'zone'.
+    """
+    value = os.environ.get('IDS_STANDIN_%s_LATENCY' % (name,), 0)
+    if program:
+        value = os.environ.get('IDS_STANDIN_%s_%s_LATENCY' % (program.upper(), name),
+                               value)
+    seconds = float(value)
+    if name == 'CONNECT':
+        for item in os.environ.get('IDS_STANDIN_ZONE_LATENCY', '').split(','):
+            if '=' in item:
+                slow_zone, extra = item.split('=', 1)
+                if slow_zone.strip() == (zone or local_zone()):
+                    seconds += float(extra)
+    return seconds
+
+
+
+def open_catalog(zone=None, create=False):
+    """
+    Opens the sqlite database of a stand-in zone (the local
+    zone if zone is None). Returns None if the zone doesn't
+    exist and create is False.
+    """
+    path = os.path.join(catalog_dir(), '%s.db' % (zone or local_zone(),))
+    if not create and not os.path.exists(path):
+        return None
+    db = sqlite3.connect(path, check_same_thread=False)
+    db.text_factory = str
+    db.execute('pragma case_sensitive_like = on')
+    if create:
+        db.executescript(schema)
+    return db
+
+
+
+def open_path_catalog(path):
+    """
+    Opens the catalog of the zone an iRODS path is in, the way
+    a federation redirects requests for paths in other zones,
+    falling back to the local zone. Returns None if neither
+    exists.
+    """
+    parts = path.split('/')
+    if len(parts) > 1 and parts[1]:
+        db = open_catalog(parts[1])
+        if db is not None:
+            return db
+    return open_catalog()
+
+
+def run_genquery(db, selects, conditions, page_size=256, lock=None):
+    """
+    Runs a parsed GenQuery against the catalog, yielding rows
+    (tuples of strings) as iquest would return them, fetching
+    page_size rows at a time. If 'lock' is given, it is held
+    while talking to the database.
+    """
+    sql, params = genquery_to_sql(selects, conditions)
+    lock = lock or threading.Lock()
+    with lock:
+        cursor = db.execute(sql, params)
+    while True:
+        with lock:
+            page = cursor.fetchmany(page_size)
+        if not page:
+            break
+        for row in page:
+            yield tuple('' if value is None else str(value) for value in row)
+
+
+
+def record_call(program, args):
+    """
+    Appends a line for each stub icommand invocation to the
+    file named by $IDS_STANDIN_CALL_LOG, so benchmarks can count
+    the processes a workflow spawned.
+    """
+    log = os.environ.get('IDS_STANDIN_CALL_LOG')
+    if log:
+        with open(log, 'a') as f:
+            f.write('%s %s\n' % (program, ' '.join(args).replace('\n', ' ')))
+
+
+
+
+def round_trip(program, zone=None):
+    """
+    Pays the simulated latency of one catalog query or change by
+    'program', and counts it with a line in the file named by
+    $IDS_STANDIN_ROUND_TRIP_LOG, if set.
+    """
+    time.sleep(latency('QUERY', program))
+    log = os.environ.get('IDS_STANDIN_ROUND_TRIP_LOG')
+    if log:
+        with open(log, 'a') as f:
+            f.write('%s %s\n' % (program, zone or local_zone()))
+
+
+class StandinConnection(object):
+    """
+    A connection to a stand-in zone for ids.utils.SessionBackend.
+    Connecting costs $IDS_STANDIN_CONNECT_LATENCY once, and each
+    query is a round trip (see round_trip()).
+    """
+
+    def __init__(self, zone=None):
+        time.sleep(latency('CONNECT', zone=zone))
+        self.lock = threading.Lock()
+        self.dbs = {}
+        if self.get_db(zone) is None:
+            raise IOError('no such zone %s' % (zone,))
+
+
+    def get_db(self, zone):
+        if zone not in self.dbs:
+            self.dbs[zone] = open_catalog(zone)
+        return self.dbs[zone]
+
+
+    def genquery(self, selects, conditions, zone=None):
+        round_trip('session', zone)
+        return run_genquery(self.get_db(zone), selects, conditions,
+                            lock=self.lock)
+
+
+    def close(self):
+        for db in self.dbs.values():
+            if db is not None:
+                db.close()
+        self.dbs = {}
+
+
+
+def irods_time(t=None):
+    """ iRODS stores times as zero padded epoch seconds """
+    return '%011d' % (t if t is not None else time.time(),)
+
+
+
+def create_zone(zone, zone_list=(), connection='localhost:1247'):
+    """
+    Creates (or opens) the stand-in catalog for 'zone', with zone
+    definitions for the zone itself (local) and every zone in
+    'zone_list' (remote). Returns the open sqlite connection.
+    """
+    db = open_catalog(zone, create=True)
+    now = irods_time()
+    db.execute('insert or ignore into zones values (null, ?, ?, ?, ?, ?, ?)',
+               (zone, 'local', connection, '', now, now))
+    for remote in zone_list:
+        if remote != zone:
+            db.execute('insert or ignore into zones values (null, ?, ?, ?, ?, ?, ?)',
+                       (remote, 'remote', '%s.example.org:1247' % (remote,),
+                        '', now, now))
+    db.commit()
+    return db
+
+
+
+def add_user(db, name, zone, user_type='rodsuser'):
+    """ adds a user (or group, with user_type 'rodsgroup') and returns its id """
+    now = irods_time()
+    cursor = db.execute('insert into users values (null, ?, ?, ?, ?, ?, ?)',
+                        (name, zone, user_type, '', now, now))
+    user_id = cursor.lastrowid
+    if user_type == 'rodsgroup':
+        # iRODS makes every group a member of itself
+        db.execute('insert into user_groups values (?, ?)', (user_id, user_id))
+    return user_id
+
+
+
+def set_password(db, user_id, password):
+    """ sets the password iinit checks for a user """
+    db.execute('insert or replace into passwords values (?, ?)', (user_id, password))
+
+
+
+def add_collection(db, name, owner_id=None):
+    """ adds a collection (not its parents) and returns its id """
+    now = irods_time()
+    parent = name.rsplit('/', 1)[0] or '/'
+    cursor = db.execute('insert into colls values (null, ?, ?, ?, ?, ?, ?)',
+                        (name, parent, 'rods', '', now, now))
+    coll_id = cursor.lastrowid
+    if owner_id is not None:
+        db.execute('insert into coll_access values (?, ?, ?)',
+                   (coll_id, owner_id, 'own'))
+    return coll_id
+
+
+
+def add_data_object(db, coll_id, name, size=0, owner_id=None):
+    """ adds a data object to a collection and returns its id """
+    now = irods_time()
+    cursor = db.execute('insert into data values (null, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        (coll_id, name, size, 'demoResc', 'rods', '', now, now))
+    data_id = cursor.lastrowid
+    if owner_id is not None:
+        db.execute('insert into data_access values (?, ?, ?)',
+                   (data_id, owner_id, 'own'))
+    return data_id
+
+
+
+def activate(directory, zone):
+    """
+    Points this process (and any icommands it runs) at the
+    stand-in federation in 'directory' with local zone 'zone',
+    by setting the environment and putting the stub icommands
+    first on $PATH.
+    """
+    os.environ['IDS_STANDIN_DIR'] = directory
+    os.environ['IDS_STANDIN_ZONE'] = zone
+    stubs = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bin')
+    path = os.environ.get('PATH', '').split(os.pathsep)
+    if stubs not in path:
+        os.environ['PATH'] = os.pathsep.join([stubs] + path)
+    # the stubs import the ids package from this tree
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    pythonpath = os.environ.get('PYTHONPATH', '')
+    if root not in pythonpath.split(os.pathsep):
+        os.environ['PYTHONPATH'] = os.pathsep.join(p for p in [root, pythonpath] if p)
@@ -0,0 +1,185 @@
+"""
+A stand-in for the INCF LDAP directory: an in-memory directory
+object with the subset of the python-ldap LDAPObject interface
+used by ids.users (start_tls_s, simple_bind_s, search_s, and
+search_ext/result3 with the paged results control), so the LDAP
+harvest can be run and measured without an LDAP server.
+
+Every request is a round trip, counted in round_trips and costing
+'latency' seconds. Filters are limited to what ids.users sends:
+(attr=value) with '*' wildcards, and (|...) and (&...) of those.
+"""
+
+import re
+import time
+import random
+
+
+# the OID of the paged results control
+paged_results_oid = '1.2.840.113556.1.4.319'
+
+# python-ldap's result type for a search result
+RES_SEARCH_RESULT = 101
+
+
+
+class PagedResultsResponse(object):
+    """ the paged results control a server returns with a page """
+
+    controlType = paged_results_oid
+
+    def __init__(self, size, cookie):
+        self.size = size
+        self.cookie = cookie
+
+
+
+class StandinDirectory(object):
+    """
+    A connection to a directory holding 'entries', a list of
+    (dn, {attribute: [values]}) tuples.
+    """
+
+    def __init__(self, entries, latency=0.0):
+        self.entries = entries
+        self.latency = latency
+        self.round_trips = 0
+        self.searches = {}
+        self.next_msgid = 1
+
+
+    def round_trip(self):
+        self.round_trips += 1
+        time.sleep(self.latency)
+
+
+    def start_tls_s(self):
+        self.round_trip()
+
+
+    def simple_bind_s(self, who='', cred=''):
+        self.round_trip()
+
+
+    def search_s(self, base, scope, filterstr='(objectClass=*)', attrlist=None):
+        self.round_trip()
+        return list(self.matches(base, filterstr, attrlist))
+
+
+    def search_ext(self, base, scope, filterstr='(objectClass=*)', attrlist=None,
+                   attrsonly=0, serverctrls=None):
+        page_size = None
+        cookie = ''
+        for control in serverctrls or []:
+            if control.controlType == paged_results_oid:
+                page_size = control.size
+                cookie = control.cookie
+        msgid = self.next_msgid
+        self.next_msgid += 1
+        self.searches[msgid] = (base, filterstr, attrlist, page_size, cookie)
+        return msgid
+
+
+    def result3(self, msgid):
+        """
+        Returns a page of results for a search_ext() request, with
+        a paged results control whose cookie (the offset of the
+        next page) is empty on the last page.
+        """
+        self.round_trip()
+        base, filterstr, attrlist, page_size, cookie = self.searches.pop(msgid)
+        results = list(self.matches(base, filterstr, attrlist))
+        if page_size is None:
+            return RES_SEARCH_RESULT, results, msgid, []
+        start = int(cookie or 0)
+        end = start + page_size
+        next_cookie = str(end) if end < len(results) else ''
+        return (RES_SEARCH_RESULT, results[start:end], msgid,
+                [PagedResultsResponse(page_size, next_cookie)])
+
+
+    def matches(self, base, filterstr, attrlist):
+        match = compile_filter(filterstr)
+        base = base.lower()
+        for dn, entry in self.entries:
+            if not dn.lower().endswith(base) or not match(entry):
+                continue
+            if attrlist:
+                wanted = set(name.lower() for name in attrlist)
+                entry = dict((name, values) for name, values in entry.items()
+                             if name.lower() in wanted)
+            yield dn, entry
+
+
+
+def compile_filter(filterstr):
+    """
+    Returns a function of an entry that tells whether it matches
+    the LDAP filter 'filterstr'.
+    """
+    match, rest = _parse_filter(filterstr.strip())
+    if rest:
+        raise ValueError('bad filter: %s' % (filterstr,))
+    return match
+
+
+def _parse_filter(text):
+    if not text.startswith('('):
+        raise ValueError('bad filter: %s' % (text,))
+    if text[1] in '|&':
+        op = any if text[1] == '|' else all
+        text = text[2:]
+        parts = []
+        while not text.startswith(')'):
+            part, text = _parse_filter(text)
+            parts.append(part)
+        return (lambda entry: op(part(entry) for part in parts)), text[1:]
+
+    end = text.index(')')
+    name, value = text[1:end].split('=', 1)
+    value = re.sub(r'\\([0-9a-fA-F]{2})', lambda m: chr(int(m.group(1), 16)), value)
+    pattern = re.compile('^%s$' % ('.*'.join(re.escape(part) for part in value.split('*')),),
+                         re.IGNORECASE)
+    name = name.lower()
+    def match(entry):
+        for attribute, values in entry.items():
+            if attribute.lower() == name:
+                return any(pattern.match(v) for v in values)
+        return False
+    return match, text[end + 1:]
+
+
+
+def synthetic_directory(groups=500, users=50000, memberships=3, seed=0,
+                        timestamp='20140101000000Z'):
+    """
+    Returns the entries of a directory with 'users' people
+    (uid=userNNNNNN) and the IDS groups: ids-user, with every user
+    in it, and 'groups' more groups, each user being a member of
+    'memberships' of them. The directory also holds some groups
+    that aren't IDS groups, as a real one does.
+    """
+    rand = random.Random(seed)
+    people = 'ou=people,dc=incf,dc=org'
+    base = 'ou=groups,dc=incf,dc=org'
+    uids = ['user%06d' % (n,) for n in range(users)]
+    members = dict(('ids-group%04d' % (n,), []) for n in range(groups))
+    names = sorted(members)
+    for uid in uids:
+        for name in rand.sample(names, min(memberships, groups)):
+            members[name].append('uid=%s,%s' % (uid, people))
+    members['ids-user'] = ['uid=%s,%s' % (uid, people) for uid in uids]
+
+    entries = []
+    for uid in uids:
+        entries.append(('uid=%s,%s' % (uid, people),
+                        {'uid': [uid], 'objectClass': ['inetOrgPerson']}))
+    for name in sorted(members):
+        entries.append(('cn=%s,%s' % (name, base),
+                        {'cn': [name], 'objectClass': ['groupOfNames'],
+                         'member': members[name], 'modifyTimestamp': [timestamp]}))
+    for n in range(groups / 10):
+        entries.append(('cn=staff%03d,%s' % (n, base),
+                        {'cn': ['staff%03d' % (n,)], 'objectClass': ['groupOfNames'],
+                         'member': [], 'modifyTimestamp': [timestamp]}))
+    return entries
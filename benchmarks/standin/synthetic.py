@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# -*- python -*-
+"""
+Loads a stand-in federation (see catalog.py) with synthetic data
+at a realistic scale, for example:
+
+  python benchmarks/standin/synthetic.py --dir /tmp/federation \
+      --zones 200 --users 50000 --objects 1000000
+
+The local zone gets IDS users (user#incf), ids-* groups with their
+members, a home collection per user, and project collections that
+hold the data objects, each with its AVUs and its owner and group
+ACLs. Every other zone of the federation gets a small catalog of
+its own, so that queries with 'iquest -z' work for all of them.
+
+Users' passwords (for the iinit stub) are their user names, and
+'rods' (the local rodsadmin) has the password 'rods'.
+"""
+
+import os
+import sys
+import time
+import random
+import optparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))))
+
+from standin import catalog
+
+
+# attribute names and values for the synthetic AVUs
+avu_values = [
+    ('species', ['rat', 'mouse', 'human', 'macaque', 'zebrafish']),
+    ('modality', ['MRI', 'EEG', 'MEG', 'histology', 'ephys']),
+    ('experiment', ['exp%02d' % (n,) for n in range(50)]),
+    ('subject', ['sub%03d' % (n,) for n in range(500)]),
+    ('session', ['ses%d' % (n,) for n in range(10)]),
+    ]
+
+
+
+def zone_names(count):
+    return ['zone%03d' % (n,) for n in range(count)]
+
+
+
+def load_federation(directory, zone, zones=200, users=50000, groups=500,
+                    collections=10000, objects=1000000, avus=2,
+                    seed=0, progress=None):
+    """
+    Creates the stand-in federation in 'directory' with local
+    zone 'zone', and 'zones' - 1 other zones. 'progress', if
+    given, is called with a message as each stage starts.
+
+    Returns a dict of the numbers of rows loaded, by table.
+    """
+    rand = random.Random(seed)
+    progress = progress or (lambda message: None)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    catalog.activate(directory, zone)
+
+    federation = [zone] + [name for name in zone_names(zones) if name != zone][:zones - 1]
+
+    progress('creating %d zones' % (len(federation),))
+    for remote in federation[1:]:
+        db = catalog.create_zone(remote, federation)
+        admin = catalog.add_user(db, 'rods', remote, 'rodsadmin')
+        catalog.set_password(db, admin, 'rods')
+        catalog.add_collection(db, '/' + remote, admin)
+        catalog.add_collection(db, '/%s/home' % (remote,), admin)
+        db.commit()
+        db.close()
+
+    db = catalog.create_zone(zone, federation)
+    db.execute('pragma synchronous = off')
+    db.execute('pragma journal_mode = memory')
+    counts = {}
+    now = time.time()
+
+    def when():
+        return catalog.irods_time(now - rand.randint(0, 3 * 365 * 86400))
+
+    # users and groups, with explicit ids so nothing has to be
+    # looked up while loading
+    progress('loading %d users and %d groups' % (users, groups))
+    user_id = db.execute('select coalesce(max(id), 0) from users').fetchone()[0] + 1
+    admin_id = user_id
+    user_rows = [(admin_id, 'rods', zone, 'rodsadmin', '', when(), when())]
+    password_rows = [(admin_id, 'rods')]
+    group_names = ['ids-user', 'public'] + ['ids-group%04d' % (n,) for n in range(groups)]
+    group_ids = []
+    for name in group_names:
+        user_id += 1
+        group_ids.append(user_id)
+        user_rows.append((user_id, name, zone, 'rodsgroup', '', when(), when()))
+    member_rows = [(group_id, group_id) for group_id in group_ids]
+    user_ids = []
+    for n in range(users):
+        user_id += 1
+        user_ids.append(user_id)
+        name = 'user%06d' % (n,)
+        user_rows.append((user_id, name, 'incf', 'rodsuser', '', when(), when()))
+        password_rows.append((user_id, name))
+        member_rows.append((group_ids[0], user_id))
+        member_rows.append((group_ids[1], user_id))
+        for group_id in rand.sample(group_ids[2:], min(3, groups)):
+            member_rows.append((group_id, user_id))
+    db.executemany('insert into users values (?, ?, ?, ?, ?, ?, ?)', user_rows)
+    db.executemany('insert into passwords values (?, ?)', password_rows)
+    db.executemany('insert into user_groups values (?, ?)', member_rows)
+    counts['users'] = len(user_rows)
+    counts['user_groups'] = len(member_rows)
+
+    # collections: the zone's top-level ones, home collections,
+    # and project collections of up to 100 sub-collections each
+    progress('loading %d home and %d project collections' % (users, collections))
+    first_coll = db.execute('select coalesce(max(id), 0) from colls').fetchone()[0] + 1
+    coll_rows = []
+    coll_access_rows = []
+    def add_coll(name, owner, group=None):
+        coll_id = len(coll_rows) + first_coll
+        parent = name.rsplit('/', 1)[0] or '/'
+        coll_rows.append((coll_id, name, parent, 'rods', zone, when(), when()))
+        coll_access_rows.append((coll_id, owner, 'own'))
+        if group:
+            coll_access_rows.append((coll_id, group, 'read object'))
+        return coll_id
+    for name in ['/' + zone, '/%s/home' % (zone,), '/%s/projects' % (zone,)]:
+        add_coll(name, admin_id, group_ids[1])
+    for n, owner in enumerate(user_ids):
+        add_coll('/%s/home/user%06d' % (zone, n), owner)
+    datasets = []
+    for n in range(collections):
+        if n % 100 == 0:
+            add_coll('/%s/projects/p%04d' % (zone, n / 100), admin_id, group_ids[1])
+        owner = rand.choice(user_ids) if user_ids else admin_id
+        group = rand.choice(group_ids[2:]) if groups else None
+        datasets.append((add_coll('/%s/projects/p%04d/c%02d' % (zone, n / 100, n % 100),
+                                  owner, group), owner, group))
+    db.executemany('insert into colls values (?, ?, ?, ?, ?, ?, ?)', coll_rows)
+    db.executemany('insert into coll_access values (?, ?, ?)', coll_access_rows)
+    counts['colls'] = len(coll_rows)
+    counts['coll_access'] = len(coll_access_rows)
+
+    # data objects, spread evenly over the project collections,
+    # with their AVUs and ACLs, loaded in chunks
+    progress('loading %d data objects' % (objects,))
+    data_id = db.execute('select coalesce(max(id), 0) from data').fetchone()[0]
+    counts['data'] = counts['data_meta'] = counts['data_access'] = 0
+    chunk = 50000
+    for start in range(0, objects if datasets else 0, chunk):
+        data_rows = []
+        meta_rows = []
+        access_rows = []
+        for n in range(start, min(objects, start + chunk)):
+            data_id += 1
+            coll, owner, group = datasets[n % len(datasets)]
+            data_rows.append((data_id, coll, 'file%07d.dat' % (n,),
+                              rand.randint(0, 1 << 30), 'demoResc', 'rods', zone,
+                              when(), when()))
+            for attr, values in rand.sample(avu_values, min(avus, len(avu_values))):
+                meta_rows.append((data_id, attr, rand.choice(values), ''))
+            access_rows.append((data_id, owner, 'own'))
+            if group:
+                access_rows.append((data_id, group, 'read object'))
+        db.executemany('insert into data values (?, ?, ?, ?, ?, ?, ?, ?, ?)', data_rows)
+        db.executemany('insert into data_meta values (?, ?, ?, ?)', meta_rows)
+        db.executemany('insert into data_access values (?, ?, ?)', access_rows)
+        counts['data'] += len(data_rows)
+        counts['data_meta'] += len(meta_rows)
+        counts['data_access'] += len(access_rows)
+        progress('  %d data objects' % (counts['data'],))
+
+    db.commit()
+    db.close()
+    return counts
+
+
+
+if __name__ == '__main__':
+
+    parser = optparse.OptionParser(usage='%prog --dir DIRECTORY [options]')
+    parser.add_option('--dir', dest='directory',
+                      help='directory to create the stand-in federation in')
+    parser.add_option('--zone', default='benchZone',
+                      help='name of the local zone')
+    parser.add_option('--zones', type='int', default=200,
+                      help='number of zones in the federation')
+    parser.add_option('--users', type='int', default=50000,
+                      help='number of IDS users')
+    parser.add_option('--groups', type='int', default=500,
+                      help='number of ids-* groups')
+    parser.add_option('--collections', type='int', default=10000,
+                      help='number of project collections')
+    parser.add_option('--objects', type='int', default=1000000,
+                      help='number of data objects')
+    parser.add_option('--avus', type='int', default=2,
+                      help='number of AVUs per data object')
+    parser.add_option('--seed', type='int', default=0,
+                      help='random seed')
+    options, args = parser.parse_args()
+
+    if not options.directory:
+        parser.error('--dir is required')
+
+    def progress(message):
+        sys.stderr.write('%s\n' % (message,))
+
+    start = time.time()
+    counts = load_federation(options.directory, options.zone, options.zones,
+                             options.users, options.groups, options.collections,
+                             options.objects, options.avus, options.seed, progress)
+    for table in sorted(counts):
+        print('%-12s %10d rows' % (table, counts[table]))
+    print('loaded in %.1f s' % (time.time() - start,))
+    print('use it with: IDS_STANDIN_DIR=%s IDS_STANDIN_ZONE=%s PATH=%s:$PATH'
+          % (os.path.abspath(options.directory), options.zone,
+             os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bin')))
@@ -0,0 +1,439 @@
+#!/usr/bin/env python
+# -*- python -*-
+#
+# Runs the ids command line workflows against a stand-in federation
+# (see standin/) at several data sizes, and records for each run its
+# wall time, the number of icommand processes it spawned, its catalog
+# round trips and the peak RSS of the workflow's own process. The
+# results are written as JSON, and can be compared against a stored
+# baseline to catch regressions:
+#
+#   python benchmarks/suite.py --sizes small,medium
+#   python benchmarks/suite.py --sizes small --check
+#   python benchmarks/suite.py --sizes small --save-baseline
+#
+# Every case runs the real bin script (or, for the zone API, the
+# Flask application) in a fresh process, against a federation built
+# for it in a temporary directory.
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import optparse
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from standin import catalog
+from standin.synthetic import load_federation
+
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+default_baseline = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'baseline.json')
+
+local_zone = 'benchZone'
+
+
+# parameters of each data size
+sizes = {
+    'small': dict(zones=5, users=200, groups=20, collections=20, objects=500,
+                  events=50, requests=20),
+    'medium': dict(zones=20, users=2000, groups=100, collections=200, objects=10000,
+                   events=200, requests=100),
+    'large': dict(zones=100, users=20000, groups=500, collections=2000, objects=100000,
+                  events=1000, requests=500),
+    }
+
+# the metrics compared against the baseline
+metrics = ['wall', 'processes', 'round_trips', 'max_rss_kb']
+
+
+
+def script(name, *args):
+    return [sys.executable, os.path.join(root, 'bin', name)] + list(args)
+
+
+
+def load(directory, size, zone=local_zone, **overrides):
+    params = dict(zones=size['zones'], users=size['users'], groups=size['groups'],
+                  collections=size['collections'], objects=size['objects'])
+    params.update(overrides)
+    return load_federation(directory, zone, **params)
+
+
+
+def copy_users(directory, from_zone, to_zone):
+    """
+    Copies the users and groups of one stand-in zone (other than
+    its rods) into another, so ACLs naming them can be set there.
+    The groups become groups of the other zone.
+    """
+    db = catalog.open_catalog(to_zone)
+    db.execute("attach database ? as source",
+               (os.path.join(directory, '%s.db' % (from_zone,)),))
+    db.execute("insert into users select * from source.users where name != 'rods'")
+    db.execute("insert into user_groups select * from source.user_groups")
+    db.execute("update users set zone = ? where type = 'rodsgroup'", (to_zone,))
+    db.commit()
+    db.close()
+
+
+
+#
+# The cases. Each takes the federation directory and the size
+# parameters, builds the federation, and returns the list of
+# commands that make up the workflow (run one after the other)
+# and a list of commands to run first, unmeasured.
+#
+
+def copy_dataset(directory, size):
+    """ ids-copy-dataset of a project: harvest, irsync, ACLs and AVUs """
+    load(directory, size, zones=2)
+    copy_users(directory, local_zone, 'zone000')
+    command = script('ids-copy-dataset', '/%s/projects/p0000' % (local_zone,),
+                     '/zone000/home/p0000')
+    return [command], []
+
+
+def copy_dataset_sharded(directory, size):
+    """ ids-copy-dataset with the data copied by 4 irsyncs at once """
+    commands, setup = copy_dataset(directory, size)
+    return [commands[0] + ['--transfers', '4']], setup
+
+
+def copy_dataset_pipelined(directory, size):
+    """ ids-copy-dataset with the ACLs and AVUs set as the data is copied """
+    commands, setup = copy_dataset(directory, size)
+    return [commands[0] + ['--transfers', '4', '--pipeline']], setup
+
+
+def copy_dataset_rerun(directory, size):
+    """ ids-copy-dataset again, onto a complete copy """
+    commands, setup = copy_dataset(directory, size)
+    return commands, commands
+
+
+def sync_users(directory, size):
+    """ ids-sync-users of the incf zone's users and groups """
+    load(directory, size, zone='incf', zones=2, collections=0, objects=0)
+    db = catalog.create_zone(local_zone, ['incf'])
+    catalog.add_user(db, 'rods', local_zone, 'rodsadmin')
+    db.commit()
+    db.close()
+    return [script('ids-sync-users')], []
+
+
+def search_meta(directory, size):
+    """ ids-search-meta across every zone """
+    load(directory, size)
+    return [script('ids-search-meta', 'species', '=', 'rat')], []
+
+
+def sync_peer_zones(directory, size):
+    """ ids-sync-peer-zones, with zones added, moved and removed """
+    load(directory, size, users=10, groups=2, collections=0, objects=0)
+    names = ['zone%03d' % (n,) for n in range(size['zones'] - 1)]
+    kept = names[:len(names) - len(names) / 4]
+    added = ['new%03d' % (n,) for n in range(len(names) / 4 + 1)]
+    db = catalog.create_zone('incf', [local_zone] + kept + added)
+    db.execute("update zones set connection = 'moved.example.org:1247'"
+               " where name in (%s)" % (','.join('?' * len(kept[::3])),), kept[::3])
+    db.commit()
+    db.close()
+    return [script('ids-sync-peer-zones')], []
+
+
+def event_logger(directory, size):
+    """ ids-event-logger, one process per event """
+    log_dir = os.path.join(directory, 'audit')
+    os.mkdir(log_dir)
+    catalog.activate(directory, local_zone)
+    now = time.time()
+    commands = []
+    for n in range(size['events']):
+        commands.append(script('ids-event-logger', 'acPostProcForPut', str(now + n),
+                               'user%06d#incf' % (n % 100,),
+                               'target=/%s/projects/p0000/c%02d/file%07d.dat'
+                               % (local_zone, n % 10, n),
+                               'resource=demoResc', 'logdir=' + log_dir))
+    return commands, []
+
+
+def zone_api(directory, size):
+    """ zone API requests through the Flask application """
+    try:
+        import flask
+    except ImportError:
+        return None, 'flask is not installed'
+    load(directory, size, users=10, groups=2, collections=0, objects=0)
+    command = [sys.executable, '-c',
+               'import sys; sys.path.insert(0, %r); import suite; '
+               'sys.exit(suite.zone_api_client(%d, %d))'
+               % (os.path.dirname(os.path.abspath(__file__)),
+                  size['requests'], size['zones'])]
+    return [command], []
+
+
+def zone_api_client(requests, zones):
+    """
+    Makes 'requests' authenticated requests of the zone API,
+    alternating between the zone list and single zones. Returns
+    the number of requests that failed.
+    """
+    import base64
+    from ids.api_1_0 import service
+
+    client = service.test_client()
+    headers = {'Authorization': 'Basic ' + base64.b64encode('user000000:user000000')}
+    failures = 0
+    for n in range(requests):
+        if n % 2:
+            url = '/api/v1.0/zone/zone%03d' % (n % max(zones - 1, 1),)
+        else:
+            url = '/api/v1.0/zones'
+        if client.get(url, headers=headers).status_code != 200:
+            failures += 1
+    return failures
+
+
+cases = [
+    ('copy_dataset', copy_dataset),
+    ('copy_dataset_sharded', copy_dataset_sharded),
+    ('copy_dataset_pipelined', copy_dataset_pipelined),
+    ('copy_dataset_rerun', copy_dataset_rerun),
+    ('sync_users', sync_users),
+    ('search_meta', search_meta),
+    ('sync_peer_zones', sync_peer_zones),
+    ('event_logger', event_logger),
+    ('zone_api', zone_api),
+    ]
+
+# icommands that a case must not run at all
+forbidden = {
+    # the ACLs and AVUs are all in place already
+    'copy_dataset_rerun': ('ichmod', 'imeta'),
+    }
+
+
+
+def count_lines(path):
+    if not os.path.exists(path):
+        return 0
+    with open(path) as f:
+        return sum(1 for line in f)
+
+
+
+def peak_rss(pid):
+    """
+    Returns the peak RSS (in KB) of a running process so far,
+    or 0 if it can't be read. Unlike the ru_maxrss of a child,
+    this doesn't count the memory of the process that forked it.
+    """
+    try:
+        with open('/proc/%d/status' % (pid,)) as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except (IOError, ValueError):
+        pass
+    return 0
+
+
+
+def run_command(command, output):
+    """
+    Runs a command, with its output going to the file 'output'.
+    Returns its exit code and peak RSS (in KB).
+    """
+    with open(output, 'a') as out:
+        proc = subprocess.Popen(command, stdin=open(os.devnull), stdout=out,
+                                stderr=subprocess.STDOUT)
+        rss = 0
+        while proc.poll() is None:
+            rss = max(rss, peak_rss(proc.pid))
+            time.sleep(0.01)
+    return proc.returncode, rss
+
+
+
+def run_case(name, function, size_name, verbose=False):
+    """
+    Builds the federation for a case and runs its workflow.
+    Returns the result record.
+    """
+    result = {'case': name, 'size': size_name}
+    directory = tempfile.mkdtemp(prefix='ids-suite-')
+    environ = dict(os.environ)
+    try:
+        for variable in ('IDS_CACHE_FILE', 'IDS_TRACE_FILE', 'IDS_SLOW_CALL'):
+            os.environ.pop(variable, None)
+        catalog.activate(directory, local_zone)
+
+        commands, setup = function(directory, sizes[size_name])
+        if commands is None:
+            result['skipped'] = setup
+            return result
+        catalog.activate(directory, local_zone)
+
+        output = os.path.join(directory, 'output.log')
+        for command in setup:
+            run_command(command, output)
+
+        calls = os.path.join(directory, 'calls.log')
+        trips = os.path.join(directory, 'round_trips.log')
+        os.environ['IDS_STANDIN_CALL_LOG'] = calls
+        os.environ['IDS_STANDIN_ROUND_TRIP_LOG'] = trips
+
+        failures = 0
+        max_rss = 0
+        start = time.time()
+        for command in commands:
+            rc, rss = run_command(command, output)
+            failures += rc != 0
+            max_rss = max(max_rss, rss)
+        result['wall'] = round(time.time() - start, 3)
+        result['processes'] = count_lines(calls)
+        result['round_trips'] = count_lines(trips)
+        result['max_rss_kb'] = max_rss
+        result['failures'] = failures
+        if name in forbidden and os.path.exists(calls):
+            with open(calls) as f:
+                result['forbidden'] = sum(1 for line in f
+                                          if line.split()[0] in forbidden[name])
+
+        if verbose or failures:
+            with open(output) as f:
+                sys.stderr.write(f.read()[-4000:])
+    finally:
+        os.environ.clear()
+        os.environ.update(environ)
+        shutil.rmtree(directory)
+    return result
+
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compares results against the baseline results. Returns the
+    list of regressions, as messages: a metric more than
+    'tolerance' (a fraction) worse than its baseline, a workflow
+    that failed, or one that ran icommands it must not run.
+    """
+    previous = {}
+    for result in baseline.get('results', []):
+        previous[(result['case'], result['size'])] = result
+
+    regressions = []
+    for result in results:
+        if 'skipped' in result:
+            continue
+        if result['failures']:
+            regressions.append('%s/%s: %d commands failed'
+                               % (result['case'], result['size'], result['failures']))
+        if result.get('forbidden'):
+            regressions.append('%s/%s: ran %d of %s'
+                               % (result['case'], result['size'], result['forbidden'],
+                                  ', '.join(forbidden[result['case']])))
+        base = previous.get((result['case'], result['size']))
+        if not base or 'skipped' in base:
+            continue
+        for metric in metrics:
+            if result[metric] > base[metric] * (1 + tolerance) and result[metric] - base[metric] > 1:
+                regressions.append('%s/%s: %s %s, baseline %s'
+                                   % (result['case'], result['size'], metric,
+                                      result[metric], base[metric]))
+    return regressions
+
+
+
+def print_results(results, out=sys.stdout):
+    out.write('%-20s %-7s %9s %10s %12s %10s\n'
+              % ('case', 'size', 'wall s', 'processes', 'round trips', 'rss KB'))
+    for result in results:
+        if 'skipped' in result:
+            out.write('%-20s %-7s skipped: %s\n'
+                      % (result['case'], result['size'], result['skipped']))
+        else:
+            out.write('%-20s %-7s %9.2f %10d %12d %10d\n'
+                      % (result['case'], result['size'], result['wall'],
+                         result['processes'], result['round_trips'],
+                         result['max_rss_kb']))
+
+
+
+if __name__ == '__main__':
+
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--sizes', default='small',
+                      help='comma separated data sizes to run: %s (default small)'
+                      % (', '.join(sorted(sizes)),))
+    parser.add_option('--cases',
+                      help='comma separated cases to run (default all): %s'
+                      % (', '.join(name for name, function in cases),))
+    parser.add_option('--output', '-o',
+                      help='write the results as JSON to this file')
+    parser.add_option('--baseline', default=default_baseline,
+                      help='baseline results to compare with (default %default)')
+    parser.add_option('--save-baseline', action='store_true', default=False,
+                      help='store the results as the new baseline')
+    parser.add_option('--check', action='store_true', default=False,
+                      help='exit with status 1 if anything regressed')
+    parser.add_option('--tolerance', type='float', default=0.25,
+                      help='fraction a metric may exceed its baseline by (default %default)')
+    parser.add_option('--verbose', '-v', action='store_true', default=False,
+                      help='show the output of the workflows')
+    options, args = parser.parse_args()
+
+    size_names = options.sizes.split(',')
+    for size_name in size_names:
+        if size_name not in sizes:
+            parser.error('unknown size %s' % (size_name,))
+    selected = cases
+    if options.cases:
+        names = options.cases.split(',')
+        selected = [case for case in cases if case[0] in names]
+        if len(selected) != len(names):
+            parser.error('unknown cases: %s'
+                         % (', '.join(set(names) - set(case[0] for case in cases)),))
+
+    results = []
+    for size_name in size_names:
+        for name, function in selected:
+            sys.stderr.write('running %s (%s)\n' % (name, size_name))
+            results.append(run_case(name, function, size_name, options.verbose))
+
+    report = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+        'results': results,
+        }
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+    print_results(results)
+
+    regressions = []
+    if os.path.exists(options.baseline) and not options.save_baseline:
+        with open(options.baseline) as f:
+            regressions = compare(results, json.load(f), options.tolerance)
+        if regressions:
+            print('\nregressions against %s:' % (options.baseline,))
+            for message in regressions:
+                print('  %s' % (message,))
+        else:
+            print('\nno regressions against %s' % (options.baseline,))
+
+    if options.save_baseline:
+        with open(options.baseline, 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+        print('\nsaved the baseline to %s' % (options.baseline,))
+
+    if options.check and regressions:
+        sys.exit(1)
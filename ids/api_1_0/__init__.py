@@ -1,13 +1,57 @@
-from flask import Flask
+import time
+
+from flask import Flask, Response, url_for, request, g
 from flask.ext.restful import reqparse, abort, Api, Resource, fields, marshal
 from flask.ext.httpauth import HTTPBasicAuth
+from werkzeug.http import http_date, quote_etag
 
+from ids.genquery import to_datetime
 from ids.zones import get_zone_details, make_zone, modify_zone, remove_zone, check_zone_endpoint
 from ids.users import auth_irods_user
+from ids.api_1_0.authcache import AuthCache
+from ids.api_1_0.jobs import JobStore
+from ids.api_1_0.zonecache import ZoneCache
+from ids.api_1_0.metrics import RequestMetrics
 
 service = Flask(__name__)
 api = Api(service)
 auth = HTTPBasicAuth()
+auth_cache = AuthCache()
+jobs = JobStore()
+zone_cache = ZoneCache(get_zone_details)
+
+
+def cache_samples():
+    return [('ids_api_auth_cache_hits_total', (), auth_cache.hits),
+            ('ids_api_auth_cache_misses_total', (), auth_cache.misses),
+            ('ids_api_zone_cache_hits_total', (), zone_cache.hits),
+            ('ids_api_zone_cache_misses_total', (), zone_cache.misses)]
+
+metrics = RequestMetrics(cache_samples)
+
+
+@service.before_request
+def start_request():
+    g.request_start = time.time()
+    metrics.started()
+
+@service.after_request
+def count_request(response):
+    metrics.finished(request.endpoint or 'none', request.method, response.status_code,
+                     time.time() - g.request_start)
+    g.request_counted = True
+    return response
+
+@service.teardown_request
+def end_request(exception=None):
+    # requests that raised skip after_request
+    if getattr(g, 'request_start', None) and not getattr(g, 'request_counted', False):
+        metrics.finished(request.endpoint or 'none', request.method, 500,
+                         time.time() - g.request_start)
+
+@service.route('/metrics')
+def report_metrics():
+    return Response(metrics.report(), mimetype='text/plain; version=0.0.4')
 
 
 @auth.verify_password
@@ -15,7 +59,8 @@ def verify_password(username, password):
     if username == 'tester' and password == 'blah':
         return True
     else:
-        return auth_irods_user(username, password, scheme='password')
+        return auth_cache.verify(username, password,
+                                 lambda: auth_irods_user(username, password, scheme='password'))
 
 @auth.error_handler
 def unauthorized():
@@ -29,19 +74,42 @@ zone_fields = {
     'uri': fields.Url('zone_resource', absolute=True),
     }
 
+job_fields = {
+    'job_id': fields.String,
+    'zone_name': fields.String,
+    'endpoint': fields.String,
+    'status': fields.String,
+    'message': fields.String,
+    'created': fields.Float,
+    'updated': fields.Float,
+    }
+
+
+def conditional_response(zones, etag, make_data):
+    """
+    Returns a 304 response if the client has the zones with ETag
+    'etag' already, and the data from make_data() otherwise.
+    """
+    headers = {'ETag': quote_etag(etag), 'Cache-Control': 'no-cache'}
+    times = [to_datetime(zone['modification_time']) for zone in zones
+             if zone['modification_time']]
+    if times:
+        headers['Last-Modified'] = http_date(max(times))
+    if request.if_none_match.contains_weak(etag):
+        return '', 304, headers
+    return make_data(), 200, headers
+
 
 # list of zone resources
 class ZoneListAPI(Resource):
 
     @auth.login_required
     def get(self):
-        zone_list = get_zone_details()
+        (zone_list, etag) = zone_cache.get()
         if zone_list is None:
             abort(500, message="Server failed to retrieve zone information")
-        zones = []
-        for zone in zone_list:
-            zones.append(marshal(zone, zone_fields))
-        return zones
+        return conditional_response(zone_list, etag,
+                                    lambda: [marshal(zone, zone_fields) for zone in zone_list])
 
 
 # single zone resources
@@ -71,8 +139,13 @@ class ZoneAPI(Resource):
 
     @auth.login_required
     def get(self, zone_name):
-        zone = lookup_zone(zone_name)
-        return marshal(zone, zone_fields)
+        found = zone_cache.lookup(zone_name)
+        if found is None:
+            abort(500, message="Server failed to retrieve zone information from iRODS")
+        (zone, etag) = found
+        if zone is None:
+            abort(404, message="Zone %s does not exist" % zone_name)
+        return conditional_response([zone], etag, lambda: marshal(zone, zone_fields))
 
 
     @auth.login_required
@@ -90,6 +163,7 @@ class ZoneAPI(Resource):
         if remove_zone(zone_name):
             abort(500, message="Server error when removing zone %s" % zone_name)
         else:
+            zone_cache.invalidate()
             return '', 204
 
 
@@ -102,29 +176,69 @@ class ZoneAPI(Resource):
             abort(403, message="Zone %s is local, and cannot be managed" % zone_name)
 
         args = self.reqparse.parse_args()
-        (success, reason) = check_zone_endpoint(zone_name, args['endpoint'])
-        if not success:
-            abort(400, message='problem with endpoint: %s' % reason)
-
-        if zone:
-            # updating an existing zone
-            # only allow the zone creator to make changes
-            if zone['comment'] != 'creator=%s' % auth.username():
-                abort(403, message="Zone can only be updated by the zone creator")
-                
-            newzone = modify_zone(zone_name, args['endpoint'])
-            if newzone:
-                return marshal(newzone, zone_fields), 200
-            else:
-                abort(500, message="Server error when modifying zone %s" % zone_name)
-        else:
-            # creating a new zone
-            comment = 'creator=%s' % auth.username()
-            newzone = make_zone(zone_name, args['endpoint'], comment)
-            if newzone:
-                return marshal(newzone, zone_fields), 201
-            else:
-                abort(500, message="Server error when creating zone %s" % zone_name)
+        if args['endpoint'].count(':') != 1:
+            abort(400, message='problem with endpoint: malformed endpoint. Should be host:port')
+
+        # only allow the zone creator to make changes
+        if zone and zone['comment'] != 'creator=%s' % auth.username():
+            abort(403, message="Zone can only be updated by the zone creator")
+
+        # one registration of a zone at a time. The endpoint check
+        # and the iadmin calls can take a while, so they're done in
+        # the background
+        (job, submitted) = jobs.submit_unless_pending(zone_name, args['endpoint'], auth.username(),
+                                                      'modify' if zone else 'create', register_zone)
+        if job is None:
+            abort(500, message="Server error when registering zone %s" % zone_name)
+        if not submitted and (job['endpoint'] != args['endpoint']
+                              or job['creator'] != auth.username()):
+            abort(409, message="Zone %s is already being registered" % zone_name)
+
+        status = job_status(job)
+        return status, 202, {'Location': status['uri']}
+
+
+def register_zone(job):
+    """
+    Checks the endpoint of a job's zone, and creates or modifies
+    the zone. Returns (success, message, zone).
+    """
+    (success, reason) = check_zone_endpoint(job['zone_name'], job['endpoint'])
+    if not success:
+        return (False, 'problem with endpoint: %s' % reason, None)
+
+    if job['action'] == 'modify':
+        newzone = modify_zone(job['zone_name'], job['endpoint'])
+        if not newzone:
+            return (False, "Server error when modifying zone %s" % job['zone_name'], None)
+    else:
+        comment = 'creator=%s' % job['creator']
+        newzone = make_zone(job['zone_name'], job['endpoint'], comment)
+        if not newzone:
+            return (False, "Server error when creating zone %s" % job['zone_name'], None)
+    zone_cache.invalidate()
+    return (True, None, newzone)
+
+
+# zone registration job resources
+
+def job_status(job):
+    status = marshal(job, job_fields)
+    status['uri'] = url_for('job_resource', job_id=job['job_id'], _external=True)
+    if job['zone']:
+        status['zone'] = marshal(job['zone'], zone_fields)
+    return status
+
+
+class JobAPI(Resource):
+
+    @auth.login_required
+    def get(self, job_id):
+        job = jobs.get(job_id)
+        # only the user who asked for it can see a job
+        if job is None or job['creator'] != auth.username():
+            abort(404, message="Job %s does not exist" % job_id)
+        return job_status(job)
 
 
 # API routing
@@ -134,3 +248,6 @@ api.add_resource(ZoneListAPI,
 api.add_resource(ZoneAPI,
                  '/api/v1.0/zone/<string:zone_name>',
                  endpoint='zone_resource')
+api.add_resource(JobAPI,
+                 '/api/v1.0/job/<string:job_id>',
+                 endpoint='job_resource')
@@ -0,0 +1,100 @@
+"""
+A cache of the zone API's credential checks, so that repeated
+requests from the same client don't each run iinit (a full
+authentication round trip to iRODS).
+
+Credentials are kept only as a salted hash (HMAC-SHA256 with a
+random per-process key). Successful checks are remembered for
+$IDS_API_AUTH_TTL seconds (default 300), and failed ones for
+$IDS_API_AUTH_NEGATIVE_TTL seconds (default 10), which makes
+retrying the same bad password cheap for us and useless for an
+attacker. At most $IDS_API_AUTH_CACHE_SIZE entries (default 1000)
+are kept, dropping the least recently used.
+"""
+
+import os
+import hmac
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+
+def _setting(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+
+class AuthCache(object):
+    """
+    Remembers whether (username, password) pairs authenticated.
+    Safe to use from several threads.
+    """
+
+    def __init__(self, ttl=None, negative_ttl=None, max_entries=None):
+        self.ttl = ttl if ttl is not None else _setting('IDS_API_AUTH_TTL', 300)
+        self.negative_ttl = (negative_ttl if negative_ttl is not None
+                             else _setting('IDS_API_AUTH_NEGATIVE_TTL', 10))
+        self.max_entries = int(max_entries if max_entries is not None
+                               else _setting('IDS_API_AUTH_CACHE_SIZE', 1000))
+        self.hits = 0
+        self.misses = 0
+        self._key = os.urandom(32)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def _hash(self, username, password):
+        return hmac.new(self._key, '%s\0%s' % (username, password),
+                        hashlib.sha256).digest()
+
+
+    def lookup(self, username, password):
+        """
+        Returns True or False if the credentials were checked
+        recently, and None if they have to be checked.
+        """
+        key = self._hash(username, password)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[1] <= time.time():
+                self.misses += 1
+                return None
+            # most recently used go last
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+
+    def store(self, username, password, authenticated):
+        ttl = self.ttl if authenticated else self.negative_ttl
+        if ttl <= 0:
+            return
+        key = self._hash(username, password)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (authenticated, time.time() + ttl)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+    def verify(self, username, password, authenticate):
+        """
+        Returns whether the credentials are good, calling
+        authenticate() (which returns True or False) only if
+        they're not in the cache.
+        """
+        authenticated = self.lookup(username, password)
+        if authenticated is None:
+            authenticated = bool(authenticate())
+            self.store(username, password, authenticated)
+        return authenticated
+
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
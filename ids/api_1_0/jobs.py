@@ -0,0 +1,264 @@
+"""
+Zone registration jobs. Checking a new zone's endpoint can take
+as long as a TCP connect timeout, and creating or modifying the
+zone takes several iadmin calls, so the zone API does them on a
+pool of background threads ($IDS_API_JOB_WORKERS, default 4)
+instead of in the request, and clients poll the job for the
+outcome.
+
+Jobs are kept as JSON files in $IDS_API_JOB_DIR (by default
+~/.irods/ids-zone-api/jobs), so that every worker process of the
+API can answer for them. The directory is made private to the
+API's user, and not used if it belongs to someone else, since
+the jobs in it are trusted. Finished
+jobs are removed after $IDS_API_JOB_TTL seconds (default a day).
+A zone has only one job at a time: the check for a job in progress
+and the submission of a new one are made under a lock file for the
+zone in the same directory.
+"""
+
+import os
+import re
+import json
+import time
+import uuid
+import fcntl
+import errno
+import hashlib
+import tempfile
+import threading
+
+from ids.utils import Executor, private_directory
+
+
+# the states of a job
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_SUCCEEDED = 'succeeded'
+JOB_FAILED = 'failed'
+
+_job_id_pattern = re.compile('^[0-9a-f]{32}$')
+
+
+
+def _setting(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+
+class JobStore(object):
+    """
+    Runs zone registration jobs in the background and keeps
+    their status. A job is a dict with
+
+      job_id, zone_name, endpoint, creator, action ('create' or
+      'modify'), status, message, zone (the zone's details once
+      it's done), created and updated (Unix times), and pid (the
+      process running it).
+    """
+
+    def __init__(self, directory=None, workers=None, ttl=None):
+        self.directory = directory or os.environ.get(
+            'IDS_API_JOB_DIR', os.path.expanduser('~/.irods/ids-zone-api/jobs'))
+        self.workers = int(workers if workers is not None
+                           else _setting('IDS_API_JOB_WORKERS', 4))
+        self.ttl = ttl if ttl is not None else _setting('IDS_API_JOB_TTL', 86400)
+        self._executor = None
+        self._lock = threading.Lock()
+        self._checked = False
+
+
+    def _check_directory(self):
+        """
+        Creates the job directory, or checks that it's private to
+        this user. Raises OSError if it isn't.
+        """
+        if not self._checked:
+            private_directory(self.directory)
+            self._checked = True
+
+
+    def _path(self, job_id):
+        return os.path.join(self.directory, '%s.json' % (job_id,))
+
+
+    def _save(self, job):
+        job['updated'] = time.time()
+        (fd, temp_path) = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(job, f)
+        os.rename(temp_path, self._path(job['job_id']))
+
+
+    def _lock_zone(self, zone_name):
+        """
+        Takes an exclusive lock on 'zone_name' across every process
+        of the API, and returns the file descriptor holding it;
+        closing it releases the lock. The kernel releases it too if
+        the process dies, so a lock is never left behind.
+        """
+        self._check_directory()
+        name = hashlib.sha1(zone_name.encode('utf-8')).hexdigest()
+        fd = os.open(os.path.join(self.directory, '%s.lock' % (name,)),
+                     os.O_CREAT | os.O_RDWR, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        except (IOError, OSError):
+            os.close(fd)
+            raise
+        return fd
+
+
+    def _load(self, job_id):
+        try:
+            with open(self._path(job_id)) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+
+    def submit(self, zone_name, endpoint, creator, action, work):
+        """
+        Queues work(job), which returns (success, message, zone),
+        as a new job. Returns the job, or None if it couldn't be
+        recorded.
+        """
+        job = {'job_id': uuid.uuid4().hex,
+               'zone_name': zone_name,
+               'endpoint': endpoint,
+               'creator': creator,
+               'action': action,
+               'status': JOB_QUEUED,
+               'message': None,
+               'zone': None,
+               'created': time.time(),
+               'pid': os.getpid()}
+        try:
+            self._check_directory()
+            self._save(job)
+        except (IOError, OSError) as e:
+            print('Error recording a zone registration job in %s: %s' % (self.directory, e))
+            return None
+        self.expire()
+
+        with self._lock:
+            if self._executor is None:
+                self._executor = Executor(workers=self.workers)
+        self._executor.submit(self._run, job, work)
+        return job
+
+
+    def submit_unless_pending(self, zone_name, endpoint, creator, action, work):
+        """
+        Queues work(job) as submit() does, unless 'zone_name'
+        already has a job that isn't done. The check and the
+        submission are made under the zone's lock, so concurrent
+        requests for a zone get a single job between them.
+
+        Returns (job, True) for a new job, (job, False) for the
+        zone's pending one, or (None, False) on error.
+        """
+        try:
+            fd = self._lock_zone(zone_name)
+        except (IOError, OSError) as e:
+            print('Error locking zone %s in %s: %s' % (zone_name, self.directory, e))
+            return (None, False)
+        try:
+            job = self.pending(zone_name)
+            if job:
+                return (job, False)
+            job = self.submit(zone_name, endpoint, creator, action, work)
+            return (job, job is not None)
+        finally:
+            os.close(fd)
+
+
+    def _run(self, job, work):
+        try:
+            job['status'] = JOB_RUNNING
+            self._save(job)
+            (success, message, zone) = work(job)
+        except Exception as e:
+            (success, message, zone) = (False, 'Server error: %s' % (e,), None)
+        job['status'] = JOB_SUCCEEDED if success else JOB_FAILED
+        job['message'] = message
+        job['zone'] = zone
+        try:
+            self._save(job)
+        except (IOError, OSError, TypeError, ValueError) as e:
+            print('Error recording zone registration job %s: %s' % (job['job_id'], e))
+
+
+    def get(self, job_id):
+        """
+        Returns the job 'job_id', or None if there's no such job.
+        """
+        if not _job_id_pattern.match(job_id or ''):
+            return None
+        try:
+            self._check_directory()
+        except OSError as e:
+            print('Not reading zone registration jobs from %s: %s' % (self.directory, e))
+            return None
+        job = self._load(job_id)
+        if job and job['status'] in (JOB_QUEUED, JOB_RUNNING) and not _process_alive(job['pid']):
+            job['status'] = JOB_FAILED
+            job['message'] = 'The server stopped before the job was done'
+        return job
+
+
+    def pending(self, zone_name):
+        """
+        Returns a job for 'zone_name' that isn't done yet, or
+        None if there isn't one.
+        """
+        try:
+            self._check_directory()
+            names = os.listdir(self.directory)
+        except OSError:
+            return None
+        for name in names:
+            if not name.endswith('.json'):
+                continue
+            job = self.get(name[:-len('.json')])
+            if (job and job['zone_name'] == zone_name
+                and job['status'] in (JOB_QUEUED, JOB_RUNNING)):
+                return job
+        return None
+
+
+    def expire(self):
+        """
+        Removes the jobs that finished more than 'ttl' seconds ago.
+        """
+        cutoff = time.time() - self.ttl
+        try:
+            self._check_directory()
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in names:
+            if name.endswith('.lock'):
+                # another process may be waiting on it
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.getmtime(path) >= cutoff:
+                    continue
+                job = self.get(name[:-len('.json')]) if name.endswith('.json') else None
+                if job is None or job['status'] in (JOB_SUCCEEDED, JOB_FAILED):
+                    os.remove(path)
+            except OSError:
+                pass
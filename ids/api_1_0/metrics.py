@@ -0,0 +1,243 @@
+"""
+Runtime metrics of the zone API, served at /metrics in the
+Prometheus text format:
+
+ - ids_api_requests_total and ids_api_request_duration_seconds,
+   by resource, method (and status, for the count),
+ - ids_api_requests_in_flight,
+ - the hits and misses of the credential and zone caches,
+ - ids_irods_commands_total, ids_irods_command_errors_total and
+   ids_irods_command_duration_seconds, by command, from the
+   ids.profiling registry.
+
+Each process counts its own requests. When $IDS_API_METRICS_DIR
+is set (ids-zone-api sets it when it runs several worker
+processes), each process also keeps a copy of its metrics there,
+at most 'interval' seconds old, and /metrics adds up those of all
+the live processes, whichever one answers the scrape.
+"""
+
+import os
+import json
+import time
+import errno
+import tempfile
+import threading
+from collections import OrderedDict
+
+from ids import profiling
+from ids.profiling import histogram_buckets
+
+
+# name -> (type, help), in the order they're shown
+families = [
+    ('ids_api_requests_total', 'counter',
+     'Requests handled, by resource, method and status.'),
+    ('ids_api_request_duration_seconds', 'histogram',
+     'Time taken to handle requests, by resource and method.'),
+    ('ids_api_requests_in_flight', 'gauge',
+     'Requests being handled.'),
+    ('ids_api_auth_cache_hits_total', 'counter',
+     'Credential checks answered from the cache.'),
+    ('ids_api_auth_cache_misses_total', 'counter',
+     'Credential checks that had to authenticate to iRODS.'),
+    ('ids_api_zone_cache_hits_total', 'counter',
+     'Zone lookups answered from the cache.'),
+    ('ids_api_zone_cache_misses_total', 'counter',
+     'Zone lookups that had to query iRODS.'),
+    ('ids_irods_commands_total', 'counter',
+     'iRODS commands and queries run, by command.'),
+    ('ids_irods_command_errors_total', 'counter',
+     'iRODS commands and queries that failed, by command.'),
+    ('ids_irods_command_duration_seconds', 'histogram',
+     'Time taken by iRODS commands and queries, by command.'),
+    ]
+
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+
+def histogram_samples(name, labels, buckets, total, count):
+    """
+    Returns the samples of a histogram with the cumulative
+    'buckets' counts (for histogram_buckets), as (name, labels,
+    value) tuples.
+    """
+    samples = []
+    for bound, bucket in zip(histogram_buckets, buckets):
+        samples.append((name + '_bucket', labels + (('le', repr(bound)),), bucket))
+    samples.append((name + '_bucket', labels + (('le', '+Inf'),), count))
+    samples.append((name + '_sum', labels, total))
+    samples.append((name + '_count', labels, count))
+    return samples
+
+
+
+def command_samples():
+    """
+    Returns the samples for the iRODS commands run so far.
+    """
+    samples = []
+    for command, (count, errors, total, buckets) in sorted(profiling.snapshot().items()):
+        labels = (('command', command),)
+        samples.append(('ids_irods_commands_total', labels, count))
+        samples.append(('ids_irods_command_errors_total', labels, errors))
+        samples.extend(histogram_samples('ids_irods_command_duration_seconds',
+                                         labels, buckets, total, count))
+    return samples
+
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+
+def render(samples):
+    """
+    Returns the samples, (name, labels, value) tuples, in the
+    Prometheus text format. Samples with the same name and labels
+    are added up.
+    """
+    values = OrderedDict()
+    for name, labels, value in samples:
+        key = (name, tuple(tuple(label) for label in labels))
+        values[key] = values.get(key, 0) + value
+
+    lines = []
+    for family, kind, help in families:
+        if kind == 'histogram':
+            names = (family + '_bucket', family + '_sum', family + '_count')
+        else:
+            names = (family,)
+        lines.append('# HELP %s %s' % (family, help))
+        lines.append('# TYPE %s %s' % (family, kind))
+        for (name, labels), value in values.items():
+            if name not in names:
+                continue
+            if labels:
+                name = '%s{%s}' % (name, ','.join('%s="%s"' % (label, _escape(str(text)))
+                                                  for (label, text) in labels))
+            lines.append('%s %s' % (name, repr(float(value))))
+    return '\n'.join(lines) + '\n'
+
+
+
+class RequestMetrics(object):
+    """
+    Counts the requests handled by this process. collect(), if
+    given, returns more samples of the process (such as its cache
+    counters). Safe to use from several threads.
+    """
+
+    def __init__(self, collect=None, directory=None, interval=1.0):
+        self.collect = collect
+        self.directory = directory or os.environ.get('IDS_API_METRICS_DIR')
+        self.interval = interval
+        self.in_flight = 0
+        self.requests = {}
+        self.durations = {}
+        self._saved = 0
+        self._lock = threading.Lock()
+
+
+    def started(self):
+        with self._lock:
+            self.in_flight += 1
+
+
+    def finished(self, resource, method, status, seconds):
+        with self._lock:
+            self.in_flight -= 1
+            key = (resource, method, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            key = (resource, method)
+            if key not in self.durations:
+                self.durations[key] = [[0] * len(histogram_buckets), 0.0, 0]
+            histogram = self.durations[key]
+            for i, bound in enumerate(histogram_buckets):
+                if seconds <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+        if self.directory and time.time() - self._saved >= self.interval:
+            self.save()
+
+
+    def samples(self):
+        """
+        Returns the samples of this process: its requests, the
+        iRODS commands it ran and those from collect().
+        """
+        samples = [('ids_api_requests_in_flight', (), self.in_flight)]
+        with self._lock:
+            for (resource, method, status), count in self.requests.items():
+                samples.append(('ids_api_requests_total',
+                                (('resource', resource), ('method', method),
+                                 ('status', str(status))), count))
+            for (resource, method), (buckets, total, count) in self.durations.items():
+                samples.extend(histogram_samples('ids_api_request_duration_seconds',
+                                                 (('resource', resource), ('method', method)),
+                                                 buckets, total, count))
+        samples.extend(command_samples())
+        if self.collect:
+            samples.extend(self.collect())
+        return samples
+
+
+    def save(self):
+        """
+        Writes the samples of this process to the metrics
+        directory.
+        """
+        self._saved = time.time()
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            (fd, temp_path) = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.samples(), f)
+            os.rename(temp_path, os.path.join(self.directory, '%d.json' % (os.getpid(),)))
+        except (IOError, OSError) as e:
+            print('Error saving the API metrics in %s: %s' % (self.directory, e))
+
+
+    def report(self):
+        """
+        Returns the metrics in the Prometheus text format, of all
+        the processes sharing the metrics directory if there is
+        one, or of this process.
+        """
+        if not self.directory:
+            return render(self.samples())
+
+        self.save()
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return render(self.samples())
+        samples = []
+        for name in names:
+            path = os.path.join(self.directory, name)
+            if not name.endswith('.json'):
+                continue
+            pid = int(name[:-len('.json')])
+            if pid != os.getpid() and not _process_alive(pid):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            try:
+                with open(path) as f:
+                    samples.extend(json.load(f))
+            except (IOError, OSError, ValueError):
+                pass
+        return render(samples)
@@ -0,0 +1,208 @@
+"""
+Serving the zone API in production. 'application' is the WSGI
+entry point, for any WSGI server, for example:
+
+  gunicorn --workers 4 --threads 8 --timeout 60 ids.api_1_0.server:application
+
+serve() is a WSGI server of its own, for installations without
+one, and is what ids-zone-api runs. Requests are handled by a
+pool of threads in each of one or more worker processes, so a
+request waiting on iRODS (iinit, iquest, imiscsvrinfo) doesn't
+hold up the others:
+
+ - a client has 'request_timeout' seconds to send its request,
+   and every iRODS command run for a request is killed after
+   'request_timeout' seconds (see ids.utils.default_command_timeout),
+ - on SIGTERM or SIGINT the server stops accepting connections,
+   and exits once the requests in progress are done, or after
+   'shutdown_timeout' seconds.
+"""
+
+import os
+import sys
+import time
+import errno
+import select
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+
+from ids import utils
+from ids.utils import Executor
+
+
+
+def application(environ, start_response):
+    """
+    The WSGI entry point of the zone API.
+    """
+    from ids.api_1_0 import service
+    return service(environ, start_response)
+
+
+
+class RequestHandler(WSGIRequestHandler):
+
+    # seconds a client has to send its request (set by serve)
+    timeout = 60
+
+    def log_message(self, format, *args):
+        sys.stderr.write('%s [%d] %s - %s\n'
+                         % (time.strftime('%Y-%m-%d %H:%M:%S'), os.getpid(),
+                            self.client_address[0], format % args))
+
+
+
+class ThreadPoolWSGIServer(WSGIServer):
+    """
+    A WSGI server that handles each request on one of 'threads'
+    worker threads. When they are all busy, new connections wait
+    in the listen queue.
+    """
+
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, server_address, handler_class, threads=8,
+                 bind_and_activate=True):
+        WSGIServer.__init__(self, server_address, handler_class, bind_and_activate)
+        self.executor = Executor(workers=threads)
+        self.slots = threading.Semaphore(threads)
+        self.active = 0
+        self.idle = threading.Condition()
+
+
+    def process_request(self, request, client_address):
+        self.slots.acquire()
+        with self.idle:
+            self.active += 1
+        self.executor.submit(self._handle, request, client_address)
+
+
+    def _handle(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            with self.idle:
+                self.active -= 1
+                self.idle.notify_all()
+            self.slots.release()
+
+
+    def wait_idle(self, timeout):
+        """
+        Waits up to 'timeout' seconds for the requests in progress
+        to finish. Returns the number still in progress.
+        """
+        deadline = time.time() + timeout
+        with self.idle:
+            while self.active and time.time() < deadline:
+                self.idle.wait(deadline - time.time())
+            return self.active
+
+
+
+def _serve_worker(server, shutdown_timeout):
+    """
+    Runs a server until SIGTERM or SIGINT, then lets the requests
+    in progress finish.
+    """
+    def stop(signum, frame):
+        # shutdown() waits for serve_forever() to return, so it
+        # can't be called from the thread running it
+        threading.Thread(target=server.shutdown).start()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while True:
+        try:
+            server.serve_forever()
+            break
+        except (OSError, IOError, socket.error, select.error) as e:
+            # a signal interrupting select()
+            if e.args[0] != errno.EINTR:
+                raise
+
+    remaining = server.wait_idle(shutdown_timeout)
+    if remaining:
+        sys.stderr.write('ids-zone-api: exiting with %d requests in progress\n'
+                         % (remaining,))
+    server.server_close()
+
+
+
+def serve(app=None, host='0.0.0.0', port=5000, processes=1, threads=8,
+          request_timeout=60, shutdown_timeout=30):
+    """
+    Serves 'app' (the zone API by default) on host:port with
+    'processes' worker processes of 'threads' threads each,
+    until SIGTERM or SIGINT. Returns 0 when done.
+    """
+    app = app or application
+    utils.default_command_timeout = request_timeout
+
+    class Handler(RequestHandler):
+        timeout = request_timeout
+
+    server = ThreadPoolWSGIServer((host, port), Handler, threads)
+    server.set_app(app)
+    sys.stderr.write('ids-zone-api: serving on %s:%d with %d processes of %d threads\n'
+                     % (host, server.server_port, processes, threads))
+
+    if processes <= 1:
+        _serve_worker(server, shutdown_timeout)
+        return 0
+
+    # worker processes share the listening socket; this one just
+    # looks after them, replacing any that die. They add up their
+    # metrics in a directory of their own (see ids.api_1_0.metrics)
+    metrics_dir = None
+    if 'IDS_API_METRICS_DIR' not in os.environ:
+        metrics_dir = tempfile.mkdtemp(prefix='ids-zone-api-metrics-')
+        os.environ['IDS_API_METRICS_DIR'] = metrics_dir
+    workers = set()
+    stopping = []
+
+    def start_worker():
+        pid = os.fork()
+        if pid == 0:
+            try:
+                _serve_worker(server, shutdown_timeout)
+            finally:
+                os._exit(0)
+        workers.add(pid)
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for n in range(processes):
+        start_worker()
+    while workers:
+        try:
+            pid, status = os.wait()
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            break
+        workers.discard(pid)
+        if not stopping:
+            sys.stderr.write('ids-zone-api: worker %d exited, starting another\n' % (pid,))
+            start_worker()
+
+    server.server_close()
+    if metrics_dir:
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+    return 0
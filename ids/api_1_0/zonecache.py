@@ -0,0 +1,138 @@
+"""
+A cache of the zone details for the zone API. The federation's
+zone list changes a few times a month, but clients poll it, and
+each request used to run iquest for it.
+
+The zones are reloaded every $IDS_API_ZONE_TTL seconds (default
+60), and as soon as the API itself changes a zone: invalidate()
+touches a stamp file ($IDS_API_ZONE_STAMP, by default
+~/.irods/ids-zone-api/zones.stamp), so the caches of all the
+API's worker processes see the change. The stamp file's directory
+is made private to the API's user, and the stamp isn't used if
+the directory belongs to someone else.
+
+Each load gets an ETag, a hash of the zones' names, endpoints,
+comments and modify times (ZONE_MODIFY_TIME), for conditional
+GETs.
+"""
+
+import os
+import time
+import hashlib
+import threading
+
+from ids.utils import private_directory
+
+
+
+def _setting(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+
+def zone_etag(zones):
+    """
+    Returns the ETag of a list of zones: it changes whenever a
+    zone is added, removed or modified.
+    """
+    digest = hashlib.sha1()
+    for zone in sorted(zones, key=lambda zone: zone['zone_name']):
+        digest.update(repr((zone['zone_name'], zone['type'], zone['connection'],
+                            zone['comment'], zone['modification_time'])))
+    return digest.hexdigest()
+
+
+
+class ZoneCache(object):
+    """
+    Holds the list of zones returned by load() (None on error),
+    reloading it when it's older than 'ttl' seconds or has been
+    invalidated. Safe to use from several threads.
+    """
+
+    def __init__(self, load, ttl=None, stamp_file=None):
+        self.load = load
+        self.ttl = ttl if ttl is not None else _setting('IDS_API_ZONE_TTL', 60)
+        self.stamp_file = stamp_file or os.environ.get(
+            'IDS_API_ZONE_STAMP', os.path.expanduser('~/.irods/ids-zone-api/zones.stamp'))
+        self.hits = 0
+        self.misses = 0
+        self._zones = None
+        self._etag = None
+        self._loaded = 0
+        self._lock = threading.Lock()
+        self._checked = False
+
+
+    def _check_directory(self):
+        """
+        Creates the stamp file's directory, or checks that it's
+        private to this user. Raises OSError if it isn't.
+        """
+        if not self._checked:
+            private_directory(os.path.dirname(os.path.abspath(self.stamp_file)))
+            self._checked = True
+
+
+    def _stamp(self):
+        try:
+            self._check_directory()
+            return os.path.getmtime(self.stamp_file)
+        except OSError:
+            return 0
+
+
+    def get(self):
+        """
+        Returns (zones, etag), or (None, None) if the zones
+        couldn't be loaded.
+        """
+        with self._lock:
+            now = time.time()
+            if (self._zones is not None and now - self._loaded < self.ttl
+                and self._stamp() < self._loaded):
+                self.hits += 1
+                return (self._zones, self._etag)
+
+            self.misses += 1
+            zones = self.load()
+            if zones is None:
+                return (None, None)
+            self._zones = zones
+            self._etag = zone_etag(zones)
+            self._loaded = now
+            return (self._zones, self._etag)
+
+
+    def lookup(self, zone_name):
+        """
+        Returns (zone, etag) for the zone 'zone_name', (None, None)
+        if there's no such zone, or None if the zones couldn't be
+        loaded.
+        """
+        (zones, etag) = self.get()
+        if zones is None:
+            return None
+        for zone in zones:
+            if zone['zone_name'] == zone_name:
+                return (zone, zone_etag([zone]))
+        return (None, None)
+
+
+    def invalidate(self):
+        """
+        Drops the zones, here and in the other processes sharing
+        the stamp file.
+        """
+        with self._lock:
+            self._zones = None
+        try:
+            self._check_directory()
+            with open(self.stamp_file, 'a'):
+                pass
+            os.utime(self.stamp_file, None)
+        except (IOError, OSError) as e:
+            print('Error updating the zone cache stamp %s: %s' % (self.stamp_file, e))
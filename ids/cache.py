@@ -0,0 +1,194 @@
+"""
+An optional on-disk cache for catalog information that changes
+slowly: the local zone name, the zone list and details, resource
+details and user id maps. The cache is shared between runs of the
+ids commands, so a cron job doesn't have to query the catalog for
+the same things every time it starts.
+
+The cache is off unless $IDS_CACHE_FILE names the file to keep it
+in (~/.irods/ids-cache.db, say), or set_cache_file() is called.
+Each entry expires after its own time-to-live, and the least
+recently used entries are dropped once there are more than
+max_entries of them. The ids functions that change the catalog
+invalidate the entries they make stale.
+"""
+
+import os
+import time
+import sqlite3
+import cPickle as pickle
+
+
+
+# how long (in seconds) each kind of entry is kept
+ttls = {
+    'local_zone': 86400,
+    'zones': 300,
+    'resources': 900,
+    'user_ids': 300,
+    }
+
+max_entries = 1000
+
+
+# the cache file, if not taken from the environment
+_cache_file = None
+
+# when set, cached() always loads the values, but entries
+# are still invalidated
+_bypass = False
+
+_schema = """
+create table if not exists cache (
+    key text primary key, value blob, expires real, used real);
+create index if not exists cache_used on cache (used);
+"""
+
+
+
+def set_cache_file(path):
+    """
+    Sets the file to keep the cache in, overriding $IDS_CACHE_FILE.
+    An empty string turns the cache off. Returns the previous
+    setting.
+    """
+    global _cache_file
+
+    previous = _cache_file
+    _cache_file = path
+    return previous
+
+
+
+def bypass_cache(bypass=True):
+    """
+    Stops (or restarts) using the cached values. Changes to the
+    catalog still invalidate the cache entries while it's bypassed.
+    """
+    global _bypass
+
+    _bypass = bypass
+
+
+
+def get_cache_file():
+    """
+    Returns the path of the cache file, or None if the cache
+    is off.
+    """
+    if _cache_file is not None:
+        path = _cache_file
+    else:
+        path = os.environ.get('IDS_CACHE_FILE')
+    if not path:
+        return None
+    return os.path.expanduser(path)
+
+
+
+def _scope():
+    """
+    The settings that pick the iRODS server and user, as a
+    prefix for the cache keys, so that different environments
+    sharing a cache file don't see each other's entries.
+    """
+    return '|'.join([os.environ.get(name, '') for name in
+                     ('IRODS_ENVIRONMENT_FILE', 'irodsHost', 'irodsPort',
+                      'irodsZone', 'irodsUserName')]) + '|'
+
+
+
+def _connect():
+    path = get_cache_file()
+    if not path:
+        return None
+    db = sqlite3.connect(path, timeout=10)
+    db.executescript(_schema)
+    return db
+
+
+
+def cached(kind, key, load, refresh=False):
+    """
+    Returns the cached value for 'key' (within the 'kind' of
+    entry, one of those in ttls), calling 'load' to get the
+    value if there's no live entry for it, or if 'refresh' is
+    set. Values of None (an error) and '' (not found) aren't
+    cached.
+
+    Any problem with the cache file is treated as a cache
+    miss; the cache never makes an ids function fail.
+    """
+    if _bypass:
+        return load()
+
+    try:
+        db = _connect()
+    except sqlite3.Error:
+        db = None
+    if db is None:
+        return load()
+
+    cache_key = '%s%s:%s' % (_scope(), kind, key)
+    now = time.time()
+    try:
+        row = None
+        if not refresh:
+            row = db.execute('select value from cache where key = ? and expires > ?',
+                             (cache_key, now)).fetchone()
+        if row:
+            db.execute('update cache set used = ? where key = ?', (now, cache_key))
+            db.commit()
+            db.close()
+            return pickle.loads(str(row[0]))
+    except (sqlite3.Error, pickle.UnpicklingError):
+        pass
+
+    value = load()
+    if value is None or value == '':
+        db.close()
+        return value
+
+    try:
+        db.execute('insert or replace into cache values (?, ?, ?, ?)',
+                   (cache_key, sqlite3.Binary(pickle.dumps(value, 2)),
+                    now + ttls[kind], now))
+        db.execute('delete from cache where expires <= ?', (now,))
+        db.execute('delete from cache where key not in '
+                   '(select key from cache order by used desc limit ?)',
+                   (max_entries,))
+        db.commit()
+    except sqlite3.Error:
+        pass
+    db.close()
+
+    return value
+
+
+
+def invalidate(*kinds):
+    """
+    Drops the cached entries of the given kinds (or all the
+    entries if no kinds are given), for all environments.
+    """
+    try:
+        db = _connect()
+        if db is None:
+            return
+        if not kinds:
+            db.execute('delete from cache')
+        for kind in kinds:
+            db.execute("delete from cache where key like ? escape '\\'",
+                       ('%%|%s:%%' % (kind.replace('_', '\\_'),),))
+        db.commit()
+        db.close()
+    except sqlite3.Error:
+        pass
+
+
+
+def flush_cache():
+    """
+    Empties the cache.
+    """
+    invalidate()
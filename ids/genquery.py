@@ -0,0 +1,211 @@
+"""
+A builder for iRODS GenQuery strings, and a parser that returns
+query results as compact, typed records. All the ids modules
+build their catalog queries with this, rather than formatting
+query strings and splitting iquest output by hand.
+
+  query = GenQuery('COLL_NAME', 'count(DATA_NAME)')
+  query.where('COLL_NAME', 'like', '/zone/home/%')
+  for row in query.rows():
+      print row.coll_name, row.count_data_name
+
+Rows are namedtuples with one field per selected column, named
+after the column in lower case (with the function prepended for
+columns like 'count(DATA_NAME)'). Values are converted by column:
+counts and sizes are ints, *_TIME columns are datetimes (UTC), and
+everything else is left as a string. rows(convert=False) leaves
+them all as the strings iquest returns.
+"""
+
+import re
+import datetime
+from collections import namedtuple
+
+from ids.utils import iquest_rows, parse_genquery
+
+
+
+class GenQuery(object):
+    """
+    A GenQuery, built from the selected columns (either column
+    names, or GenQuery functions such as 'order(ZONE_NAME)' or
+    'count(DATA_ID)') and conditions added with where() and
+    where_any().
+    """
+
+    def __init__(self, *columns):
+        self.selects = []
+        self.conditions = []
+        for column in columns:
+            selects = parse_genquery('select %s' % (column,))[0]
+            if len(selects) != 1:
+                raise ValueError('bad column: %s' % (column,))
+            self.selects.append(selects[0])
+
+
+    def where(self, column, op, value):
+        """
+        Adds the condition "column op 'value'". Conditions are
+        joined with 'and'. Returns the query, so calls can be
+        chained.
+        """
+        return self.where_any(column, [(op, value)])
+
+
+    def where_any(self, column, alternatives):
+        """
+        Adds a condition on 'column' that matches any of the
+        (op, value) pairs in 'alternatives' (joined with '||'
+        in the query). Returns the query.
+        """
+        for op, value in alternatives:
+            if "'" in str(value):
+                # GenQuery has no way to quote a single quote
+                raise ValueError("GenQuery values can't contain \"'\": %s" % (value,))
+        self.conditions.append((column, [(op, str(value)) for op, value in alternatives]))
+        return self
+
+
+    def string(self):
+        """
+        Returns the query in the iquest GenQuery syntax.
+        """
+        selects = []
+        for func, column in self.selects:
+            if func:
+                selects.append('%s(%s)' % (func, column))
+            else:
+                selects.append(column)
+        query = 'select %s' % (', '.join(selects),)
+
+        conditions = []
+        for column, alternatives in self.conditions:
+            conditions.append('%s %s' % (column, ' || '.join(["%s '%s'" % alt
+                                                              for alt in alternatives])))
+        if conditions:
+            query += ' where ' + ' and '.join(conditions)
+        return query
+
+    __str__ = string
+
+
+    def record_type(self):
+        """
+        Returns the namedtuple class used for rows of this query.
+        """
+        return record_type(self.selects)
+
+
+    def rows(self, zone=None, verbose=False, timeout=None, convert=True):
+        """
+        Runs the query (in 'zone' if provided) and yields the
+        result rows as typed records (or records of strings, if
+        'convert' is False). Rows are streamed from the catalog
+        page by page (see ids.utils.iquest_rows). The query is
+        abandoned after 'timeout' seconds, if given.
+
+        Raises ids.utils.IquestError if the query fails.
+        """
+        return parse_rows(iquest_rows(self.string(), zone, verbose, timeout),
+                          self.selects, convert)
+
+
+    def first(self, zone=None, verbose=False, timeout=None):
+        """
+        Runs the query and returns the first row, or None if
+        there were no results.
+
+        Raises ids.utils.IquestError if the query fails.
+        """
+        for row in self.rows(zone, verbose, timeout):
+            return row
+        return None
+
+
+
+def parse_rows(rows, selects, convert=True):
+    """
+    Converts rows of strings (as returned by iquest_rows) for a
+    query with the given (function, column) selects into typed
+    records, or records of the strings if 'convert' is False.
+    Yields the records.
+    """
+    record = record_type(selects)
+    converters = column_converters(selects) if convert else []
+    if not any(converters):
+        # nothing to convert, the fast path
+        make = record._make
+        for row in rows:
+            yield make(row)
+    else:
+        converters = [conv or str for conv in converters]
+        for row in rows:
+            yield record._make([conv(value) for conv, value in zip(converters, row)])
+
+
+
+_record_types = {}
+
+def record_type(selects):
+    """
+    Returns the namedtuple class for rows with the given
+    (function, column) selects. Classes are shared between
+    queries that select the same columns.
+    """
+    key = tuple(selects)
+    if key not in _record_types:
+        fields = []
+        for func, column in selects:
+            if func and func not in ('order', 'order_desc'):
+                fields.append('%s_%s' % (func, column.lower()))
+            else:
+                fields.append(column.lower())
+        _record_types[key] = namedtuple('Row', fields)
+    return _record_types[key]
+
+
+
+def column_converters(selects):
+    """
+    Returns the list of value converters for the selected
+    columns, with None where the string value is kept.
+    """
+    converters = []
+    for func, column in selects:
+        if func == 'count':
+            converters.append(to_int)
+        elif func == 'avg':
+            converters.append(to_float)
+        elif _int_column_regex.search(column):
+            converters.append(to_int)
+        elif column.endswith('_TIME'):
+            converters.append(to_datetime)
+        else:
+            converters.append(None)
+    return converters
+
+
+_int_column_regex = re.compile(r'_(SIZE|REPL_NUM|COUNT)$')
+
+
+
+def to_int(value):
+    if not value:
+        return None
+    return int(value)
+
+
+def to_float(value):
+    if not value:
+        return None
+    return float(value)
+
+
+def to_datetime(value):
+    """
+    iRODS stores times as zero padded seconds since the epoch
+    """
+    if not value:
+        return None
+    return datetime.datetime.utcfromtimestamp(int(value))
+
@@ -0,0 +1,175 @@
+"""
+A checkpoint of a dataset copy (see ids-copy-dataset), so that a
+copy that stopped partway (a network failure, an expired ticket)
+can be resumed without starting over. The manifest is an sqlite
+file recording
+
+ - the phases of the copy that are done (the harvest of the ACLs
+   and AVUs, the policy AVUs, the transfer, the ACLs and the AVUs),
+ - the results of the harvest, so it isn't run again,
+ - the parts of the transfer (see ids.transfer) and which of them
+   have been copied,
+ - the sub-collections whose ACLs have been set, and how many of
+   the AVUs have been added.
+
+Everything is committed as soon as it's recorded.
+"""
+
+import os
+import hashlib
+import sqlite3
+import threading
+import cPickle as pickle
+
+
+_schema = """
+create table if not exists meta (key text primary key, value text);
+create table if not exists phases (name text primary key);
+create table if not exists data (key text primary key, value blob);
+create table if not exists parts (
+    id integer primary key, shard integer, part blob, done integer default 0);
+create table if not exists applied (
+    kind text, path text, primary key (kind, path));
+"""
+
+
+
+def default_manifest_path(source, destination):
+    """
+    Returns the manifest file used for copying 'source' to
+    'destination' when none is given.
+    """
+    digest = hashlib.sha1('%s\0%s' % (source, destination)).hexdigest()[:16]
+    return os.path.expanduser('~/.irods/ids-copy-dataset-%s.manifest' % (digest,))
+
+
+
+class CopyManifest(object):
+    """
+    The manifest of the copy of 'source' to 'destination', kept
+    in the file 'path'. Unless 'resume' is set, what the file
+    recorded before is dropped. Safe to use from several threads.
+
+    Raises ValueError when resuming from a manifest of another
+    copy, and sqlite3.Error if the file can't be used.
+    """
+
+    def __init__(self, path, source, destination, resume=False):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._db.executescript(_schema)
+
+        recorded = dict(self._db.execute('select key, value from meta'))
+        if resume and recorded:
+            if (recorded.get('source'), recorded.get('destination')) != (source, destination):
+                raise ValueError('%s is the manifest of copying %s to %s'
+                                 % (path, recorded.get('source'), recorded.get('destination')))
+        else:
+            for table in ('meta', 'phases', 'data', 'parts', 'applied'):
+                self._db.execute('delete from %s' % (table,))
+            self._db.executemany('insert into meta values (?, ?)',
+                                 [('source', source), ('destination', destination)])
+            self._db.commit()
+        self.resumed = bool(resume and recorded)
+
+
+    def _execute(self, sql, args=()):
+        with self._lock:
+            self._db.execute(sql, args)
+            self._db.commit()
+
+
+    def _query(self, sql, args=()):
+        with self._lock:
+            return self._db.execute(sql, args).fetchall()
+
+
+    def done(self, phase):
+        """ Returns whether 'phase' is done. """
+        return bool(self._query('select 1 from phases where name = ?', (phase,)))
+
+
+    def finish(self, phase):
+        """ Records that 'phase' is done. """
+        self._execute('insert or replace into phases values (?)', (phase,))
+
+
+    def save(self, key, value):
+        """ Keeps 'value' (anything that can be pickled) as 'key'. """
+        self._execute('insert or replace into data values (?, ?)',
+                      (key, sqlite3.Binary(pickle.dumps(value, 2))))
+
+
+    def load(self, key):
+        """ Returns the value kept as 'key', or None. """
+        rows = self._query('select value from data where key = ?', (key,))
+        if not rows:
+            return None
+        return pickle.loads(str(rows[0][0]))
+
+
+    def set_shards(self, shards):
+        """
+        Records the shards of the transfer (lists of parts, see
+        ids.transfer.plan_shards), giving each part an 'id'.
+        """
+        with self._lock:
+            self._db.execute('delete from parts')
+            for n, shard in enumerate(shards):
+                for part in shard:
+                    cursor = self._db.execute('insert into parts (shard, part) values (?, ?)',
+                                              (n, sqlite3.Binary(pickle.dumps(part, 2))))
+                    part['id'] = cursor.lastrowid
+            self._db.commit()
+
+
+    def shards(self, pending=True):
+        """
+        Returns the recorded shards, with only the parts not
+        copied yet if 'pending' is set, or None if there are none.
+        """
+        rows = self._query('select id, shard, part, done from parts order by id')
+        if not rows:
+            return None
+        shards = {}
+        for part_id, shard, part, done in rows:
+            shards.setdefault(shard, [])
+            if pending and done:
+                continue
+            part = pickle.loads(str(part))
+            part['id'] = part_id
+            shards[shard].append(part)
+        return [shards[n] for n in sorted(shards)]
+
+
+    def part_done(self, part):
+        """ Records that a part of the transfer was copied. """
+        self._execute('update parts set done = 1 where id = ?', (part['id'],))
+
+
+    def applied(self, kind):
+        """ Returns the set of paths recorded as done for 'kind'. """
+        return set(path for (path,) in
+                   self._query('select path from applied where kind = ?', (kind,)))
+
+
+    def mark_applied(self, kind, paths):
+        """ Records the paths as done for 'kind' (such as 'avus'). """
+        with self._lock:
+            self._db.executemany('insert or replace into applied values (?, ?)',
+                                 [(kind, path) for path in paths])
+            self._db.commit()
+
+
+    def remove(self):
+        """ Deletes the manifest, once the copy is complete. """
+        with self._lock:
+            self._db.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
@@ -0,0 +1,424 @@
+"""
+A compact store for the ACLs and AVUs harvested from a collection
+(see ids-copy-dataset). A dataset of a million data objects, kept
+as dicts of path -> list of lists, takes gigabytes; here
+
+ - every attribute name, value, unit, user name and access is kept
+   once, in a string table, and referred to by number,
+ - every path is kept as its parent's number and its last part
+   (in a list, and as the key of a (parent, last part) -> number
+   dict to look it up), and full paths are only made when read,
+ - an AVU whose value is its own path (such as the policy AVU
+   idsadm:primaryCopyLocation, see PATH) refers to the path by
+   number, rather than adding the path to the string table,
+ - the AVUs and ACLs are rows of numbers in arrays, one per column.
+
+Above a memory budget ($IDS_META_MEMORY_MB megabytes, default
+1024) the AVU and ACL rows are moved to an sqlite file, and the
+rows added after that go there too. The budget counts an estimate
+of the string and path tables as well, but those stay in memory:
+the string table holds each distinct value once, and a path takes
+about _path_bytes more than its last part. Either way, the rows
+are read back as a stream, in the order they were added, or
+grouped by the sub-collection of the store's collection they're
+in. Once the store is filled, several threads can read it by
+sub-collection at once.
+
+  store = MetaStore('/zone/home/dataset')
+  store.add_avu('/zone/home/dataset/a/file.dat', False, 'attr', 'value', '')
+  for path, kind, attr, value, units in store.avus():
+      ...
+"""
+
+import os
+import sqlite3
+import tempfile
+import threading
+from array import array
+from itertools import izip
+
+
+# rows added between checks of the memory used
+_check_interval = 10000
+
+# rows written to the spill file at a time
+_flush_size = 10000
+
+# rough sizes (in bytes) of the entries, besides their strings,
+# for the memory estimate: a path is a list entry, a dict entry,
+# its (parent, last part) key and number (int objects), and array
+# items
+_path_bytes = 260
+_string_bytes = 60
+
+# the value of an AVU that is the path it's on
+PATH = object()
+
+
+
+def _setting(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+
+class MetaStore(object):
+    """
+    The ACLs and AVUs of the collection 'root' and everything
+    below it. 'memory_budget' is in bytes; the rows are spilled
+    to 'spill_path' (a temporary file by default) above it.
+    """
+
+    def __init__(self, root, memory_budget=None, spill_path=None):
+        self.root = root.rstrip('/')
+        if memory_budget is None:
+            memory_budget = _setting('IDS_META_MEMORY_MB', 1024) * 1024 * 1024
+        self.memory_budget = memory_budget
+        self.spill_path = spill_path
+
+        self.strings = []
+        self._string_ids = {}
+        self._string_size = 0
+
+        # the paths: parent id (-1 for the root, whose last part
+        # is its whole path), last part, and the top id (the
+        # sub-collection of the root it's in, or the root)
+        self.parents = array('l')
+        self.leaves = []
+        self._tops = array('l')
+        self.is_coll = array('b')
+        self._children = {}
+        self._path_size = 0
+        # the last collection looked up, as rows tend to come
+        # collection by collection
+        self._last = (None, None)
+
+        # path, top, attr, value, units
+        self._avus = tuple(array('l') for n in range(5))
+        # path, top, user, access
+        self._acls = tuple(array('l') for n in range(4))
+        self.avu_count = 0
+        self.acl_count = 0
+
+        self._db = None
+        self._pending = {'avus': [], 'acls': []}
+        self._top_rows = {}
+        self._since_check = 0
+        self._lock = threading.Lock()
+        self._add_path(-1, self.root, True)
+
+
+    # strings and paths
+
+    def string_id(self, string):
+        """ Returns the number of 'string' in the string table. """
+        try:
+            return self._string_ids[string]
+        except KeyError:
+            n = self._string_ids[string] = len(self.strings)
+            self.strings.append(string)
+            self._string_size += len(string) + _string_bytes
+            return n
+
+
+    def path_id(self, path, collection):
+        """
+        Returns the number of the collection (if 'collection' is
+        set) or data object at 'path', adding it if need be.
+        Raises ValueError if 'path' isn't in the root collection.
+        """
+        if collection and path == self.root:
+            return 0
+        if not path.startswith(self.root + '/'):
+            raise ValueError('%s is not in %s' % (path, self.root))
+
+        (parent_path, leaf) = path.rsplit('/', 1)
+        if self._last[0] == parent_path:
+            parent = self._last[1]
+        else:
+            parent = self.path_id(parent_path, True)
+            self._last = (parent_path, parent)
+        try:
+            return self._children[(parent, leaf)]
+        except KeyError:
+            n = self._children[(parent, leaf)] = self._add_path(parent, leaf, collection)
+            return n
+
+
+    def find_path(self, path, collection):
+        """
+        Returns the number of a path if it's in the store, or None.
+        """
+        if path == self.root:
+            return 0 if collection else None
+        if not path.startswith(self.root + '/'):
+            return None
+        n = 0
+        for leaf in path[len(self.root) + 1:].split('/'):
+            n = self._children.get((n, leaf))
+            if n is None:
+                return None
+        return n if bool(self.is_coll[n]) == bool(collection) else None
+
+
+    def _add_path(self, parent, leaf, collection):
+        n = len(self.leaves)
+        self.parents.append(parent)
+        self.leaves.append(leaf)
+        self.is_coll.append(1 if collection else 0)
+        self._path_size += len(leaf) + _path_bytes
+        if parent == -1 or self.parents[parent] == -1:
+            # the root, what's directly in it, and its
+            # sub-collections are their own tops
+            self._tops.append(n if collection else max(parent, 0))
+        else:
+            self._tops.append(self._tops[parent])
+        return n
+
+
+    def top_of(self, path, collection):
+        """
+        Returns the number of the top of a path (see top()), or
+        None if the path isn't in the store.
+        """
+        n = self.find_path(path, collection)
+        return None if n is None else self._tops[n]
+
+
+    def path(self, n):
+        """ Returns the path numbered 'n'. """
+        leaves = []
+        while n != -1:
+            leaves.append(self.leaves[n])
+            n = self.parents[n]
+        return '/'.join(reversed(leaves))
+
+
+    def paths(self):
+        """
+        Yields (number, path, collection) for each path in the
+        store.
+        """
+        for n in range(len(self.leaves)):
+            yield (n, self.path(n), bool(self.is_coll[n]))
+
+
+    def top(self, n):
+        """
+        Returns the path of the top of path 'n': the sub-collection
+        of the root it's in, or the root for the root itself and
+        the data objects directly in it.
+        """
+        return self.path(self._tops[n])
+
+
+    # adding rows
+
+    def add_avu(self, path, collection, attr, value, units):
+        """
+        Adds an AVU of 'path'. A 'value' of PATH is the path itself.
+        """
+        n = self.path_id(path, collection)
+        # paths as values are numbered from -1 down
+        value = -1 - n if value is PATH else self.string_id(value)
+        row = (n, self._tops[n], self.string_id(attr), value,
+               self.string_id(units or ''))
+        self._add('avus', self._avus, row)
+        self.avu_count += 1
+
+
+    def add_acl(self, path, collection, user, access):
+        n = self.path_id(path, collection)
+        row = (n, self._tops[n], self.string_id(user), self.string_id(access))
+        self._add('acls', self._acls, row)
+        self.acl_count += 1
+
+
+    def has_avu(self, attr):
+        """
+        Returns the set of the numbers of the paths that have an
+        AVU with the attribute 'attr'.
+        """
+        if attr not in self._string_ids:
+            return set()
+        attr = self._string_ids[attr]
+        return set(row[0] for row in self._rows('avus', self._avus) if row[2] == attr)
+
+
+    def _add(self, table, columns, row):
+        if self._db is not None:
+            self._pending[table].append(row)
+            if len(self._pending[table]) >= _flush_size:
+                self._flush(table)
+            return
+        for column, value in zip(columns, row):
+            column.append(value)
+        self._top_rows.pop(table, None)
+        self._since_check += 1
+        if self._since_check >= _check_interval:
+            self._since_check = 0
+            if self.memory_used() > self.memory_budget:
+                self.spill()
+
+
+    def memory_used(self):
+        """ Returns an estimate of the memory used, in bytes. """
+        return (self._string_size + self._path_size
+                + sum(len(column) * column.itemsize
+                      for column in self._avus + self._acls))
+
+
+    # the spill file
+
+    def spilled(self):
+        """ Returns whether the rows are in the spill file. """
+        return self._db is not None
+
+
+    def _connect(self):
+        if self.spill_path is None:
+            (fd, self.spill_path) = tempfile.mkstemp(prefix='ids-metastore-', suffix='.db')
+            os.close(fd)
+        self._db = sqlite3.connect(self.spill_path, check_same_thread=False)
+        self._db.executescript("""
+            create table if not exists avus (
+                path integer, top integer, attr integer, value integer, units integer);
+            create table if not exists acls (
+                path integer, top integer, user integer, access integer);
+            create index if not exists avus_top on avus (top);
+            create index if not exists acls_top on acls (top);
+            """)
+
+
+    def spill(self):
+        """
+        Moves the AVU and ACL rows to the spill file, where the
+        rows added from now on will go too.
+        """
+        if self._db is not None:
+            return
+        self._connect()
+        for table, columns in (('avus', self._avus), ('acls', self._acls)):
+            # left from an earlier spill to the same file
+            self._db.execute('delete from %s' % (table,))
+            self._pending[table] = zip(*columns)
+            self._flush(table)
+            for column in columns:
+                del column[:]
+        self._top_rows = {}
+
+
+    def _flush(self, table):
+        rows = self._pending[table]
+        if rows:
+            self._db.executemany('insert into %s values (%s)'
+                                 % (table, ', '.join('?' * len(rows[0]))), rows)
+            self._db.commit()
+        self._pending[table] = []
+
+
+    def _rows(self, table, columns, top=None):
+        with self._lock:
+            if self._db is None:
+                if top is None:
+                    return izip(*columns)
+                if table not in self._top_rows:
+                    # the rows of each top, by number
+                    index = {}
+                    for i, row_top in enumerate(columns[1]):
+                        index.setdefault(row_top, array('l')).append(i)
+                    self._top_rows[table] = index
+                return (tuple(column[i] for column in columns)
+                        for i in self._top_rows[table].get(top, ()))
+            self._flush(table)
+            if top is None:
+                return self._db.execute('select * from %s order by rowid' % (table,))
+            # read at once, as other threads share the connection
+            return self._db.execute('select * from %s where top = ? order by rowid'
+                                    % (table,), (top,)).fetchall()
+
+
+    # reading
+
+    def avus(self, top=None):
+        """
+        Yields the AVUs as (path, kind ('-C' or '-d'), attr, value,
+        units), in the order they were added; only those under the
+        top 'top' (see tops()) if given.
+        """
+        strings = self.strings
+        for n, row_top, attr, value, units in self._rows('avus', self._avus, top):
+            yield (self.path(n), '-C' if self.is_coll[n] else '-d', strings[attr],
+                   strings[value] if value >= 0 else self.path(-1 - value),
+                   strings[units])
+
+
+    def acls(self, top=None):
+        """
+        Yields the ACLs as (path, user, access), in the order they
+        were added; only those under the top 'top' if given.
+        """
+        strings = self.strings
+        for n, row_top, user, access in self._rows('acls', self._acls, top):
+            yield (self.path(n), strings[user], strings[access])
+
+
+    def tops(self):
+        """
+        Returns the numbers of the tops: the root, and the
+        sub-collections directly in it.
+        """
+        return [n for n in range(len(self.parents))
+                if self.is_coll[n] and (self.parents[n] == -1
+                                        or self.parents[self.parents[n]] == -1)]
+
+
+    def close(self):
+        """ Removes the spill file, if any. """
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+            try:
+                os.remove(self.spill_path)
+            except OSError:
+                pass
+
+
+    # pickling, for the copy manifest (see ids.manifest)
+
+    def __getstate__(self):
+        if self._db is not None:
+            for table in self._pending:
+                self._flush(table)
+        state = dict(self.__dict__)
+        del state['_lock']
+        # made again from the parents and leaves
+        del state['_children']
+        state['_db'] = self._db is not None
+        state['_top_rows'] = {}
+        for name in ('parents', '_tops', 'is_coll'):
+            state[name] = state[name].tostring()
+        state['_avus'] = [column.tostring() for column in self._avus]
+        state['_acls'] = [column.tostring() for column in self._acls]
+        return state
+
+
+    def __setstate__(self, state):
+        spilled = state.pop('_db')
+        for name, code in (('parents', 'l'), ('_tops', 'l'), ('is_coll', 'b')):
+            state[name] = array(code, state[name])
+        state['_avus'] = tuple(array('l', column) for column in state['_avus'])
+        state['_acls'] = tuple(array('l', column) for column in state['_acls'])
+        self.__dict__.update(state)
+        self._children = dict(((parent, leaf), n) for n, (parent, leaf)
+                              in enumerate(izip(self.parents, self.leaves)))
+        self._lock = threading.Lock()
+        self._db = None
+        if spilled:
+            self._connect()
+            # rows added to the file after the store was pickled
+            self._db.execute('delete from avus where rowid > ?', (self.avu_count,))
+            self._db.execute('delete from acls where rowid > ?', (self.acl_count,))
+            self._db.commit()
@@ -5,7 +5,8 @@ and data objects in ICAT that doesn't actually change bits on disk
 go in this module.
 """
 
-from ids.utils import run_iquest, shell_command
+from ids.utils import IquestError, CommandBatch, shell_command
+from ids.genquery import GenQuery
 from ids.users import irods_id_to_user
 
 
@@ -25,12 +26,13 @@ def irods_coll_exists(coll, verbose=False):
     if not coll:
         return -1
 
-    coll_query = "select count(COLL_NAME) where COLL_NAME = '%s'" % (coll,)
-    exists = run_iquest(coll_query, format='%s', verbose=verbose)
-    if exists == None:
+    coll_query = GenQuery('count(COLL_NAME)').where('COLL_NAME', '=', coll)
+    try:
+        row = coll_query.first(verbose=verbose)
+    except IquestError:
         return -1
 
-    return int(exists)
+    return row.count_coll_name if row else 0
 
 
 
@@ -49,12 +51,13 @@ def irods_obj_exists(obj, verbose=False):
     if not obj:
         return -1
 
-    obj_query = "select count(DATA_NAME) where DATA_NAME = '%s'" % (obj,)
-    exists = run_iquest(obj_query, format='%s', verbose=verbose)
-    if exists == None:
+    obj_query = GenQuery('count(DATA_NAME)').where('DATA_NAME', '=', obj)
+    try:
+        row = obj_query.first(verbose=verbose)
+    except IquestError:
         return -1
 
-    return int(exists)
+    return row.count_data_name if row else 0
 
 
 
@@ -72,21 +75,20 @@ def irods_coll_getacls(path, verbose=False):
 
     acl_list = []
     
-    acl_query = "select COLL_ACCESS_NAME, COLL_ACCESS_USER_ID where COLL_NAME = '%s'"
-
-    output = run_iquest(acl_query % (path,), format='%s:%s', verbose=verbose)
-    if output == None:
+    acl_query = GenQuery('COLL_ACCESS_NAME', 'COLL_ACCESS_USER_ID')
+    acl_query.where('COLL_NAME', '=', path)
+
+    try:
+        for access, user_id in acl_query.rows(verbose=verbose):
+            if access.startswith('read'):
+                access = 'read'
+            elif access.startswith('modify'):
+                access = 'write'
+            user_name = irods_id_to_user(user_id, verbose=verbose)
+            acl_list.append([user_name, access])
+    except IquestError:
         return None
 
-    for line in output.splitlines():
-        access, user_id = line.split(':')
-        if access.startswith('read'):
-            access = 'read'
-        elif access.startswith('modify'):
-            access = 'write'
-        user_name = irods_id_to_user(user_id, verbose=verbose)
-        acl_list.append([user_name, access])
-
     return acl_list
 
 
@@ -105,21 +107,20 @@ def irods_obj_getacls(path, verbose=False):
 
     acl_list = []
     
-    acl_query = "select DATA_ACCESS_NAME, DATA_ACCESS_USER_ID where DATA_NAME = '%s'"
-
-    output = run_iquest(acl_query % (path,), format='%s:%s', verbose=verbose)
-    if output == None:
+    acl_query = GenQuery('DATA_ACCESS_NAME', 'DATA_ACCESS_USER_ID')
+    acl_query.where('DATA_NAME', '=', path)
+
+    try:
+        for access, user_id in acl_query.rows(verbose=verbose):
+            if access.startswith('read'):
+                access = 'read'
+            elif access.startswith('modify'):
+                access = 'write'
+            user_name = irods_id_to_user(user_id, verbose=verbose)
+            acl_list.append([user_name, access])
+    except IquestError:
         return None
 
-    for line in output.splitlines():
-        access, user_id = line.split(':')
-        if access.startswith('read'):
-            access = 'read'
-        elif access.startswith('modify'):
-            access = 'write'
-        user_name = irods_id_to_user(user_id, verbose=verbose)
-        acl_list.append([user_name, access])
-
     return acl_list
 
 
@@ -165,19 +166,237 @@ def irods_setacls(path, acl_list, verbose=False):
     if not path or not acl_list:
         return 1
 
-    for acl in acl_list:
-        (rc, output) = shell_command(['ichmod', acl[1], acl[0], path])
-        if rc:
-            if verbose:
-                print("Error running 'ichmod %s %s %s': rc = %d:"
-                      % (acl[1], acl[0], path, rc))
-                print output[1]
-            return rc
+    failures = irods_bulk_setacls({path: acl_list}, scan=False, verbose=verbose)
+    if failures is None or failures:
+        return 1
 
     return 0
 
 
 
+def irods_tree_getacls(collection, zone=None, verbose=False):
+    """
+    This function returns the ACLs of a collection and
+    everything below it, with one query for the collections and
+    one for the data objects. The result is a tuple of two
+    dicts: the first is keyed by path, and holds a dict of
+    'user#zone' -> access (as used by ichmod) for each path; the
+    second maps each collection to the list of paths directly
+    within it.
+
+    Paths are found from their ACLs, and so every collection and
+    data object with an owner is included.
+
+    None is returned if an error occurred.
+    """
+    if not collection:
+        return None
+
+    acls = {}
+    children = {}
+    in_tree = [('=', collection), ('like', collection + '/%')]
+
+    coll_query = GenQuery('COLL_NAME', 'COLL_ACCESS_NAME', 'COLL_ACCESS_USER_ID')
+    coll_query.where_any('COLL_NAME', in_tree)
+    data_query = GenQuery('COLL_NAME', 'DATA_NAME', 'DATA_ACCESS_NAME',
+                          'DATA_ACCESS_USER_ID')
+    data_query.where_any('COLL_NAME', in_tree)
+
+    try:
+        for coll, access, user_id in coll_query.rows(zone, verbose):
+            if coll not in acls:
+                acls[coll] = {}
+                children.setdefault(coll, [])
+                if coll != collection:
+                    children.setdefault(coll.rsplit('/', 1)[0], []).append(coll)
+            user_name = irods_id_to_user(user_id, zone, verbose)
+            if user_name:
+                acls[coll][user_name] = _ichmod_access(access)
+
+        for coll, name, access, user_id in data_query.rows(zone, verbose):
+            obj = coll + '/' + name
+            if obj not in acls:
+                acls[obj] = {}
+                children.setdefault(coll, []).append(obj)
+            user_name = irods_id_to_user(user_id, zone, verbose)
+            if user_name:
+                acls[obj][user_name] = _ichmod_access(access)
+    except IquestError:
+        return None
+
+    return (acls, children)
+
+
+
+def irods_tree_getavus(collection, zone=None, verbose=False, recursive=True):
+    """
+    This function returns the AVUs of a collection and everything
+    below it (or only the data objects directly in it, if
+    'recursive' is False), with one query for the collections and
+    one for the data objects. The result is a dict keyed by path,
+    holding a set of (attribute, value, units) for each path that
+    has AVUs.
+
+    None is returned if an error occurred.
+    """
+    if not collection:
+        return None
+
+    avus = {}
+    if recursive:
+        in_tree = [('=', collection), ('like', collection + '/%')]
+    else:
+        in_tree = [('=', collection)]
+
+    # '_' and '%' in the name are wildcards for 'like'
+    def inside(coll):
+        return coll == collection or (recursive and coll.startswith(collection + '/'))
+
+    coll_query = GenQuery('COLL_NAME', 'META_COLL_ATTR_NAME',
+                          'META_COLL_ATTR_VALUE', 'META_COLL_ATTR_UNITS')
+    coll_query.where_any('COLL_NAME', in_tree)
+    data_query = GenQuery('COLL_NAME', 'DATA_NAME', 'META_DATA_ATTR_NAME',
+                          'META_DATA_ATTR_VALUE', 'META_DATA_ATTR_UNITS')
+    data_query.where_any('COLL_NAME', in_tree)
+
+    try:
+        for coll, attr, value, units in coll_query.rows(zone, verbose):
+            if inside(coll):
+                avus.setdefault(coll, set()).add((attr, value, units))
+        for coll, name, attr, value, units in data_query.rows(zone, verbose):
+            if inside(coll):
+                avus.setdefault(coll + '/' + name, set()).add((attr, value, units))
+    except IquestError:
+        return None
+
+    return avus
+
+
+
+def _ichmod_access(access):
+    """ maps an ICAT access name to the ichmod one """
+    if access.startswith('read'):
+        return 'read'
+    elif access.startswith('modify'):
+        return 'write'
+    return access
+
+
+
+def irods_bulk_setacls(acl_dict, collection=None, zone=None, scan=True,
+                       verbose=False, paths_per_command=100):
+    """
+    This function sets the ACLs for a whole tree of collections
+    and data objects at once. 'acl_dict' is keyed by path, and
+    each value is an ACL list as for irods_setacls. 'collection'
+    is the top of the tree, and defaults to the longest collection
+    path common to all the paths.
+
+    The ACLs already in place (in 'zone' if provided) are read
+    first, and only the ones that differ are changed. Where every
+    item in a sub-collection is to end up with the same access
+    for a user, one 'ichmod -r' is run on the sub-collection.
+    The remaining changes are grouped by access and user, and run
+    with up to 'paths_per_command' paths per ichmod. If 'scan' is
+    False, the tree isn't read, and all the ACLs are set.
+
+    Returns a list of the ACLs that could not be set, as
+    (path, acl, error output) tuples, which is empty on success.
+    Returns None if there was nothing to do, or on error.
+    """
+
+    if not acl_dict:
+        return None
+
+    if not scan:
+        (current, children) = ({}, {})
+    elif not collection:
+        collection = acl_dict.keys()[0]
+        for path in acl_dict:
+            while path != collection and not path.startswith(collection + '/'):
+                collection = collection.rsplit('/', 1)[0]
+        if not collection:
+            return None
+
+    if scan:
+        tree = irods_tree_getacls(collection, zone, verbose)
+        if tree is None:
+            return None
+        (current, children) = tree
+
+    # the changes needed, as (access, user) -> set of paths,
+    # kept in the order they are first asked for
+    changes = {}
+    order = []
+    for path in acl_dict:
+        for user, access in acl_dict[path]:
+            if not scan or current.get(path, {}).get(user, 'null') != access:
+                if (access, user) not in changes:
+                    changes[(access, user)] = set()
+                    order.append((access, user))
+                changes[(access, user)].add(path)
+
+    commands = []
+    for access, user in order:
+        paths = changes[(access, user)]
+
+        def final(path):
+            for acl in acl_dict.get(path, ()):
+                if acl[0] == user:
+                    return acl[1]
+            return current.get(path, {}).get(user, 'null')
+
+        # find the sub-collections that end up uniform, deepest
+        # first, so each can use what's known about its children
+        uniform = {}
+        for coll in sorted(children, key=lambda c: -c.count('/')):
+            uniform[coll] = (final(coll) == access and
+                             all(uniform.get(child, final(child) == access)
+                                 for child in children[coll]))
+
+        # one 'ichmod -r' for each of the highest uniform
+        # sub-collections with more than one change below it
+        recursive = []
+        covered = set()
+        for coll in sorted(uniform, key=lambda c: c.count('/')):
+            if not uniform[coll] or coll in covered:
+                continue
+            below = [coll]
+            for path in below:
+                below.extend(children.get(path, ()))
+            covered.update(below)
+            if len(paths.intersection(below)) > 1:
+                recursive.append(coll)
+                paths = paths.difference(below)
+
+        for n in range(0, len(recursive), paths_per_command):
+            commands.append((['-r', access, user], recursive[n:n+paths_per_command]))
+        paths = sorted(paths)
+        for n in range(0, len(paths), paths_per_command):
+            commands.append(([access, user], paths[n:n+paths_per_command]))
+
+    failures = []
+    for args, paths in commands:
+        acl = [args[-1], args[-2]]
+        (rc, output) = shell_command(['ichmod'] + args + paths)
+        if rc and len(paths) > 1:
+            # find out which of the paths failed
+            for path in paths:
+                (rc, output) = shell_command(['ichmod'] + args + [path])
+                if rc:
+                    failures.append((path, acl, output[1]))
+        elif rc:
+            failures.append((paths[0], acl, output[1]))
+
+    if verbose:
+        for path, acl, output in failures:
+            print("Error running 'ichmod %s %s %s': %s"
+                  % (acl[1], acl[0], path, output.strip()))
+
+    return failures
+
+
+
 def irods_setavus(path, avu_list, verbose=False):
     """
     This function will add the AVUs listed in 'avu_list'
@@ -197,20 +416,58 @@ def irods_setavus(path, avu_list, verbose=False):
     if not path or not avu_list:
         return 1
 
-    for avu in avu_list:
-        imeta_cmd = ['imeta', 'add']
-        imeta_cmd.append(avu[0])     # type ... -d or -C
-        imeta_cmd.append(path)       # target collection or object
-        imeta_cmd.append(avu[1])     # attribute name
-        imeta_cmd.append(avu[2])     # attribute value
-        if avu[3]:
-            imeta_cmd.append(avu[3]) # units (if provided)
-        (rc, output) = shell_command(imeta_cmd)
-        if rc and 'Operation now in progress' not in output[1]:
-            if verbose:
-                print('Error running imeta add on %s: rc = %d:'
-                      % (path, rc))
-                print output[1]
-            return rc
+    failures = irods_bulk_setavus({path: avu_list}, verbose)
+    if failures is None or failures:
+        return 1
 
     return 0
+
+
+
+def irods_bulk_setavus(avu_dict, verbose=False, sessions=1, session_size=5000,
+                       current=None):
+    """
+    This function adds AVUs to many collections and data
+    objects at once. 'avu_dict' is keyed by path, and each
+    value is an AVU list as for irods_setavus. If 'current' (the
+    AVUs already in place, as returned by irods_tree_getavus) is
+    given, only the AVUs that aren't in it are added. An AVU
+    that turns out to be there already isn't an error either.
+
+    Rather than running imeta once per AVU, the additions are
+    sent through a few long-lived imeta sessions of up to
+    'session_size' additions each, 'sessions' of them at a time
+    (see ids.utils.CommandBatch).
+
+    Returns a list of the AVUs that could not be added, as
+    (path, avu, error output) tuples, which is empty on success.
+    Returns None if there was nothing to do.
+    """
+
+    if not avu_dict:
+        return None
+
+    batch = CommandBatch('imeta', sessions=sessions, session_size=session_size)
+    added = []
+    for path in avu_dict:
+        in_place = current.get(path, ()) if current else ()
+        for avu in avu_dict[path]:
+            if (avu[1], avu[2], avu[3] or '') in in_place:
+                continue
+            imeta_cmd = ['add', avu[0], path, avu[1], avu[2]]
+            if avu[3]:
+                imeta_cmd.append(avu[3]) # units (if provided)
+            added.append((path, avu, batch.add(*imeta_cmd)))
+
+    batch.run()
+
+    failures = []
+    for path, avu, command in added:
+        if (command.rc and 'Operation now in progress' not in command.output
+            and 'CATALOG_ALREADY_HAS_ITEM_BY_THAT_NAME' not in command.output):
+            if verbose:
+                print('Error running imeta add on %s: %s'
+                      % (path, command.output.strip()))
+            failures.append((path, avu, command.output))
+
+    return failures
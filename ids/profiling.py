@@ -0,0 +1,187 @@
+"""
+Instrumentation for the iRODS commands and queries run by the ids
+package. Every icommand run (through shell_command, the iquest query
+backends or a CommandBatch session) is recorded with its wall time,
+exit code, bytes of output, command name and query text:
+
+ - in an in-process registry, summarized by summary() and, with the
+   --profile option of the ids commands, printed when they exit,
+ - as a JSON line in the file named by $IDS_TRACE_FILE, if set,
+ - as a line on stderr, if it took longer than $IDS_SLOW_CALL
+   seconds (if set).
+"""
+
+import os
+import sys
+import time
+import json
+import atexit
+import threading
+from collections import deque
+
+
+
+# the upper bounds (in seconds) of the call time histograms
+histogram_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# the number of recent call times kept per command, for the
+# percentiles; a long-running process (the zone API) would
+# otherwise keep them all
+max_times = 100000
+
+
+
+class CallStats(object):
+    """
+    The calls recorded for one kind of command. buckets[i] is
+    the number of calls that took at most histogram_buckets[i]
+    seconds.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.errors = 0
+        self.bytes = 0
+        self.buckets = [0] * len(histogram_buckets)
+        self.times = deque(maxlen=max_times)
+
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.times.append(seconds)
+        for i, bound in enumerate(histogram_buckets):
+            if seconds <= bound:
+                self.buckets[i] += 1
+
+
+    def percentile(self, percent):
+        times = sorted(self.times)
+        if not times:
+            return 0.0
+        return times[min(len(times) - 1, int(len(times) * percent / 100.0))]
+
+
+
+# command name -> CallStats
+registry = {}
+
+_lock = threading.Lock()
+_trace = None
+
+
+
+def get_slow_call_threshold():
+    """
+    Returns the number of seconds above which a call is logged
+    as slow, or None.
+    """
+    try:
+        return float(os.environ['IDS_SLOW_CALL'])
+    except (KeyError, ValueError):
+        return None
+
+
+
+def record(command, seconds, rc=0, output_bytes=0, query=None):
+    """
+    Records a call of 'command' (such as 'iquest' or 'iadmin
+    mkuser') that took 'seconds', exited with 'rc' and produced
+    'output_bytes' of output. 'query' is the GenQuery text, for
+    queries.
+    """
+    global _trace
+
+    with _lock:
+        if command not in registry:
+            registry[command] = CallStats()
+        stats = registry[command]
+        stats.add(seconds)
+        stats.bytes += output_bytes
+        if rc:
+            stats.errors += 1
+
+        trace_file = os.environ.get('IDS_TRACE_FILE')
+        if trace_file:
+            try:
+                if _trace is None or _trace.name != trace_file:
+                    _trace = open(trace_file, 'a')
+                _trace.write(json.dumps({
+                    'time': time.time(), 'command': command,
+                    'seconds': round(seconds, 6), 'rc': rc,
+                    'bytes': output_bytes, 'query': query,
+                    }) + '\n')
+                _trace.flush()
+            except IOError:
+                pass
+
+    threshold = get_slow_call_threshold()
+    if threshold is not None and seconds > threshold:
+        sys.stderr.write('ids: slow call (%.2f s): %s\n' % (seconds, query or command))
+
+
+
+def command_name(command_list):
+    """
+    Returns the name calls of the command in 'command_list' are
+    recorded under: the program name, and the sub-command for
+    programs like iadmin.
+    """
+    name = os.path.basename(command_list[0])
+    if (name in ('iadmin', 'imeta') and len(command_list) > 1
+        and not command_list[1].startswith('-')):
+        name += ' ' + command_list[1]
+    return name
+
+
+
+def reset():
+    with _lock:
+        registry.clear()
+
+
+
+def snapshot():
+    """
+    Returns a dict of command name -> (calls, errors, total
+    seconds, histogram bucket counts), for the calls so far.
+    """
+    with _lock:
+        return dict((command, (stats.count, stats.errors, stats.total, list(stats.buckets)))
+                    for command, stats in registry.items())
+
+
+
+def summary():
+    """
+    Returns a table of the calls made so far, with the number
+    of calls and errors, the total, average and 95th percentile
+    times, and the bytes of output, per command.
+    """
+    lines = ['%-24s %7s %7s %10s %10s %10s %12s'
+             % ('command', 'calls', 'errors', 'total s', 'avg ms', 'p95 ms', 'bytes')]
+    with _lock:
+        for command in sorted(registry):
+            stats = registry[command]
+            lines.append('%-24s %7d %7d %10.3f %10.1f %10.1f %12d'
+                         % (command, stats.count, stats.errors, stats.total,
+                            stats.total * 1000 / stats.count,
+                            stats.percentile(95) * 1000, stats.bytes))
+    return '\n'.join(lines)
+
+
+
+def print_summary(out=None):
+    out = out or sys.stderr
+    out.write('\n%s\n' % (summary(),))
+    out.flush()
+
+
+
+def print_summary_at_exit():
+    """
+    Arranges for the summary to be printed (on stderr) when the
+    program exits. This is what the --profile option does.
+    """
+    atexit.register(print_summary)
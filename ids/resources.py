@@ -4,7 +4,9 @@ Includes functions for retrieving resource information as
 well as functions for creating and deleting resources.
 """
 
-from ids.utils import run_iquest, run_iadmin
+from ids.utils import IquestError, run_iadmin
+from ids.genquery import GenQuery
+from ids.cache import cached
 
 
 
@@ -16,13 +18,18 @@ def get_resource_list(verbose=False):
     Returns a list sorted by resource name, or None if
     some error occurred.
     """
+    return cached('resources', 'list', lambda: _get_resource_list(verbose))
 
-    output = run_iquest('select order(RESC_NAME)',
-                        format='%s', verbose=verbose)
-    if not output:
+
+
+def _get_resource_list(verbose=False):
+    query = GenQuery('order(RESC_NAME)')
+    try:
+        resources = [row.resc_name for row in query.rows(verbose=verbose)]
+    except IquestError:
         return None
 
-    return [resource.rstrip('\n') for resource in output.splitlines()]
+    return resources or None
 
 
 
@@ -36,49 +43,40 @@ def get_resource_details(resource_name=None, verbose=False):
     Returns a dict of dicts, where the key of the top-level
     dict is the resource name, and the sub-dict contains the
     resource details including: type, endpoint, comment,
-    and creation and modification timestamps. Will return
+    and creation and modification timestamps (as iquest
+    returns them; see ids.genquery.to_datetime). Will return
     None if some error occurred.
     """
+    return cached('resources', 'details:%s' % (resource_name or '',),
+                  lambda: _get_resource_details(resource_name, verbose))
+
 
-    sep = '~_~'
-    query_fields = [
-        'RESC_NAME',
-        'RESC_ZONE_NAME',
-        'RESC_TYPE_NAME',
-        'RESC_CLASS_NAME',
-        'RESC_LOC',
-        'RESC_VAULT_PATH',
-        'RESC_STATUS',
-        'RESC_INFO',
-        'RESC_COMMENT',
-        'RESC_CREATE_TIME',
-        'RESC_MODIFY_TIME',
-        ]
-    query_format = sep.join(['%s'] * len(query_fields))
-    
-    query = 'select %s' % (','.join(query_fields))
+
+def _get_resource_details(resource_name=None, verbose=False):
+    query = GenQuery('RESC_NAME', 'RESC_ZONE_NAME', 'RESC_TYPE_NAME',
+                     'RESC_CLASS_NAME', 'RESC_LOC', 'RESC_VAULT_PATH',
+                     'RESC_STATUS', 'RESC_INFO', 'RESC_COMMENT',
+                     'RESC_CREATE_TIME', 'RESC_MODIFY_TIME')
     if resource_name:
-        query = query + " where RESC_NAME = '%s'" % (resource_name,)
+        query.where('RESC_NAME', '=', resource_name)
 
-    output = run_iquest(query, format=query_format, verbose=verbose)
-    if not output:
+    resources = {}
+    try:
+        for row in query.rows(verbose=verbose, convert=False):
+            resource = {
+                'zone_name': row.resc_zone_name,
+                'type': row.resc_type_name,
+                'class': row.resc_class_name,
+                'server': row.resc_loc,
+                'vault_path': row.resc_vault_path,
+                'status': row.resc_status,
+                'info': row.resc_info,
+                'comment': row.resc_comment,
+                'create_time': row.resc_create_time,
+                'modification_time': row.resc_modify_time,
+                }
+            resources[row.resc_name] = resource
+    except IquestError:
         return None
 
-    resources = {}
-    for line in output.splitlines():
-        fields = line.split(sep)
-        resource = {
-            'zone_name': fields[1],
-            'type': fields[2],
-            'class': fields[3],
-            'server': fields[4],
-            'vault_path': fields[5],
-            'status': fields[6],
-            'info': fields[7],
-            'comment': fields[8],
-            'create_time': fields[9],
-            'modification_time': fields[10],
-            }
-        resources[fields[0]] = resource
-
-    return resources
+    return resources or None
@@ -0,0 +1,321 @@
+"""
+Copying collections between zones with irsync, either with one
+'irsync -r' of the whole collection, or sharded: the collection
+is split into parts (sub-collection trees, and batches of the
+data objects of the collections that had to be split), the parts
+are spread over a number of shards of about the same total size,
+and each shard is copied by its own worker, so several irsync
+processes run at once. A part that fails is retried on its own,
+without copying the rest again.
+
+  shards = plan_shards('/zoneA/home/dataset', 8)
+  failures = run_sharded_irsync('/zoneA/home/dataset',
+                                '/zoneB/home/dataset', shards,
+                                streams=4)
+"""
+
+import sys
+import time
+import heapq
+import threading
+from subprocess import Popen, PIPE, STDOUT
+
+from ids.utils import IquestError, Executor, shell_command
+from ids.genquery import GenQuery
+from ids.profiling import record
+
+
+# data objects per irsync of a batch of them, to keep the
+# command lines short
+batch_objects = 200
+
+# parts planned per shard, so the parts can be balanced
+parts_per_shard = 4
+
+_output_lock = threading.Lock()
+
+
+
+def _write(line):
+    with _output_lock:
+        sys.stdout.write(line + '\n')
+        sys.stdout.flush()
+
+
+
+def run_irsync(source, destination, verbose=False, streams=0, recursive=True,
+               label=None):
+    """
+    This function runs the iRODS irsync command on the
+    given source and destination. In this case, source
+    and destination are assumed to be iRODS collection
+    names, so the function will adjust the command
+    syntax appropriately. 'source' can also be a list of
+    data objects, to be copied into the destination
+    collection (without 'recursive').
+
+    This function will not return until
+    irsync has completed, and it will print all output
+    from irsync as it is read, tagged with 'label' if
+    given.
+
+    The verbose option will add the verbose flag (-v) to irsync.
+    'streams' is the number of parallel transfer streams irsync
+    may use for each data object (-N); 0 turns them off.
+
+    The function returns the exit code from irsync.
+    """
+
+    if not source or not destination:
+        return -1
+
+    irsync_cmd = ['irsync', '-N', str(streams)]
+    if recursive:
+        irsync_cmd.insert(1, '-r')
+
+    if verbose:
+        irsync_cmd.append('-v')
+
+    if isinstance(source, basestring):
+        source = [source]
+    irsync_cmd.extend(['i:' + path for path in source])
+    irsync_cmd.append('i:' + destination)
+
+    prefix = 'IRSYNC OUT: ' if label is None else 'IRSYNC OUT [%s]: ' % (label,)
+
+    start = time.time()
+    try:
+        irsync_proc = Popen(irsync_cmd, stdout=PIPE, stderr=STDOUT)
+    except OSError as e:
+        print('Error running %s: %s' % (' '.join(irsync_cmd), e.strerror))
+        return -1
+
+    output_bytes = 0
+    while irsync_proc.returncode == None:
+        line = irsync_proc.stdout.readline()
+        output_bytes += len(line)
+        line = line.rstrip('\n')
+        if line:
+            _write(prefix + line)
+        irsync_proc.poll()
+
+    record('irsync', time.time() - start, irsync_proc.returncode, output_bytes)
+    return irsync_proc.returncode
+
+
+
+def get_collection_sizes(collection, zone=None, verbose=False):
+    """
+    Returns a dict of the collection and every collection below
+    it -> (bytes, data objects) directly in it. Returns None on
+    error.
+    """
+    where = [('=', collection), ('like', collection + '/%')]
+    sizes = {}
+    try:
+        for (coll,) in GenQuery('COLL_NAME').where_any('COLL_NAME', where).rows(zone, verbose):
+            sizes[coll] = (0, 0)
+        query = GenQuery('COLL_NAME', 'sum(DATA_SIZE)', 'count(DATA_ID)')
+        for coll, size, count in query.where_any('COLL_NAME', where).rows(zone, verbose):
+            sizes[coll] = (size or 0, count or 0)
+    except IquestError:
+        return None
+    return sizes
+
+
+
+def get_collection_objects(collections, zone=None, verbose=False):
+    """
+    Returns a dict of each of the collections -> list of (data
+    object name, size) in it. Returns None on error.
+    """
+    objects = dict((coll, {}) for coll in collections)
+    collections = sorted(collections)
+    try:
+        # a few dozen collections per query, to keep the queries short
+        for start in range(0, len(collections), 50):
+            query = GenQuery('COLL_NAME', 'DATA_NAME', 'DATA_SIZE')
+            query.where_any('COLL_NAME', [('=', coll) for coll in collections[start:start + 50]])
+            for coll, name, size in query.rows(zone, verbose):
+                # one row per replica
+                objects[coll][name] = max(objects[coll].get(name, 0), size or 0)
+    except IquestError:
+        return None
+    return dict((coll, sorted(names.items())) for coll, names in objects.items())
+
+
+
+def plan_parts(collection, sizes, objects_of, part_bytes):
+    """
+    Splits 'collection' into parts of about 'part_bytes' or less,
+    given 'sizes' (as returned by get_collection_sizes). A part
+    is a dict with
+
+      kind: 'tree' (a collection and everything below it) or
+            'objects' (a batch of the data objects directly in
+            a collection),
+      collection, names (of the data objects, for 'objects'),
+      bytes and objects (the number of data objects).
+
+    'objects_of(collections)' returns the data objects in the
+    collections that had to be split, as get_collection_objects
+    does. Returns the list of parts, and the collections that
+    were split, or None on error.
+    """
+    children = {}
+    for coll in sizes:
+        if coll != collection:
+            children.setdefault(coll.rsplit('/', 1)[0], []).append(coll)
+
+    totals = {}
+    def total(coll):
+        if coll not in totals:
+            (size, count) = sizes.get(coll, (0, 0))
+            for child in children.get(coll, []):
+                (child_size, child_count) = total(child)
+                size += child_size
+                count += child_count
+            totals[coll] = (size, count)
+        return totals[coll]
+
+    # split the trees that are too big, down to parts that fit
+    trees = []
+    split = []
+    pending = [collection]
+    while pending:
+        coll = pending.pop()
+        (size, count) = total(coll)
+        divisible = children.get(coll) or sizes.get(coll, (0, 0))[1] > 1
+        # GenQuery can't quote a "'", so those aren't split
+        if size <= part_bytes or not divisible or "'" in coll:
+            trees.append(coll)
+        else:
+            split.append(coll)
+            pending.extend(children.get(coll, []))
+
+    parts = []
+    for coll in sorted(trees):
+        (size, count) = total(coll)
+        parts.append({'kind': 'tree', 'collection': coll, 'names': None,
+                      'bytes': size, 'objects': count})
+
+    objects = objects_of(split) if split else {}
+    if objects is None:
+        return None
+    for coll in sorted(split):
+        batch = []
+        batch_size = 0
+        for name, size in objects.get(coll, []) + [(None, 0)]:
+            if batch and (name is None or len(batch) >= batch_objects
+                          or batch_size + size > part_bytes):
+                parts.append({'kind': 'objects', 'collection': coll, 'names': batch,
+                              'bytes': batch_size, 'objects': len(batch)})
+                batch = []
+                batch_size = 0
+            if name is not None:
+                batch.append(name)
+                batch_size += size
+
+    return (parts, sorted(split))
+
+
+
+def plan_shards(collection, shards, zone=None, verbose=False):
+    """
+    Splits the copy of 'collection' into 'shards' shards of about
+    the same size. Returns (shards, split collections), shards
+    being lists of parts (see plan_parts), or None on error.
+    """
+    sizes = get_collection_sizes(collection, zone, verbose)
+    if not sizes:
+        return None
+    total = sum(size for (size, count) in sizes.values())
+    part_bytes = max(1, total / (shards * parts_per_shard))
+
+    planned = plan_parts(collection, sizes,
+                         lambda colls: get_collection_objects(colls, zone, verbose),
+                         part_bytes)
+    if planned is None:
+        return None
+    (parts, split) = planned
+
+    # the biggest parts first, each into the emptiest shard
+    heap = [(0, n, []) for n in range(min(shards, len(parts)) or 1)]
+    for part in sorted(parts, key=lambda part: (-part['bytes'], part['collection'])):
+        (size, n, shard) = heapq.heappop(heap)
+        shard.append(part)
+        heapq.heappush(heap, (size + part['bytes'], n, shard))
+    return ([shard for (size, n, shard) in sorted(heap, key=lambda entry: entry[1])], split)
+
+
+
+def _target(path, source, destination):
+    return destination + path[len(source):]
+
+
+
+def copy_part(part, source, destination, verbose=False, streams=0, label=None):
+    """
+    Copies one part of a sharded copy. Returns irsync's exit code.
+    """
+    target = _target(part['collection'], source, destination)
+    if part['kind'] == 'tree':
+        return run_irsync(part['collection'], target, verbose, streams, label=label)
+    return run_irsync(['%s/%s' % (part['collection'], name) for name in part['names']],
+                      target, verbose, streams, recursive=False, label=label)
+
+
+
+def run_sharded_irsync(source, destination, shards, split=(), verbose=False,
+                       streams=0, retries=2, done=None):
+    """
+    Copies 'source' to 'destination', running each of 'shards'
+    (as planned by plan_shards) on its own worker. The target
+    collections of the 'split' collections are made first. Parts
+    that fail are retried up to 'retries' times. done(part), if
+    given, is called for each part copied.
+
+    Prints the progress, and returns the list of the parts that
+    couldn't be copied, or None if the target collections
+    couldn't be made.
+    """
+    targets = [_target(coll, source, destination) for coll in split]
+    for start in range(0, len(targets), batch_objects):
+        (rc, output) = shell_command(['imkdir', '-p'] + targets[start:start + batch_objects])
+        if rc != 0:
+            print('Error making the collections under %s: %s' % (destination, output[1]))
+            return None
+
+    total_parts = sum(len(shard) for shard in shards)
+    total_bytes = sum(part['bytes'] for shard in shards for part in shard)
+    progress = {'parts': 0, 'bytes': 0}
+    lock = threading.Lock()
+
+    def copy_shard(n, shard):
+        failed = []
+        for attempt in range(retries + 1):
+            for part in shard:
+                label = 'shard %d' % (n + 1,)
+                if copy_part(part, source, destination, verbose, streams, label):
+                    failed.append(part)
+                    continue
+                if done:
+                    done(part)
+                with lock:
+                    progress['parts'] += 1
+                    progress['bytes'] += part['bytes']
+                    _write('Copied %d of %d parts, %d of %d bytes'
+                           % (progress['parts'], total_parts, progress['bytes'], total_bytes))
+            if not failed or attempt == retries:
+                break
+            _write('Retrying %d failed parts of shard %d' % (len(failed), n + 1))
+            (shard, failed) = (failed, [])
+        return failed
+
+    executor = Executor(workers=len(shards) or 1)
+    futures = [executor.submit(copy_shard, n, shard) for n, shard in enumerate(shards)]
+    failures = []
+    for future in futures:
+        failures.extend(future.result())
+    executor.shutdown()
+    return failures
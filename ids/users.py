@@ -6,10 +6,15 @@ from both iRODS and LDAP that conform to IDS naming policies.
 """
 
 import tempfile
+import hashlib
+import time
+import json
 import os
 
-from ids.utils import run_iquest, run_iadmin, shell_command
+from ids.utils import IquestError, CommandBatch, shell_command
+from ids.genquery import GenQuery
 from ids.zones import get_local_zone
+from ids.cache import cached, invalidate
 
 
 
@@ -18,12 +23,51 @@ from ids.zones import get_local_zone
 # and we want to avoid spurious iquest commands.
 #
 # There needs to be a cache per zone, since user to id mapping
-# is zone specific.
+# is zone specific. The whole map for a zone is loaded the first
+# time it's needed, and reloaded when an id isn't found in it, but
+# no more often than every user_id_refresh seconds.
 user_id_cache = {}
+user_id_cache_time = {}
+user_id_refresh = 60
 
 
+# how often (in seconds) an incremental user DB sync does a full
+# reconciliation instead
+full_sync_interval = 86400
 
-def connect_to_directory(ldap_server):
+
+# the INCF LDAP directory the IDS users and groups come from. Each
+# setting can be overridden with an environment variable: server
+# with $IDS_LDAP_SERVER, base with $IDS_LDAP_BASE, and so on.
+ldap_settings = {
+    'server': 'ldap://ldap.incf.org',
+    'base': 'ou=groups,dc=incf,dc=org',
+    'bind_dn': '',
+    'bind_password': '',
+    'start_tls': '1',
+    'page_size': '500',
+    }
+
+
+
+def get_ldap_settings():
+    """
+    Returns the LDAP settings (see ldap_settings), with any
+    overrides from the environment applied.
+    """
+    settings = {}
+    for name, value in ldap_settings.items():
+        settings[name] = os.environ.get('IDS_LDAP_%s' % (name.upper(),), value)
+    settings['start_tls'] = settings['start_tls'].lower() not in ('0', 'no', 'false', '')
+    try:
+        settings['page_size'] = int(settings['page_size'])
+    except ValueError:
+        settings['page_size'] = int(ldap_settings['page_size'])
+    return settings
+
+
+
+def connect_to_directory(ldap_server, bind_dn='', bind_password='', start_tls=True):
 
     import ldap
 
@@ -32,8 +76,9 @@ def connect_to_directory(ldap_server):
     
     try:
         con = ldap.initialize(ldap_server)
-        con.start_tls_s()
-        con.simple_bind_s('', '')
+        if start_tls:
+            con.start_tls_s()
+        con.simple_bind_s(bind_dn, bind_password)
     except ldap.LDAPError, e:
         print 'Error binding to LDAP server %s' % (ldap_server,)
         print e
@@ -43,6 +88,12 @@ def connect_to_directory(ldap_server):
 
 
 
+def connect_with_settings(settings):
+    return connect_to_directory(settings['server'], settings['bind_dn'],
+                                settings['bind_password'], settings['start_tls'])
+
+
+
 def do_ldap_search(connection, search_base, filter, attributes):
     """
     Wraps up the call to the search_s method of an ldap connection
@@ -66,43 +117,145 @@ def do_ldap_search(connection, search_base, filter, attributes):
 
 
 
-def get_ldap_group_membership():
+def do_ldap_paged_search(connection, search_base, filter, attributes, page_size=500):
+    """
+    Runs a subtree search, asking the server for the results a page
+    of 'page_size' entries at a time (with the LDAP paged results
+    control), so large directories don't hit the server's size
+    limit. Yields the (dn, attributes) of each entry as its page
+    arrives.
+
+    Raises ldap.LDAPError if the search fails.
+    """
 
     import ldap
-    
-    ldap_server = 'ldap://ldap.incf.org'
-    search_base = 'ou=groups,dc=incf,dc=org'
-    
-    con = connect_to_directory(ldap_server)
-    if con == None:
-        return None
+    from ldap.controls import SimplePagedResultsControl
+
+    control = SimplePagedResultsControl(True, size=page_size, cookie='')
+    while True:
+        msgid = connection.search_ext(search_base, ldap.SCOPE_SUBTREE, filter,
+                                      attributes, serverctrls=[control])
+        rtype, rdata, rmsgid, serverctrls = connection.result3(msgid)
+        for dn, entry in rdata:
+            if dn is not None:
+                # not a search reference
+                yield dn, entry
+
+        cookie = None
+        for response in serverctrls:
+            if response.controlType == SimplePagedResultsControl.controlType:
+                cookie = response.cookie
+        if not cookie:
+            break
+        control.cookie = cookie
+
+
 
-    search_results = do_ldap_search(con, search_base, '(cn=ids-*)', ['cn',])
-    if not search_results:
+def member_uid(dn):
+    """
+    Returns the value of the first RDN of a member's DN, such as
+    'jdoe' for 'uid=jdoe,ou=people,dc=incf,dc=org'. Only DNs with
+    escaped or multi-valued RDNs are parsed in full.
+    """
+    if '\\' in dn or '+' in dn or '"' in dn:
+        import ldap
+        return ldap.dn.str2dn(dn)[0][0][1]
+    return dn.split(',', 1)[0].split('=', 1)[-1].strip()
+
+
+
+def ldap_group_filter(groups):
+    """
+    Returns the search filter for the named groups, or for all
+    the IDS groups if 'groups' is None.
+    """
+    if groups is None:
+        return '(cn=ids-*)'
+    from ldap.filter import escape_filter_chars
+    return '(|%s)' % (''.join(['(cn=%s)' % (escape_filter_chars(group),)
+                               for group in groups]),)
+
+
+
+def get_ldap_group_membership(groups=None):
+    """
+    Retrieves the IDS groups ('ids-*') and their members from the
+    INCF LDAP directory (see ldap_settings), or just the named
+    groups, if 'groups' is given. The groups and their members
+    are fetched together, in a single paged search.
+
+    Returns: a dict where the key is the group name, and the value
+    is a list of users who are members of the group, or None on error.
+    """
+
+    import ldap
+
+    if groups is not None and not groups:
+        return {}
+
+    settings = get_ldap_settings()
+    con = connect_with_settings(settings)
+    if con == None:
         return None
 
     group_list = {}
-    for results in search_results:
-        group_list[results[1]['cn'][0]] = []
+    try:
+        for dn, entry in do_ldap_paged_search(con, settings['base'],
+                                              ldap_group_filter(groups),
+                                              ['cn', 'member'], settings['page_size']):
+            if 'cn' in entry:
+                group_list[entry['cn'][0]] = [member_uid(member)
+                                              for member in entry.get('member', [])]
+    except ldap.LDAPError as e:
+        print('Error doing an LDAP search:')
+        print(e)
+        return None
 
-    for group in group_list:
-        search_results = do_ldap_search(con, search_base,
-                                        '(cn=%s)' % (group,), ['member',])
-        if search_results == None:
-            return None
-        for results in search_results:
-            if 'member' in results[1]:
-                for dn in results[1]['member']:
-                    group_list[group].append(ldap.dn.str2dn(dn)[0][0][1])
-        
+    if groups is None and not group_list:
+        return None
     return group_list
 
 
 
-def get_irods_group_membership(zone):
+def get_ldap_group_marks():
+    """
+    Retrieves the modifyTimestamp of each IDS group in the INCF
+    LDAP directory, which changes whenever the group's members
+    do. Only the group entries' names and timestamps are fetched.
+
+    Returns a dict of group name -> timestamp, or None on error.
+    """
+
+    import ldap
+
+    settings = get_ldap_settings()
+    con = connect_with_settings(settings)
+    if con == None:
+        return None
+
+    marks = {}
+    try:
+        for dn, entry in do_ldap_paged_search(con, settings['base'], ldap_group_filter(None),
+                                              ['cn', 'modifyTimestamp'],
+                                              settings['page_size']):
+            if 'cn' in entry:
+                marks[entry['cn'][0]] = entry.get('modifyTimestamp', [''])[0]
+    except ldap.LDAPError as e:
+        print('Error doing an LDAP search:')
+        print(e)
+        return None
+
+    if not marks:
+        return None
+    return marks
+
+
+
+def get_irods_group_membership(zone, groups=None):
     """
     Retrieves the IDS users and groups from iRODS. Only group names starting
-    with 'ids-' are retrieved.
+    with 'ids-' are retrieved, or just the named groups, if 'groups' is
+    given.
 
     Input: if 'zone' is provided, its the name of the remote zone for iquest.
 
@@ -110,32 +263,70 @@ def get_irods_group_membership(zone):
     of users who are members of the group.
     """
 
-    query = "select USER_GROUP_NAME, USER_NAME where USER_GROUP_NAME like 'ids-%'"
-
-    output = run_iquest(query, format='%s:%s', zone=zone)
-    if output == None:
-        # some error occurred
-        return None
+    queries = []
+    if groups is None:
+        query = GenQuery('USER_GROUP_NAME', 'USER_NAME')
+        query.where('USER_GROUP_NAME', 'like', 'ids-%')
+        queries.append(query)
+    else:
+        # a few dozen groups per query, to keep the queries short
+        groups = sorted(groups)
+        for start in range(0, len(groups), 50):
+            query = GenQuery('USER_GROUP_NAME', 'USER_NAME')
+            query.where_any('USER_GROUP_NAME',
+                            [('=', group) for group in groups[start:start + 50]])
+            queries.append(query)
 
     group_list = {}
 
-    for line in output.splitlines():
-        if line.startswith('Zone is'):
-            continue
-        group, user = line.split(':')
-        if not group == user:
-            if group in group_list:
-                group_list[group].append(user)
-            else:
-                group_list[group] = [ user, ]
-        elif group not in group_list:
-            group_list[group] = []  # empty group
+    try:
+        for query in queries:
+            for group, user in query.rows(zone=zone):
+                if not group == user:
+                    if group in group_list:
+                        group_list[group].append(user)
+                    else:
+                        group_list[group] = [ user, ]
+                elif group not in group_list:
+                    group_list[group] = []  # empty group
+    except IquestError:
+        # some error occurred
+        return None
         
     return group_list
 
 
 
-def synchronize_user_db(source_groups, dest_groups, remove=False, verbose=False):
+def get_irods_group_marks(zone, group_list=None):
+    """
+    Retrieves a mark for each IDS group in iRODS that changes when
+    its members do: a hash of the sorted list of its members. This
+    is a single query, however many groups there are, or none if
+    the zone's membership ('group_list', as returned by
+    get_irods_group_membership()) was retrieved already.
+
+    (The number of members and their latest modification time
+    would be cheaper, but that stays the same when one member is
+    swapped for another who was modified earlier.)
+
+    Returns a dict of group name -> mark, or None on error.
+    """
+
+    if group_list is None:
+        group_list = get_irods_group_membership(zone)
+        if group_list is None:
+            return None
+
+    marks = {}
+    for group in group_list:
+        marks[group] = hashlib.sha1('\n'.join(sorted(group_list[group]))).hexdigest()
+
+    return marks
+
+
+
+def synchronize_user_db(source_groups, dest_groups, remove=False, verbose=False,
+                        sessions=1):
     """
     This function compares the source of users/groups to the destination
     and makes any changes to the destination iRODS instance to make them
@@ -150,120 +341,287 @@ def synchronize_user_db(source_groups, dest_groups, remove=False, verbose=False)
 
     The verbose flag causes messages to be printed to indicate what
     synchronization stage is being performed.
+
+    The changes are planned by plan_user_db_sync() and made by
+    apply_user_db_sync(), with the iadmin commands of each stage
+    spread over 'sessions' iadmin sessions.
+
+    Returns 1 on success, and None on error.
     """
 
-    if not source_groups or dest_groups == None:
+    plan = plan_user_db_sync(source_groups, dest_groups, remove)
+    if plan is None:
+        if verbose and source_groups:
+            print("\tCannot synchronize group 'ids-user'. It is not in the source!")
         return None
 
-    # remove groups locally that don't exist in IDS
-    if remove:
-        if verbose:
-            print('Removing groups no longer defined in the source zone...')
-        for group in dest_groups:
-            if group not in source_groups:
-                if run_iadmin('rmgroup', [ group, ], verbose=verbose):
-                    if verbose:
-                        print('\terror removing group %s' % (group,))
-                    else:
-                        if verbose:
-                            print('\tremoved group %s' % (group,))
+    if apply_user_db_sync(plan, verbose=verbose, sessions=sessions) is None:
+        return None
+    return 1
 
-    # remove users that don't exist in IDS's ids-user group
-    if remove:
-        if verbose:
-            print('Removing users that have been removed from \'ids-user\'...')
-        if 'ids-user' in dest_groups:
-            for user in dest_groups['ids-user']:
-                if user not in source_groups['ids-user']:
-                    zone_user = user + '#incf'
-                    if run_iadmin('rmuser', [ zone_user, ], verbose=verbose):
-                        if verbose:
-                            print('\terror removing user %s' % (zone_user,))
-                            print('\tThey might still own files in iRODS.')
-                        else:
-                            if verbose:
-                                print('\tremoved user %s' % (zone_user,))
-
-
-    # Additions
-
-    # add groups from IDS that don't exist locally
-    if verbose:
-        print('Adding new source zone groups...')
-    for group in source_groups:
-        if group not in dest_groups:
-            if run_iadmin('mkgroup', [ group, ], verbose=verbose):
-                if verbose:
-                    print('\terror adding new group %s' % (group,))
-            else:
-                dest_groups[group] = []
-                if verbose:
-                    print('\tadded new group %s' % (group,))
 
-    # can happen on initial sync if there is an error adding ids-user above
-    if 'ids-user' not in dest_groups:
-        if verbose:
-            print("\tCannot synchronize group 'ids-user'. It does not exist locally!")
+
+# the stages of a user DB sync, in the order they're applied,
+# with the iadmin commands of each
+sync_stages = [
+    ('removals', ('rmgroup', 'rmuser')),
+    ('groups', ('mkgroup',)),
+    ('users', ('mkuser',)),
+    ('membership', ('atg', 'rfg')),
+    ]
+
+
+
+def plan_user_db_sync(source_groups, dest_groups, remove=False):
+    """
+    Works out the iadmin commands that make the destination groups
+    (a dict of group name -> list of members, as returned by
+    get_irods_group_membership) the same as the source groups,
+    without running any of them. Users are added to the
+    destination as user#incf, and only the members of the source's
+    'ids-user' group are added as users.
+
+    If 'remove' is set, groups that aren't in the source, users
+    that aren't in its 'ids-user' group, and group members that
+    aren't members in the source are removed.
+
+    Returns the plan, a list of iadmin argument tuples such as
+    ('atg', 'ids-user', 'jo#incf'), ordered by stage (see
+    sync_stages), or None if the source has no 'ids-user' group
+    or either dict is missing. Neither dict is changed.
+    """
+
+    if not source_groups or dest_groups == None or 'ids-user' not in source_groups:
         return None
 
+    source = dict((group, set(users)) for group, users in source_groups.items())
+    dest = dict((group, set(users)) for group, users in dest_groups.items())
+    empty = set()
 
-    # add users from ids-user that don't exist locally
-    if verbose:
-        print('Adding new users from \'ids-user\'...')
-    for user in source_groups['ids-user']:
-        if user not in dest_groups['ids-user']:
-            zone_user = user + '#incf'
-            if run_iadmin('mkuser', [ zone_user, 'rodsuser' ], verbose=verbose):
+    removed_groups = []
+    removed_users = []
+    if remove:
+        removed_groups = sorted(set(dest) - set(source))
+        removed_users = sorted(dest.get('ids-user', empty) - source['ids-user'])
+
+    new_groups = sorted(set(source) - set(dest))
+    new_users = sorted(source['ids-user'] - dest.get('ids-user', empty))
+
+    plan = []
+    plan.extend(('rmgroup', group) for group in removed_groups)
+    plan.extend(('rmuser', user + '#incf') for user in removed_users)
+    plan.extend(('mkgroup', group) for group in new_groups)
+    plan.extend(('mkuser', user + '#incf', 'rodsuser') for user in new_users)
+
+    # new users go into 'ids-user' first, then the other groups
+    # are synchronized
+    plan.extend(('atg', 'ids-user', user + '#incf') for user in new_users)
+    removed_users = set(removed_users)
+    for group in sorted(source):
+        if group == 'ids-user':
+            continue
+        members = dest.get(group, empty)
+        if remove:
+            plan.extend(('rfg', group, user + '#incf')
+                        for user in sorted(members - source[group] - removed_users))
+        plan.extend(('atg', group, user + '#incf')
+                    for user in sorted(source[group] - members))
+
+    return plan
+
+
+
+def format_user_db_sync(plan):
+    """
+    Returns the lines describing a user DB sync plan for a dry
+    run: the iadmin commands, and the number of them per stage.
+    """
+    lines = ['iadmin %s' % (' '.join(args),) for args in plan]
+    counts = []
+    for stage, commands in sync_stages:
+        count = len([args for args in plan if args[0] in commands])
+        counts.append('%d %s' % (count, stage))
+    lines.append('%d changes: %s' % (len(plan), ', '.join(counts)))
+    return lines
+
+
+
+_sync_messages = {
+    'rmgroup': ('removed group %s', 'error removing group %s'),
+    'rmuser': ('removed user %s', 'error removing user %s. They might still own files in iRODS.'),
+    'mkgroup': ('added new group %s', 'error adding new group %s'),
+    'mkuser': ('added new user %s', 'error adding new user %s'),
+    'atg': ('added user %s to group %s', 'error adding %s to group %s'),
+    'rfg': ('removed user %s from group %s', 'error removing %s from group %s'),
+    }
+
+def apply_user_db_sync(plan, verbose=False, sessions=1):
+    """
+    Runs the iadmin commands of a plan from plan_user_db_sync(),
+    one batch per stage (see ids.utils.CommandBatch) over
+    'sessions' iadmin sessions. A membership change is skipped
+    if making its group or user failed.
+
+    Returns a dict of iadmin command -> {'done': n, 'failed': n,
+    'skipped': n}, or None if the 'ids-user' group couldn't be
+    made, in which case nothing after the groups stage is run.
+    """
+    counts = {}
+    for command in _sync_messages:
+        counts[command] = {'done': 0, 'failed': 0, 'skipped': 0}
+    failed = set()
+
+    for stage, commands in sync_stages:
+        batch = CommandBatch('iadmin', sessions=sessions)
+        steps = []
+        for args in plan:
+            if args[0] not in commands:
+                continue
+            if args[0] in ('atg', 'rfg') and (args[1] in failed or args[2] in failed):
+                counts[args[0]]['skipped'] += 1
                 if verbose:
-                    print('\terror adding new user %s' % (zone_user,))
+                    print('\tskipped %s' % (' '.join(args),))
+                continue
+            steps.append((args, batch.add(*args)))
+        if not steps:
+            continue
+
+        if verbose:
+            print('Synchronizing %s...' % (stage,))
+        batch.run(verbose=verbose)
+        if stage != 'membership':
+            invalidate('user_ids')
+
+        for args, command in steps:
+            done, error = _sync_messages[args[0]]
+            if command.rc:
+                counts[args[0]]['failed'] += 1
+                failed.add(args[1])
+                message = error
             else:
-                if verbose:
-                    print('\tadded new user %s' % (zone_user,))
-                if run_iadmin('atg', [ 'ids-user', zone_user ], verbose=verbose):
-                    if verbose:
-                        print('\terror adding %s to \'ids-user\' group' % (zone_user,))
+                counts[args[0]]['done'] += 1
+                message = done
+            if verbose:
+                if args[0] in ('atg', 'rfg'):
+                    print('\t' + message % (args[2], args[1]))
                 else:
-                    if verbose:
-                        print('\tadded %s to group \'ids-user\'' % (zone_user,))
+                    print('\t' + message % (args[1],))
+
+        if stage == 'groups' and 'ids-user' in failed:
+            if verbose:
+                print("\tCannot synchronize group 'ids-user'. It does not exist locally!")
+            return None
 
+    return counts
 
 
-    # Synchronize group membership (except for ids-user which has
-    # already been processed)
-    if verbose:
-        print('Synchronizing group membership...')
-    for group in source_groups:
-        if group == 'ids-user':
-            continue
 
-        if group not in dest_groups:
+def load_sync_state(state_file):
+    """
+    Reads the state an incremental user DB sync left in
+    'state_file'. Returns a dict, which is empty if there is no
+    usable state.
+    """
+    try:
+        with open(os.path.expanduser(state_file)) as f:
+            state = json.load(f)
+    except (IOError, ValueError):
+        return {}
+    if not isinstance(state, dict) or 'marks' not in state or 'full_time' not in state:
+        return {}
+    return state
+
+
+
+def save_sync_state(state_file, state):
+    """
+    Writes the state of an incremental user DB sync to
+    'state_file', replacing it all at once. Returns 0 on success,
+    and -1 on error.
+    """
+    path = os.path.expanduser(state_file)
+    try:
+        (fd, temp_path) = tempfile.mkstemp(dir=os.path.dirname(path) or '.')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(state, f)
+        os.rename(temp_path, path)
+    except (IOError, OSError) as e:
+        print('Error saving the sync state to %s: %s' % (path, e))
+        return -1
+    return 0
+
+
+
+def incremental_sync_user_db(marks, get_groups, state_file, remove=False,
+                             verbose=False, sessions=1, full=False):
+    """
+    Synchronizes the local zone's IDS users and groups with a source
+    (the 'incf' zone, or the LDAP directory), looking only at the
+    groups that changed since the last successful sync.
+
+    'marks' is a dict of group name -> a value that changes when
+    the source group does (see get_irods_group_marks() and
+    get_ldap_group_marks()), and get_groups(groups) returns the
+    source membership (as get_irods_group_membership() does) of
+    the named groups, or of all the groups if 'groups' is None.
+    The marks of the last successful sync are kept in 'state_file'.
+
+    Every full_sync_interval seconds (or if 'full' is set, or there
+    is no state) all the groups are synchronized instead, which
+    catches changes the marks can miss.
+
+    Returns the number of changes made, or None on error. The state
+    is only saved when every change succeeded.
+    """
+
+    state = load_sync_state(state_file)
+    now = time.time()
+
+    if full or not state or now - state['full_time'] >= full_sync_interval:
+        if verbose:
+            print('Synchronizing all the groups...')
+        source_groups = get_groups(None)
+        dest_groups = get_irods_group_membership(None)
+        state = {'full_time': now}
+
+    else:
+        changed = sorted(group for group in set(marks) | set(state['marks'])
+                         if marks.get(group) != state['marks'].get(group))
+        if not changed:
             if verbose:
-                print('\tCannot synchronize group %s. It does not exist locally.' % (group,))
-            continue
+                print('No groups have changed since the last sync.')
+            return 0
+        if verbose:
+            print('Synchronizing changed groups: %s' % (' '.join(changed),))
+        if 'ids-user' not in marks:
+            return None
 
-        # remove user from group
-        for user in dest_groups[group]:
-            if remove and user not in source_groups[group]:
-                zone_user = user + '#incf'
-                if run_iadmin('rfg', [group, zone_user], verbose=verbose):
-                    if verbose:
-                        print('\terror removing %s from group %s' % (zone_user, group))
-                else:
-                    if verbose:
-                        print('\tremoved user %s from group %s' % (zone_user, group))
-                    
-        # add users to group
-        for user in source_groups[group]:
-            if user not in dest_groups[group]:
-                zone_user = user + '#incf'
-                if run_iadmin('atg', [ group, zone_user], verbose=verbose):
-                    if verbose:
-                        print('\terror adding %s to group %s' % (zone_user, group))
-                else:
-                    if verbose:
-                        print('\tadded user %s to group %s' % (zone_user, group))
+        # groups that are gone from the source are fetched from
+        # the destination only, so they are removed if need be
+        source_groups = get_groups([group for group in changed if group in marks])
+        dest_groups = get_irods_group_membership(None, groups=changed)
+        if source_groups != None and dest_groups != None and 'ids-user' not in changed:
+            # no users to add or remove
+            source_groups['ids-user'] = []
+            dest_groups['ids-user'] = []
+
+    if source_groups == None or dest_groups == None:
+        return None
+
+    plan = plan_user_db_sync(source_groups, dest_groups, remove)
+    if plan is None:
+        return None
+    counts = apply_user_db_sync(plan, verbose=verbose, sessions=sessions)
+    if counts is None:
+        return None
+
+    if not any(counts[command]['failed'] or counts[command]['skipped']
+               for command in counts):
+        state['marks'] = marks
+        save_sync_state(state_file, state)
+
+    return len(plan)
 
-    return 1
 
 
 def irods_user_to_id(username, verbose=None):
@@ -285,19 +643,59 @@ def irods_user_to_id(username, verbose=None):
             print('irods_user_to_id: username should be of form "user#zone"')
         return None
 
-    id_query = "select USER_ID where USER_NAME = '%s' and USER_ZONE = '%s'" % (user[0], user[1])
-    id = run_iquest(id_query, format='%s', verbose=verbose)
-    if id == None:
+    id_query = GenQuery('USER_ID')
+    id_query.where('USER_NAME', '=', user[0]).where('USER_ZONE', '=', user[1])
+    try:
+        row = id_query.first(verbose=verbose)
+    except IquestError:
         return None
-    elif not id:
+    if row is None:
         # user not found
         return ""
     else:
         # keep in string form, as this is what iRODS mostly works with
-        return id.rstrip('\n')
+        return row.user_id
     
 
 
+def load_user_ids(zone=None, verbose=False, refresh=False):
+    """
+    Loads the ids of all the users and groups in 'zone' (the
+    local zone by default) into the user id cache, with one
+    query. The map is taken from the catalog cache (see
+    ids.cache) if it's there, unless 'refresh' is set.
+
+    Returns the dict of id -> 'user#zone' for the zone, or
+    None if an error occurred.
+    """
+    if not zone:
+        zone = get_local_zone(verbose)
+        if not zone:
+            return None
+
+    user_ids = cached('user_ids', zone, lambda: _load_user_ids(zone, verbose),
+                      refresh=refresh)
+    if user_ids is None:
+        return None
+
+    user_id_cache[zone] = user_ids
+    user_id_cache_time[zone] = time.time()
+    return user_ids
+
+
+
+def _load_user_ids(zone, verbose=False):
+    user_ids = {}
+    user_query = GenQuery('USER_ID', 'USER_NAME', 'USER_ZONE')
+    try:
+        for id, user, user_zone in user_query.rows(zone=zone, verbose=verbose):
+            user_ids[id] = '%s#%s' % (user, user_zone)
+    except IquestError:
+        return None
+    return user_ids
+
+
+
 def irods_id_to_user(id, zone=None, verbose=None):
     """
     Look up a user id in the iRODS user DB and return the
@@ -321,21 +719,32 @@ def irods_id_to_user(id, zone=None, verbose=None):
         if id in user_id_cache[zone]:
             return user_id_cache[zone][id]
 
-    # no cache hit ... look it up
-    user_query = "select USER_NAME, USER_ZONE where USER_ID = '%s'" % (id,)
-    user = run_iquest(user_query, format='%s#%s', zone=zone, verbose=verbose)
-    if user == None:
+    # no cache hit ... (re)load the zone's ids, if that
+    # hasn't been done recently
+    if time.time() - user_id_cache_time.get(zone, 0) > user_id_refresh:
+        user_ids = load_user_ids(zone, verbose,
+                                 refresh=zone in user_id_cache_time)
+        if user_ids is not None and id in user_ids:
+            return user_ids[id]
+
+    # still no hit ... look it up
+    user_query = GenQuery('USER_NAME', 'USER_ZONE').where('USER_ID', '=', id)
+    try:
+        user = user_query.first(zone=zone, verbose=verbose)
+    except IquestError:
         return None
-    elif not user:
+    if user is None:
         # user not found
-        return ""
+        user_name = ""
     else:
         # keep in string form, as this is what iRODS mostly works with
-        user_name = user.rstrip('\n')
-        if zone not in user_id_cache:
-            user_id_cache[zone] = {}
-        user_id_cache[zone][id] = user_name
-        return user_name
+        user_name = '%s#%s' % user
+
+    # remember misses too, until the next reload
+    if zone not in user_id_cache:
+        user_id_cache[zone] = {}
+    user_id_cache[zone][id] = user_name
+    return user_name
 
 
 
@@ -353,12 +762,14 @@ def irods_user_exists(username, verbose=False):
             print('irods_user_to_id: username should be of form "user#zone"')
         return -1
 
-    user_query = "select count(USER_NAME) where USER_NAME = '%s' and USER_ZONE = '%s'"
-    exists = run_iquest(user_query % (user[0], user[1]), format='%s', verbose=verbose)
-    if exists == None:
+    user_query = GenQuery('count(USER_NAME)')
+    user_query.where('USER_NAME', '=', user[0]).where('USER_ZONE', '=', user[1])
+    try:
+        row = user_query.first(verbose=verbose)
+    except IquestError:
         return -1
-    else:
-        return int(exists)
+
+    return row.count_user_name if row else 0
 
 
     
@@ -371,13 +782,13 @@ def get_irods_group(groupname, verbose=False):
     if not groupname:
         return None
 
-    group_query = "select USER_NAME, USER_ZONE where USER_GROUP_NAME = '%s'"
-    output = run_iquest(group_query % (groupname,), format='%s#%s', verbose=verbose)
-    if output == None:
+    group_query = GenQuery('USER_NAME', 'USER_ZONE')
+    group_query.where('USER_GROUP_NAME', '=', groupname)
+    try:
+        return ['%s#%s' % row for row in group_query.rows(verbose=verbose)]
+    except IquestError:
         return None
 
-    return output.splitlines()
-
 
 
 def auth_irods_user(user, password, scheme='PAM'):
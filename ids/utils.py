@@ -2,34 +2,609 @@
 Some helpful functions for the other IDS modules and utilities
 """
 
+import os
+import sys
+import stat
+import errno
 import subprocess
 import re
+import threading
+import Queue
+import tempfile
+import time
+import datetime
+import calendar
 
+from ids import profiling
 
 
-def shell_command(command_list, environment=None):
+
+# the return code shell_command gives for a command that
+# ran past its deadline and was killed
+COMMAND_TIMED_OUT = -2
+
+# the deadline (in seconds) for commands run without one, such
+# as the request timeout of a server; None means no deadline
+default_command_timeout = None
+
+
+def shell_command(command_list, environment=None, timeout=None):
     """
     Performs a shell command using the subprocess object
     
     input list of strings that represent the argv of the process to create
-    and optionally the environment to run within
+    and optionally the environment to run within, and the number of
+    seconds after which the process is killed
 
     return tuple (return code, the output object from subprocess.communicate)
+    the return code is COMMAND_TIMED_OUT if the process was killed
+
+    commands without a timeout get default_command_timeout
     """
 
     if not command_list:
         return None
         
+    if timeout is None:
+        timeout = default_command_timeout
+    name = profiling.command_name(command_list)
+    query = command_list[-1] if name == 'iquest' else None
+    start = time.time()
     try:
         process = subprocess.Popen(command_list, stdout=subprocess.PIPE,
                                    stderr=subprocess.PIPE, env=environment)
+        deadline = _Deadline(process, timeout)
         output = process.communicate()
-        return (process.returncode, output)
+        rc = process.returncode
+        if deadline.cancel():
+            rc = COMMAND_TIMED_OUT
+            output = (output[0], '%scommand timed out after %s seconds\n'
+                      % (output[1], timeout))
+        profiling.record(name, time.time() - start, rc,
+                         len(output[0]) + len(output[1]), query)
+        return (rc, output)
     except:
+        profiling.record(name, time.time() - start, -1, 0, query)
         return (-1, [None, None])
 
 
 
+class _Deadline(object):
+    """
+    Kills 'process' if it's still running after 'timeout'
+    seconds (never, if timeout is None).
+    """
+
+    def __init__(self, process, timeout):
+        self.process = process
+        self.timeout = timeout
+        self.expired = False
+        self.timer = None
+        self._start()
+
+
+    def _start(self):
+        if self.timeout is not None:
+            self.timer = threading.Timer(self.timeout, self._expire, (self.process,))
+            self.timer.daemon = True
+            self.timer.start()
+
+
+    def _expire(self, process):
+        self.expired = True
+        try:
+            process.kill()
+        except OSError:
+            pass
+
+
+    def cancel(self):
+        """
+        Stops the timer. Returns True if the process was killed.
+        """
+        if self.timer is not None:
+            self.timer.cancel()
+        return self.expired
+
+
+    def restart(self):
+        """
+        Gives the process another 'timeout' seconds from now,
+        unless it was killed already.
+        """
+        if self.timer is not None and not self.expired:
+            self.timer.cancel()
+            self._start()
+
+
+
+def parse_genquery(query):
+    """
+    Parses a GenQuery string as accepted by iquest, for example:
+
+      select COLL_NAME, count(DATA_NAME) where COLL_NAME like '/zone/%'
+
+    Returns a tuple (selects, conditions). 'selects' is a list of
+    (function, column) tuples, where function is None, or one of
+    the GenQuery functions such as 'order' or 'count'. 'conditions'
+    is a list of (column, [(operator, value), ...]) tuples, where
+    more than one (operator, value) pair means the alternatives were
+    joined with '||'.
+
+    Raises ValueError if the query can't be parsed.
+    """
+
+    match = _genquery_regex.match(query)
+    if not match:
+        raise ValueError('not a GenQuery: %s' % (query,))
+
+    selects = []
+    for item in match.group(1).split(','):
+        item = item.strip()
+        func = _genquery_select_regex.match(item)
+        if func:
+            selects.append((func.group(1).lower(), func.group(2)))
+        elif _genquery_column_regex.match(item):
+            selects.append((None, item))
+        else:
+            raise ValueError('bad select item: %s' % (item,))
+
+    conditions = []
+    where = match.group(2)
+    while where:
+        cond = _genquery_cond_regex.match(where)
+        if not cond:
+            raise ValueError('bad condition: %s' % (where,))
+        column = cond.group(1)
+        ops = [(cond.group(2).lower(), cond.group(3))]
+        where = where[cond.end():]
+        alt = _genquery_alt_regex.match(where)
+        while alt:
+            ops.append((alt.group(1).lower(), alt.group(2)))
+            where = where[alt.end():]
+            alt = _genquery_alt_regex.match(where)
+        conditions.append((column, ops))
+        conj = _genquery_and_regex.match(where)
+        if conj:
+            where = where[conj.end():]
+        elif where.strip():
+            raise ValueError('bad condition: %s' % (where,))
+        else:
+            where = ''
+
+    return (selects, conditions)
+
+
+_genquery_regex = re.compile(r'^\s*select\s+(.+?)(?:\s+where\s+(.*?))?\s*$',
+                             re.IGNORECASE | re.DOTALL)
+_genquery_column_regex = re.compile(r'^[A-Z][A-Z0-9_]*$')
+_genquery_select_regex = re.compile(r'^(order|order_desc|count|sum|min|max|avg)'
+                                    r'\s*\(\s*([A-Z][A-Z0-9_]*)\s*\)$',
+                                    re.IGNORECASE)
+_genquery_op = r"(=|<>|<=|>=|<|>|not like|like)\s*'([^']*)'"
+_genquery_cond_regex = re.compile(r'\s*([A-Z][A-Z0-9_]*)\s*' + _genquery_op,
+                                  re.IGNORECASE)
+_genquery_alt_regex = re.compile(r'\s*\|\|\s*' + _genquery_op, re.IGNORECASE)
+_genquery_and_regex = re.compile(r'\s+and\s+', re.IGNORECASE)
+
+
+
+def format_iquest_rows(rows, selects, format=None):
+    """
+    Formats the result rows of a query the same way iquest
+    does, either using the printf style 'format' string, or
+    as 'COLUMN = value' lines separated by dashes when there
+    is no format.
+
+    Returns the formatted output as a string.
+    """
+
+    lines = []
+    for row in rows:
+        if format:
+            lines.append(format % tuple(row))
+        else:
+            for (func, column), value in zip(selects, row):
+                lines.append('%s = %s' % (column, value))
+            lines.append('-' * 60)
+    if not lines:
+        return ''
+    return '\n'.join(lines) + '\n'
+
+
+
+class IquestError(Exception):
+    """
+    Raised by iquest_rows when a query fails.
+    """
+
+
+
+# iquest has no way to quote its output, so rows are requested
+# with separators between the columns and at the end of each row
+# that are made unique to each query by a random token. That way
+# values can contain newlines or any other text.
+def _make_separators():
+    token = os.urandom(6).encode('hex')
+    return ('\x1f%s\x1f' % (token,), '\x1e%s\x1e' % (token,))
+
+
+
+class IquestBackend(object):
+    """
+    Query backend that forks the iquest command for every
+    query. This is the default backend, and the fallback for
+    the session backend.
+    """
+
+    def rows(self, query, zone=None, verbose=False, timeout=None):
+        """
+        Runs the query and yields the result rows as tuples of
+        strings while iquest is still producing them, so only
+        one row at a time is held in memory. iquest is killed if
+        it's still running after 'timeout' seconds.
+        """
+
+        selects = parse_genquery(query)[0]
+        if timeout is None:
+            timeout = default_command_timeout
+
+        command = ['iquest', '--no-page']
+        if zone:
+            command.append('-z')
+            command.append(zone)
+        column_sep, row_end = _make_separators()
+        command.append(column_sep.join(['%s'] * len(selects)) + row_end)
+        command.append(query)
+
+        # stderr goes to a file, so a chatty iquest can't block
+        # on a full pipe while we are reading stdout
+        errors = tempfile.TemporaryFile()
+        start = time.time()
+        try:
+            process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                                       stderr=errors, bufsize=-1)
+        except OSError as e:
+            errors.close()
+            profiling.record('iquest', time.time() - start, -1, 0, query)
+            if verbose:
+                print('Error running %s: %s' % (' '.join(command), e.strerror))
+            raise IquestError('could not run iquest: %s' % (e.strerror,))
+
+        deadline = _Deadline(process, timeout)
+        record = ''
+        output_bytes = 0
+        rc = 0
+        try:
+            for line in iter(process.stdout.readline, ''):
+                output_bytes += len(line)
+                # get rid of 'Zone is X' first line
+                if zone and not record and line.startswith('Zone is '):
+                    zone = None
+                    continue
+                # iquest ends each row with a newline after the format
+                record += line
+                if record.endswith(row_end + '\n'):
+                    yield tuple(record[:-len(row_end)-1].split(column_sep))
+                    record = ''
+            rc = process.wait()
+        finally:
+            if process.returncode is None:
+                # the caller stopped reading early
+                process.kill()
+                process.wait()
+            process.stdout.close()
+            timed_out = deadline.cancel()
+
+            errors.seek(0)
+            stderr = errors.read()
+            errors.close()
+
+            if 'CAT_NO_ROWS_FOUND' in record + stderr:
+                rc = 0
+            profiling.record('iquest', time.time() - start,
+                             COMMAND_TIMED_OUT if timed_out else rc,
+                             output_bytes + len(stderr), query)
+
+        if timed_out:
+            if verbose:
+                print('%s timed out after %s seconds' % (' '.join(command), timeout))
+            raise IquestError('iquest timed out after %s seconds' % (timeout,))
+
+        if rc != 0:
+            if verbose:
+                print('Error running %s, rc = %d'
+                      % (' '.join(command), rc))
+                print(stderr)
+            raise IquestError('iquest failed with rc = %d' % (rc,))
+
+
+    def query(self, query, format=None, zone=None, verbose=False):
+        """
+        Runs the query and returns the output of iquest, with
+        the same semantics as run_iquest. This is only used
+        for queries that parse_genquery doesn't understand.
+        """
+
+        command = ['iquest', '--no-page']
+
+        if zone:
+            command.append('-z')
+            command.append(zone)
+
+        if format:
+            command.append(format)
+
+        command.append(query)
+
+        (rc, output) = shell_command(command)
+        if output[0] is None:
+            if verbose:
+                print('Error running %s' % (' '.join(command),))
+            return None
+
+        if 'CAT_NO_ROWS_FOUND' in output[0] or 'CAT_NO_ROWS_FOUND' in output[1]:
+            return ""
+
+        if rc != 0:
+            if verbose:
+                print('Error running %s, rc = %d'
+                      % (' '.join(command), rc))
+                print(output[1])
+            return None
+
+        # get rid of 'Zone is X' first line
+        if zone:
+            return output[0][(output[0].find('\n')+1):]
+        else:
+            return output[0]
+
+
+
+class SessionBackend(object):
+    """
+    Query backend that keeps one authenticated connection open
+    per zone and runs every query over it, instead of paying for
+    a new iquest process (connect and authenticate) per query.
+
+    'connect' is called with the zone name (None for the local
+    zone) and must return an object with a genquery(selects,
+    conditions, zone) method that yields result rows as tuples
+    of strings. The default uses python-irodsclient.
+
+    Queries the session can't run (unsupported syntax, missing
+    python-irodsclient, connection errors) are passed on to the
+    'fallback' backend, which is iquest by default.
+    """
+
+    def __init__(self, connect=None, fallback=None):
+        self.connect = connect or IrodsClientConnection
+        self.fallback = fallback or IquestBackend()
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+
+    def get_session(self, zone, verbose=False):
+        """
+        Returns the open session for the zone, connecting if
+        needed. Returns None if a connection can't be made.
+        """
+        with self.lock:
+            if zone in self.sessions:
+                return self.sessions[zone]
+            try:
+                session = self.connect(zone)
+            except Exception as e:
+                if verbose:
+                    print('Could not open iRODS session for zone %s: %s'
+                          % (zone or 'local', e))
+                session = None
+            self.sessions[zone] = session
+            return session
+
+
+    def drop_session(self, zone):
+        """
+        Closes and forgets the session for the zone, so that the
+        next query reconnects.
+        """
+        with self.lock:
+            session = self.sessions.pop(zone, None)
+        if session is not None and hasattr(session, 'close'):
+            try:
+                session.close()
+            except Exception:
+                pass
+
+
+    def close(self):
+        for zone in list(self.sessions):
+            self.drop_session(zone)
+
+
+    def rows(self, query, zone=None, verbose=False, timeout=None):
+        """
+        Runs the query over the zone's session, yielding the
+        result rows as tuples of strings page by page. The
+        'timeout' only applies to the fallback; sessions rely on
+        the timeouts of their connections.
+        """
+
+        selects, conditions = parse_genquery(query)
+
+        # try once more with a fresh connection if the open
+        # session has gone stale
+        for attempt in range(2):
+            session = self.get_session(zone, verbose)
+            if session is None:
+                break
+            started = False
+            start = time.time()
+            try:
+                for row in session.genquery(selects, conditions, zone):
+                    started = True
+                    yield row
+                profiling.record('session query', time.time() - start, 0, 0, query)
+                return
+            except NotImplementedError:
+                if started:
+                    raise
+                break
+            except Exception as e:
+                profiling.record('session query', time.time() - start, -1, 0, query)
+                if verbose:
+                    print('Error running query over iRODS session: %s' % (e,))
+                self.drop_session(zone)
+                if started:
+                    # can't start over without repeating rows
+                    raise IquestError('iRODS session failed: %s' % (e,))
+
+        for row in self.fallback.rows(query, zone, verbose, timeout):
+            yield row
+
+
+
+class IrodsClientConnection(object):
+    """
+    A connection for the SessionBackend built on
+    python-irodsclient. The connection settings come from the
+    iRODS environment file named by $IRODS_ENVIRONMENT_FILE
+    (~/.irods/irods_environment.json by default).
+    """
+
+    def __init__(self, zone=None):
+
+        from irods.session import iRODSSession
+
+        env_file = os.environ.get('IRODS_ENVIRONMENT_FILE',
+                                  os.path.expanduser('~/.irods/irods_environment.json'))
+        self.session = iRODSSession(irods_env_file=env_file)
+        self.columns = irods_client_columns()
+
+
+    def genquery(self, selects, conditions, zone=None):
+
+        from irods.column import Criterion
+
+        for func, column in selects:
+            if column not in self.columns:
+                raise NotImplementedError(column)
+
+        query = self.session.query(*[self.columns[column]
+                                     for func, column in selects
+                                     if func in (None, 'order', 'order_desc')])
+        for func, column in selects:
+            if func == 'order':
+                query = query.order_by(self.columns[column])
+            elif func == 'order_desc':
+                query = query.order_by(self.columns[column], order='desc')
+            elif func:
+                query = getattr(query, func)(self.columns[column])
+
+        for column, ops in conditions:
+            if column not in self.columns or len(ops) != 1:
+                raise NotImplementedError(column)
+            op, value = ops[0]
+            query = query.filter(Criterion(op, self.columns[column], value))
+
+        if zone:
+            from irods import keywords
+            query = query.add_keyword(keywords.ZONE_KW, zone)
+
+        for result_set in query.get_batches():
+            for row in result_set:
+                yield tuple(_irods_client_str(row[self.columns[column]])
+                            for func, column in selects)
+
+
+    def close(self):
+        self.session.cleanup()
+
+
+
+def irods_client_columns():
+    """
+    Returns a dict of the python-irodsclient column objects
+    keyed by their GenQuery name (e.g. 'COLL_NAME').
+    """
+
+    from irods import models
+
+    columns = {}
+    for name in dir(models):
+        model = getattr(models, name)
+        for column in getattr(model, '_columns', []):
+            columns[column.icat_key] = column
+    return columns
+
+
+
+def _irods_client_str(value):
+    """
+    python-irodsclient converts values to python types, while
+    iquest returns everything as strings. Convert back to what
+    iquest would print (times are zero padded epoch seconds).
+    """
+    if value is None:
+        return ''
+    if isinstance(value, datetime.datetime):
+        return '%011d' % calendar.timegm(value.utctimetuple())
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+
+_query_backend = None
+
+def get_query_backend():
+    """
+    Returns the backend used by iquest_rows. Unless one was set
+    with set_query_backend, the backend is chosen with the
+    IDS_QUERY_BACKEND environment variable: 'session' keeps a
+    connection open per zone, while 'iquest' (the default) runs
+    the iquest command for each query.
+    """
+    global _query_backend
+    if _query_backend is None:
+        if os.environ.get('IDS_QUERY_BACKEND') == 'session':
+            _query_backend = SessionBackend()
+        else:
+            _query_backend = IquestBackend()
+    return _query_backend
+
+
+
+def set_query_backend(backend):
+    """
+    Sets the backend used by iquest_rows, returning the previous
+    one. A backend is an object with a rows(query, zone, verbose)
+    generator method, such as IquestBackend or SessionBackend.
+    """
+    global _query_backend
+    previous = _query_backend
+    _query_backend = backend
+    return previous
+
+
+
+def iquest_rows(query, zone=None, verbose=False, timeout=None):
+    """
+    Runs the GenQuery string 'query' (in the zone 'zone', if
+    provided) and yields the result rows as tuples of strings,
+    one value per selected column. Rows are yielded as the
+    catalog returns them, page by page, so memory use doesn't
+    grow with the size of the result. If 'timeout' is given,
+    the query is abandoned after that many seconds.
+
+    Raises IquestError if the query fails or times out, or
+    ValueError if the query can't be parsed.
+    """
+
+    return get_query_backend().rows(query, zone, verbose, timeout)
+
+
+
 def run_iquest(query, format=None, zone=None, verbose=False):
     """
     Runs iquest with the given string iquest_query
@@ -41,35 +616,155 @@ def run_iquest(query, format=None, zone=None, verbose=False):
 
     if not query:
         return None
-    
-    command = ['iquest', '--no-page']
 
-    if zone:
-        command.append('-z')
-        command.append(zone)
-        
-    if format:
-        command.append(format)
-        
-    command.append(query)
+    try:
+        selects = parse_genquery(query)[0]
+    except ValueError:
+        # let iquest itself deal with anything we can't parse
+        return IquestBackend().query(query, format, zone, verbose)
 
-    (rc, output) = shell_command(command)
+    try:
+        return format_iquest_rows(iquest_rows(query, zone, verbose),
+                                  selects, format)
+    except IquestError:
+        return None
 
-    if 'CAT_NO_ROWS_FOUND' in output[0] or 'CAT_NO_ROWS_FOUND' in output[1]:
-        return ""
 
-    if rc != 0:
-        if verbose:
-            print('Error running %s, rc = %d'
-                  % (' '.join(command), rc))
-            print output[1]
-        return None
 
-    # get rid of 'Zone is X' first line
-    if zone:
-        return output[0][(output[0].find('\n')+1):]
-    else:
-        return output[0]
+class DeadlineExceeded(Exception):
+    """
+    Raised by Future.result() when the result isn't ready in time.
+    """
+    pass
+
+
+
+class Future(object):
+    """
+    The result of a call submitted to an Executor.
+    """
+
+    def __init__(self):
+        self._finished = threading.Event()
+        self._result = None
+        self._error = None
+
+
+    def done(self):
+        return self._finished.is_set()
+
+
+    def result(self, timeout=None):
+        """
+        Waits (up to 'timeout' seconds) for the call to finish,
+        and returns its result. Raises the exception the call
+        raised, or DeadlineExceeded if it didn't finish in time.
+        """
+        if not self._finished.wait(timeout):
+            raise DeadlineExceeded('no result after %s seconds' % (timeout,))
+        if self._error:
+            raise self._error[0], self._error[1], self._error[2]
+        return self._result
+
+
+    def _set(self, result=None, error=None):
+        self._result = result
+        self._error = error
+        self._finished.set()
+
+
+
+class Executor(object):
+    """
+    Runs calls on a bounded pool of worker threads, so that
+    independent work (such as the same query in every zone of
+    the federation) can be done at once rather than one after
+    another.
+
+      executor = Executor(workers=8)
+      futures = [executor.shell_command(['iquest', '-z', zone, ...],
+                                        timeout=30)
+                 for zone in zones]
+      for future in futures:
+          (rc, output) = future.result()
+      executor.shutdown()
+
+    Commands run by shell_command() are killed at their deadline,
+    so one unreachable zone can't hold up the rest.
+    """
+
+    def __init__(self, workers=4):
+        self.workers = workers
+        self.queue = Queue.Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+
+
+    def submit(self, function, *args, **kwargs):
+        """
+        Queues the call function(*args, **kwargs) and returns
+        its Future.
+        """
+        future = Future()
+        with self.lock:
+            if len(self.threads) < self.workers:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+        self.queue.put((future, function, args, kwargs))
+        return future
+
+
+    def shell_command(self, command_list, environment=None, timeout=None):
+        """
+        Queues shell_command(command_list, environment, timeout),
+        and returns its Future.
+        """
+        return self.submit(shell_command, command_list, environment, timeout)
+
+
+    def map(self, function, *iterables):
+        """
+        Calls 'function' with the items of 'iterables' as for the
+        builtin map, and returns the list of Futures, in order.
+        """
+        return [self.submit(function, *args) for args in zip(*iterables)]
+
+
+    def shutdown(self, wait=True):
+        """
+        Stops the workers once the queued calls are done, waiting
+        for them if 'wait' is set.
+        """
+        with self.lock:
+            threads = self.threads
+            self.threads = []
+        for thread in threads:
+            self.queue.put(None)
+        if wait:
+            for thread in threads:
+                thread.join()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            future, function, args, kwargs = item
+            try:
+                future._set(result=function(*args, **kwargs))
+            except:
+                future._set(error=sys.exc_info())
 
 
 
@@ -96,6 +791,251 @@ def run_iadmin(command, arglist, verbose=False):
     return 0
 
 
+class BatchCommand(object):
+    """
+    A command queued on a CommandBatch. Once the batch has
+    run, 'rc' is 0 if the command succeeded and -1 if it failed,
+    and 'output' holds whatever the command printed.
+    """
+
+    __slots__ = ('args', 'rc', 'output')
+
+    def __init__(self, args):
+        self.args = args
+        self.rc = None
+        self.output = ''
+
+
+    def __str__(self):
+        return ' '.join(self.args)
+
+
+
+class CommandBatch(object):
+    """
+    Queues commands for an icommand that can read commands from
+    stdin (such as iadmin or imeta), and runs them through a few
+    long-lived sessions instead of one process per command.
+
+      batch = CommandBatch('iadmin')
+      mkuser = batch.add('mkuser', 'someone#incf', 'rodsuser')
+      batch.run()
+      if mkuser.rc: ...
+
+    To map the output back to the queued commands, an unknown
+    command is sent after each one, and the program's complaint
+    about it marks the end of that command's output. The session's
+    stdout and stderr are attached to a pseudo-terminal, so they
+    stay line buffered and in order.
+
+    Commands after the point where a session died, or that can't
+    be written on a single command line, are run one at a time
+    instead. So are those after a command that took longer than
+    'timeout' seconds (default_command_timeout if it's None), for
+    which the session is killed.
+
+    'sessions' is the number of sessions run at once, and
+    'session_size' the most commands sent to one session. Use
+    more than one session only for commands that don't depend
+    on each other.
+    """
+
+    def __init__(self, program, sessions=1, session_size=1000, timeout=None):
+        self.program = program
+        self.sessions = sessions
+        self.session_size = session_size
+        self.timeout = timeout
+        self.commands = []
+
+
+    def __len__(self):
+        return len(self.commands)
+
+
+    def add(self, *args):
+        """
+        Queues the command made up of 'args' (e.g. 'mkuser',
+        'user#zone', 'rodsuser') and returns its BatchCommand.
+        """
+        command = BatchCommand(list(args))
+        self.commands.append(command)
+        return command
+
+
+    def run(self, verbose=False):
+        """
+        Runs all the queued commands that haven't been run yet.
+        Returns the number of commands that failed.
+        """
+
+        pending = [command for command in self.commands if command.rc is None]
+        chunks = [pending[i:i+self.session_size]
+                  for i in range(0, len(pending), self.session_size)]
+
+        while chunks:
+            running = chunks[:self.sessions]
+            chunks = chunks[self.sessions:]
+            if len(running) == 1:
+                self._run_session(running[0])
+            else:
+                threads = [threading.Thread(target=self._run_session, args=(chunk,))
+                           for chunk in running]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+
+        failed = 0
+        for command in pending:
+            if command.rc is None:
+                self._run_single(command)
+            if command.rc:
+                failed += 1
+                if verbose:
+                    print('Error running %s %s' % (self.program, command))
+                    print(command.output)
+
+        return failed
+
+
+    def _run_single(self, command):
+        (rc, output) = shell_command([self.program] + command.args, timeout=self.timeout)
+        command.output = '%s%s' % (output[0] or '', output[1] or '')
+        command.rc = 0 if rc == 0 else -1
+
+
+    def _run_session(self, commands):
+
+        lines = []
+        batched = []
+        for command in commands:
+            line = _batch_command_line(command.args)
+            if line is not None:
+                lines.append(line)
+                lines.append(_batch_marker)
+                batched.append(command)
+        if not batched:
+            return
+
+        try:
+            import pty
+            import termios
+            master, slave = pty.openpty()
+            # keep newlines as they are
+            attrs = termios.tcgetattr(slave)
+            attrs[1] = attrs[1] & ~termios.OPOST
+            termios.tcsetattr(slave, termios.TCSANOW, attrs)
+        except (ImportError, OSError):
+            master = slave = None
+
+        try:
+            if slave is not None:
+                process = subprocess.Popen([self.program], stdin=subprocess.PIPE,
+                                           stdout=slave, stderr=slave, close_fds=True)
+                os.close(slave)
+                output = os.fdopen(master, 'rb')
+            else:
+                process = subprocess.Popen([self.program], stdin=subprocess.PIPE,
+                                           stdout=subprocess.PIPE,
+                                           stderr=subprocess.STDOUT)
+                output = process.stdout
+        except OSError:
+            if slave is not None:
+                os.close(master)
+                os.close(slave)
+            return
+
+        def feed():
+            try:
+                process.stdin.write('\n'.join(lines) + '\n')
+                process.stdin.close()
+            except (IOError, OSError):
+                pass
+        writer = threading.Thread(target=feed)
+        writer.start()
+
+        # each command gets the time it would get on its own
+        timeout = self.timeout if self.timeout is not None else default_command_timeout
+        deadline = _Deadline(process, timeout)
+        start = time.time()
+        output_bytes = 0
+        index = 0
+        segment = []
+        try:
+            for line in iter(output.readline, ''):
+                output_bytes += len(line)
+                if 'unrecognized command' in line:
+                    if index < len(batched):
+                        text = ''.join(segment).replace(self.program + '>', '')
+                        batched[index].output = text
+                        batched[index].rc = -1 if _batch_error_regex.search(text) else 0
+                    index += 1
+                    segment = []
+                    deadline.restart()
+                else:
+                    segment.append(line.replace('\r', ''))
+        except IOError:
+            # reading the pseudo-terminal fails once the session exits
+            pass
+        finally:
+            writer.join()
+            process.wait()
+            output.close()
+            if deadline.cancel():
+                # the rest are run one at a time
+                print('%s session timed out after %s seconds on a command'
+                      % (self.program, timeout))
+            profiling.record('%s session' % (self.program,), time.time() - start,
+                             process.returncode, output_bytes)
+
+
+
+# an unknown command, used to mark the end of each command's output
+_batch_marker = 'ids_batch_marker'
+_batch_error_regex = re.compile(r'error|-[0-9]{5,}', re.IGNORECASE)
+
+def _batch_command_line(args):
+    """
+    Quotes 'args' into a single line for an icommand's interactive
+    mode. Returns None if that can't be done.
+    """
+    words = []
+    for arg in args:
+        if '\n' in arg or '\r' in arg or ('"' in arg and "'" in arg):
+            return None
+        if not arg or re.search(r'\s|"|\'', arg):
+            quote = "'" if '"' in arg else '"'
+            words.append(quote + arg + quote)
+        else:
+            words.append(arg)
+    return ' '.join(words)
+
+
+
+def private_directory(path):
+    """
+    Makes sure 'path' is a directory only this user can use, for
+    state that must not be planted or read by other local users:
+    creates it (mode 0700) if need be, removes any group and other
+    permissions, and raises OSError if it's not a directory (or is
+    a symbolic link) or belongs to someone else.
+
+    Returns 'path'.
+    """
+    try:
+        os.makedirs(path, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid():
+        raise OSError(errno.EPERM, 'not a directory of this user', path)
+    if stat.S_IMODE(info.st_mode) & 0o077:
+        os.chmod(path, 0o700)
+    return path
+
+
+
 def get_irods_environment(verbose=False):
     """
     runs the ienv command to extract iRODS environment
@@ -5,25 +5,48 @@ well as functions for creating and deleting zones.
 """
 import os
 
-from ids.utils import run_iquest, run_iadmin, shell_command
+from ids.utils import COMMAND_TIMED_OUT, IquestError, run_iadmin, shell_command
+from ids.genquery import GenQuery
+from ids.cache import cached, invalidate
 
 
 
+# the local zone doesn't change while we're running, so
+# it is only looked up once
+local_zone = None
+
 def get_local_zone(verbose=False):
     """
     This function retrieves the name of the local
-    zone using an iquest query.
+    zone using an iquest query. The name is remembered
+    (and kept in the catalog cache, if that's in use),
+    so only the first call runs the query.
 
     Returns the name of the local zone, or None if
     some error occurred.
     """
+    global local_zone
+
+    if local_zone:
+        return local_zone
+
+    zone = cached('local_zone', '', lambda: _get_local_zone(verbose))
+    if zone:
+        local_zone = zone
+    return zone
 
-    zname = run_iquest("select ZONE_NAME where ZONE_TYPE = 'local'",
-                       format='%s', verbose=verbose)
-    if zname == None:
+
+
+def _get_local_zone(verbose=False):
+    query = GenQuery('ZONE_NAME').where('ZONE_TYPE', '=', 'local')
+    try:
+        zone = query.first(verbose=verbose)
+    except IquestError:
         return None
 
-    return zname.rstrip('\n')
+    if zone is None:
+        return ''
+    return zone.zone_name
 
 
 
@@ -35,13 +58,18 @@ def get_zone_list(verbose=False):
     Returns a list sorted by zone name, or None if
     some error occurred.
     """
+    return cached('zones', 'list', lambda: _get_zone_list(verbose))
+
 
-    output = run_iquest('select order(ZONE_NAME)',
-                        format='%s', verbose=verbose)
-    if not output:
+
+def _get_zone_list(verbose=False):
+    query = GenQuery('order(ZONE_NAME)')
+    try:
+        zones = [row.zone_name for row in query.rows(verbose=verbose)]
+    except IquestError:
         return None
 
-    return [zone.rstrip('\n') for zone in output.splitlines()]
+    return zones or None
 
 
 def get_zone_details(zone_name=None, verbose=False):
@@ -54,41 +82,35 @@ def get_zone_details(zone_name=None, verbose=False):
     Returns a array of dicts with each array element
     representing a zone, and the dict contains the
     zone details including: name, type, endpoint, comment,
-    and creation and modification timestamps. Will return
+    and creation and modification timestamps (as iquest
+    returns them; see ids.genquery.to_datetime). Will return
     None if some error occurred.
     """
+    return cached('zones', 'details:%s' % (zone_name or '',),
+                  lambda: _get_zone_details(zone_name, verbose))
 
-    sep = '~_~'
-    query_fields = [
-        'ZONE_NAME',
-        'ZONE_TYPE',
-        'ZONE_CONNECTION',
-        'ZONE_COMMENT',
-        'ZONE_CREATE_TIME',
-        'ZONE_MODIFY_TIME',
-        ]
-    query_format = sep.join(['%s'] * len(query_fields))
-
-    query = 'select %s' % (','.join(query_fields))
-    if zone_name:
-        query = query + " where ZONE_NAME = '%s'" % (zone_name,)
 
-    output = run_iquest(query, format=query_format, verbose=verbose)
-    if output is None:
-        return None
+
+def _get_zone_details(zone_name=None, verbose=False):
+    query = GenQuery('ZONE_NAME', 'ZONE_TYPE', 'ZONE_CONNECTION', 'ZONE_COMMENT',
+                     'ZONE_CREATE_TIME', 'ZONE_MODIFY_TIME')
+    if zone_name:
+        query.where('ZONE_NAME', '=', zone_name)
 
     zones = []
-    for line in output.splitlines():
-        fields = line.split(sep)
-        zone = {
-            'zone_name': fields[0],
-            'type': fields[1],
-            'connection': fields[2],
-            'comment': fields[3],
-            'create_time': fields[4],
-            'modification_time': fields[5],
-            }
-        zones.append(zone)
+    try:
+        for row in query.rows(verbose=verbose, convert=False):
+            zone = {
+                'zone_name': row.zone_name,
+                'type': row.zone_type,
+                'connection': row.zone_connection,
+                'comment': row.zone_comment,
+                'create_time': row.zone_create_time,
+                'modification_time': row.zone_modify_time,
+                }
+            zones.append(zone)
+    except IquestError:
+        return None
 
     return zones
 
@@ -113,6 +135,7 @@ def make_zone(zone_name, endpoint, comment=None):
         mkzone_args.append(comment)
     if run_iadmin('mkzone', mkzone_args):
         return None
+    invalidate('zones')
 
     # add the zone read ACLs.
     if run_iadmin('modzonecollacl', ['read', 'public', '/%s' % zone_name]):
@@ -142,9 +165,11 @@ def modify_zone(zone_name, endpoint=None, comment=None):
 
     if comment and run_iadmin('modzone', [zone_name, 'comment', comment]):
         return None
+    invalidate('zones')
 
     if endpoint and run_iadmin('modzone', [zone_name, 'conn', endpoint]):
         return None
+    invalidate('zones')
 
     zone = get_zone_details(zone_name)
 
@@ -161,15 +186,18 @@ def remove_zone(zone_name):
     if not zone_name:
         return 0
 
-    return run_iadmin('rmzone', [zone_name,])
+    rc = run_iadmin('rmzone', [zone_name,])
+    invalidate('zones')
+    return rc
 
 
 
-def check_zone_endpoint(zone_name, endpoint):
+def check_zone_endpoint(zone_name, endpoint, timeout=30):
     """
     This function will check if the iRODS service is
     available at the provided endpoint, and if the zone
-    name is accurate.
+    name is accurate. The check gives up after 'timeout'
+    seconds.
 
     Returns a tuple with the first element being True if
     the check was successful (and None in the second element),
@@ -188,7 +216,10 @@ def check_zone_endpoint(zone_name, endpoint):
     env_dict['irodsHost'] = host
     env_dict['irodsPort'] = port
 
-    (rc, output) = shell_command(['imiscsvrinfo',], environment=env_dict)
+    (rc, output) = shell_command(['imiscsvrinfo',], environment=env_dict,
+                                 timeout=timeout)
+    if rc == COMMAND_TIMED_OUT:
+        return (False, 'timed out waiting for a reply from %s' % endpoint)
     if rc:
         if ('SYS_PACK_INSTRUCT_FORMAT_ERR' in output[1]
             or 'SYS_SOCK_READ_TIMEDOUT' in output[1]